@@ -93,6 +93,56 @@ def setup_logging(config, has_filesystem):
         logging.config.dictConfig(LOG_CONFIG_RTD)
 
 
+# Default values for configuration settings that were introduced in later versions of
+# agera5tools. They are applied when a setting is missing from the configuration file, so
+# that existing configuration files keep working.
+config_defaults = {
+    "database": {
+        "ledger_table_name": "ingest_ledger_agera5",
+    },
+    "build": {
+        "days_per_chunk": 31,
+        "workers": 1,
+    },
+    "compact": {
+        "time_chunk": 365,
+        "space_chunk": 16,
+    },
+    "server": {
+        "pool_size": 4,
+        "keep_connections": None,
+        "cache_size_mb": 256,
+        "workers": 1,
+        "threads": 8,
+        "timeout": 60,
+        "max_bulk_locations": 10000,
+        "max_area_rows": 1000000,
+    },
+    "download": {
+        "max_queued": 2,
+        "max_in_flight": 4,
+        "max_retries": 3,
+        "retry_backoff": 30,
+        "max_retry_backoff": 600,
+    },
+}
+
+
+def apply_config_defaults(r, defaults):
+    """Recursively adds the settings from defaults that are missing in r.
+
+    :param r: a dict with the configuration as read from the YAML file
+    :param defaults: a dict with default configuration settings
+    :return: the updated configuration dict
+    """
+    for key, value in defaults.items():
+        if isinstance(value, dict):
+            r[key] = apply_config_defaults(r.get(key) or {}, value)
+        else:
+            r.setdefault(key, value)
+    return r
+
+
 def read_config(mk_paths=True):
     """Reads the YAML file with configuration for AgERA5tools
 
@@ -128,12 +178,20 @@ def read_config(mk_paths=True):
             click.echo(msg)
             sys.exit()
 
+        r = apply_config_defaults(r, config_defaults)
+        # Parquet output is stored next to the CSV output, unless configured otherwise
+        r["data_storage"].setdefault("parquet_path", Path(r["data_storage"]["csv_path"]).parent / "parquet")
+        # The Zarr store is optional and only used when configured
+        r["data_storage"].setdefault("zarr_path", None)
         c =  DotMap(r, _dynamic=False)
         # Update config values into proper objects
         c.region.boundingbox = util.BoundingBox(**c.region.boundingbox)
         c.data_storage.netcdf_path = Path(c.data_storage.netcdf_path)
         c.data_storage.tmp_path = Path(c.data_storage.tmp_path)
         c.data_storage.csv_path = Path(c.data_storage.csv_path)
+        c.data_storage.parquet_path = Path(c.data_storage.parquet_path)
+        if c.data_storage.zarr_path is not None:
+            c.data_storage.zarr_path = Path(c.data_storage.zarr_path)
         c.logging.log_path = Path(c.logging.log_path)
         if mk_paths:
             c.data_storage.netcdf_path.mkdir(exist_ok=True, parents=True)
@@ -144,6 +202,18 @@ def read_config(mk_paths=True):
     return c
 
 
+def reload_config():
+    """Reads the YAML file with configuration again and updates the configuration in place.
+
+    The modules of AgERA5tools refer to the same configuration object, so they all see the
+    new settings. Output directories are not created.
+    """
+    c = read_config(mk_paths=False)
+    if c is not None:
+        config.clear()
+        config.update(c)
+
+
 if "READTHEDOCS" not in os.environ:  # Avoid imports for building documentation on RTD
     has_filesystem = True
     config = read_config(mk_paths=has_filesystem)
@@ -152,7 +222,7 @@ if "READTHEDOCS" not in os.environ:  # Avoid imports for building documentation
     from . import util
     from .dump_grid import dump_grid
     from .dump_clip import dump, clip
-    from .extract_point import extract_point
+    from .extract_point import extract_point, extract_points, read_sites
     from . import build
     from . import init
     from . import check
@@ -2,25 +2,36 @@
 # Copyright (c) December 2022, Wageningen Environmental Research
 # Allard de Wit (allard.dewit@wur.nl)
 import os
+import io
 from pathlib import Path
 import logging
-import shutil
+import zlib
 import gzip
 import time
 from uuid import uuid4
 import datetime as dt
 from zipfile import ZipFile
 import concurrent.futures
+import multiprocessing
 import copy
 from itertools import product
 
 import cdsapi
 import sqlalchemy as sa
 import duckdb
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 import xarray as xr
 
 from .util import number_days_in_month, variable_names, create_target_fname, last_day_in_month, \
-    add_grid, convert_to_celsius, chunker
+    convert_to_celsius, is_temperature, chunker, imap_bounded, pipeline
+from .grid import get_landcell_index
+from .bulkload import bulk_insert
+from .scheduler import create_scheduler
+from .ledger import ledger_records, ledger_mark_started, ledger_mark_finished, ensure_ledger
 from . import config
 
 
@@ -32,37 +43,68 @@ def parse_date_from_zipfname(zipfname):
     return d.date()
 
 
-def move_agera5_file(source_fname, target_fname):
-    """Moves the file from source to target but includes building of directory structure if required
+def extract_zip_member(zip_fname, member, target_fname):
+    """Extracts a member of a ZIP file directly to its target location.
 
-    :param source_fname: The (full) path to the source file
+    The data are written to a temporary file in the target directory which is renamed to the
+    target name after the CRC of the written data was verified against the ZIP file. Extraction
+    is skipped when the target file already exists with the same size and CRC.
+
+    :param zip_fname: The path to the ZIP file
+    :param member: The ZipInfo object of the member to extract
     :param target_fname: The (full) path to the target file
+    :return: the target_fname
     """
+    logger = logging.getLogger(__name__)
+    if target_fname.exists() and target_fname.stat().st_size == member.file_size:
+        crc = 0
+        with open(target_fname, "rb") as fp:
+            while block := fp.read(1024 * 1024):
+                crc = zlib.crc32(block, crc)
+        if crc == member.CRC:
+            logger.debug(f"Skipping extraction of {member.filename}, identical file exists at {target_fname}")
+            return target_fname
+
     target_fname.parent.mkdir(parents=True, exist_ok=True)
-    shutil.move(source_fname, target_fname)
+    tmp_fname = target_fname.with_name(f"{target_fname.name}.{uuid4()}.tmp")
+    try:
+        crc = 0
+        with ZipFile(zip_fname) as myzip, myzip.open(member) as fp_in, open(tmp_fname, "wb") as fp_out:
+            while block := fp_in.read(1024 * 1024):
+                crc = zlib.crc32(block, crc)
+                fp_out.write(block)
+        if crc != member.CRC:
+            raise RuntimeError(f"CRC check failed for {member.filename} in {zip_fname}")
+        os.replace(tmp_fname, target_fname)
+    finally:
+        tmp_fname.unlink(missing_ok=True)
 
+    return target_fname
 
-def unpack_cds_download(download_details):
+
+def unpack_cds_download(download_details, threads=None):
     """Unpacks a downloaded file on the cds and moves the files to the right location
 
+    The files in the ZIP file are extracted in parallel directly into the NetCDF archive.
+
     :param download_details: the details for this download
+    :param threads: the number of threads used for extraction, defaults to the number of CPUs (max 8)
     :return: a list of paths to downloaded files
     """
-    nc_fnames_from_zip = []
     zip_fname = download_details["download_fname"]
     if zip_fname is None:
         return []
 
     with ZipFile(zip_fname) as myzip:
-        for zipfname in myzip.infolist():
-            myzip.extract(zipfname, config.data_storage.tmp_path)
-            tmp_fname = config.data_storage.tmp_path / zipfname.filename
-            day = parse_date_from_zipfname(zipfname)
-            nc_fname = create_target_fname(download_details["varname"], day,
-                                           agera5_dir=config.data_storage.netcdf_path,
-                                           version=config.misc.agera5_version)
-            move_agera5_file(tmp_fname, nc_fname)
-            nc_fnames_from_zip.append(nc_fname)
+        members = myzip.infolist()
+    nc_fnames = [create_target_fname(download_details["varname"], parse_date_from_zipfname(member),
+                                     agera5_dir=config.data_storage.netcdf_path,
+                                     version=config.misc.agera5_version)
+                 for member in members]
+
+    threads = min(threads or os.cpu_count() or 1, 8, max(len(members), 1))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        nc_fnames_from_zip = list(executor.map(extract_zip_member, [zip_fname] * len(members), members, nc_fnames))
 
     # Delete tmp download zip file
     zip_fname.unlink()
@@ -73,14 +115,15 @@ def unpack_cds_download(download_details):
 def download_one_month(input):
     """Download one month of CDS data for given variable name, year and month
 
-    :param input: a tuple of three elements consisting of
+    :param input: a tuple of three or four elements consisting of
        - agera5_variable_name: the full name of the AgERA5 variable, as in YAML configuration
        - year: the year for the download
        - month: the month for the download
+       - days: optionally, the days of the month to download, by default the whole month
     :return: a dict with input variables and the path to the downloaded filename
     """
-    agera5_variable_name, year, month = input
-    ndays_in_month = number_days_in_month(year, month)
+    agera5_variable_name, year, month = input[:3]
+    days = input[3] if len(input) > 3 else range(1, number_days_in_month(year, month) + 1)
     cds_variable_details = copy.deepcopy(variable_names[agera5_variable_name])
     version = str(config.misc.agera5_version).replace(".", "_")
 
@@ -89,7 +132,7 @@ def download_one_month(input):
             'variable': cds_variable_details.pop("variable"),
             'year': f'{year}',
             'month': f'{month:02}',
-            'day': [f"{s+1:02}" for s in range(ndays_in_month)],
+            'day': [f"{d:02}" for d in days],
             'area': config.region.boundingbox.get_cds_bbox(),
             'version': f'{version}'
         }
@@ -97,7 +140,12 @@ def download_one_month(input):
 
     download_fname = config.data_storage.tmp_path / f"cds_download_{uuid4()}.zip"
     c = cdsapi.Client(quiet=True)
-    c.retrieve('sis-agrometeorological-indicators', cds_query, download_fname)
+    try:
+        c.retrieve('sis-agrometeorological-indicators', cds_query, download_fname)
+    except Exception:
+        # Remove partial downloads, the request may be retried
+        download_fname.unlink(missing_ok=True)
+        raise
 
     msg = f"Downloaded data for {agera5_variable_name} for {year}-{month:02} to {download_fname}."
     logger = logging.getLogger(__name__)
@@ -106,6 +154,49 @@ def download_one_month(input):
     return dict(year=year, month=month, varname=agera5_variable_name, download_fname=download_fname)
 
 
+def download_and_unpack_month(input):
+    """Downloads one month of CDS data for given variable name, year and month and unpacks it.
+
+    :param input: a tuple of (agera5_variable_name, year, month) or (agera5_variable_name, year, month, days)
+    :return: a list of paths to the NetCDF files
+    """
+    return unpack_cds_download(download_one_month(input))
+
+
+def download_months(months):
+    """Downloads the NetCDF files for all variables of the given months that are not yet available.
+
+    All downloads go through one scheduler which limits the number of requests to the CDS in
+    flight and retries failed requests. Downloads for the next months already start while
+    variables of earlier months are still downloading.
+
+    :param months: an iterable of tuples of three elements consisting of
+       - year: the year for the download
+       - month: the month for the download
+       - varnames: the AgERA5 variable names to download
+    :return: a generator yielding the input tuples of the months, in the same order, when their
+       downloads are finished. Months for which a download failed are skipped.
+    """
+    logger = logging.getLogger(__name__)
+
+    def download_tasks():
+        for year, month, varnames in months:
+            tasks = [(v, year, month) for v in varnames if not nc_files_available(v, year, month)]
+            if tasks:
+                logger.info(f"Scheduling CDS download of {len(tasks)} AgERA5 variables for {year}-{month:02}")
+            else:
+                logger.info(f"Skipping download for {year}-{month:02}, NetCDF files already exist.")
+            yield (year, month, varnames), tasks
+
+    scheduler = create_scheduler(download_and_unpack_month, "build")
+    for month_input, _, errors in scheduler.run_groups(download_tasks()):
+        year, month, _ = month_input
+        if errors:
+            logger.error(f"Failed downloading AgERA5 data for {year}-{month:02}, skipping this month.")
+            continue
+        yield month_input
+
+
 def determine_build_range():
     """Determines the range of years/months to build the initial AgERA5 database based on the configuration
 
@@ -174,65 +265,292 @@ def modify_dataframe(df):
     return df
 
 
+def open_ncfiles(nc_files):
+    """Opens the NetCDF files as one multifile dataset.
+
+    The NetCDF files can contain several variables and several days, they are combined
+    by their coordinates into a single time-stacked dataset with dimensions (time, lat, lon).
+
+    :param nc_files: a list of NetCDF file to treat as one meta file
+    :return: an xarray dataset
+    """
+    ds = xr.open_mfdataset(nc_files, combine="by_coords", data_vars="minimal", coords="minimal",
+                           compat="override", parallel=True)
+    return ds
+
+
+def dataset_to_table(ds, add_gridid=True):
+    """Converts an AgERA5 dataset into an Arrow table.
+
+    The cells are gathered from the NumPy buffer of each variable, which avoids the
+    (time, lat, lon) MultiIndex and the copies made by `ds.to_dataframe()` and `modify_dataframe()`.
+    With grid IDs only the land cells of the region are gathered using the precomputed land cell
+    index, without grid IDs all cells of the dataset are kept. Rows with N/A values are removed
+    afterwards. The output has the same columns and conversions as `modify_dataframe()`.
+
+    :param ds: an xarray dataset with AgERA5 variables on (time, lat, lon)
+    :param add_gridid: add an idgrid column and keep only the land cells of the region (True)
+        or add lat/lon columns of the grid centre and keep all cells (False)
+    :return: a pyarrow Table with a day column, a column for each AgERA5 variable and idgrid
+        or lat/lon columns
+    """
+    lat, lon = ds.lat.values, ds.lon.values
+    if add_gridid:
+        cells, idgrid = get_landcell_index().gather_positions(lat, lon)
+    else:
+        cells = np.arange(len(lat) * len(lon))
+    ndays = ds.sizes["time"]
+
+    days = ds.time.values.astype("datetime64[D]")
+    columns = {"day": np.repeat(days, len(cells))}
+    if not add_gridid:
+        # add 0.05 to move coordinates to grid centre
+        columns["lat"] = np.tile(lat[cells // len(lon)] + 0.05, ndays)
+        columns["lon"] = np.tile(lon[cells % len(lon)] + 0.05, ndays)
+    is_valid = np.ones(ndays * len(cells), dtype=bool)
+    for varname in ds.data_vars:
+        if varname == "idgrid":
+            continue
+        values = ds[varname].transpose("time", "lat", "lon").values
+        values = values.reshape(ndays, -1)[:, cells].ravel()
+        is_valid &= ~np.isnan(values)
+        if config.misc.kelvin_to_celsius and is_temperature(varname):
+            values -= 273.15
+        columns[varname.lower()] = values
+    if add_gridid:
+        columns["idgrid"] = np.tile(idgrid, ndays)
+
+    # Remove any rows with N/A values
+    if not is_valid.all():
+        columns = {name: values[is_valid] for name, values in columns.items()}
+
+    # Solar radiation flux can be integer for more compact output
+    if "solar_radiation_flux" in columns:
+        columns["solar_radiation_flux"] = columns["solar_radiation_flux"].astype(np.int64)
+
+    return pa.table(columns)
+
+
+def convert_ncfiles_to_tables(nc_files, days_per_chunk=None):
+    """Reads the NetCDF files as multifile dataset and converts it to Arrow tables in chunks of days.
+
+    The NetCDF files are opened only once and each chunk of days is converted in one
+    vectorized pass. This avoids the overhead of opening and converting the files day by day.
+
+    :param nc_files: a list of NetCDF file to treat as one meta file
+    :param days_per_chunk: the number of days to convert into one table, if None all days
+        are converted into a single table.
+    :return: a generator yielding Arrow tables for consecutive chunks of days
+    """
+    ds = open_ncfiles(nc_files)
+    ndays = ds.sizes["time"]
+    if days_per_chunk is None:
+        days_per_chunk = ndays
+    for time_range in chunker(range(ndays), days_per_chunk):
+        ds_chunk = ds.isel(time=slice(time_range.start, time_range.stop))
+        yield dataset_to_table(ds_chunk)
+
+
+def convert_ncfiles_to_table(nc_files):
+    """reads the NetCDF files as multifile dataset and convert it to an Arrow table
+
+    :param nc_files: a list of NetCDF file to treat as one meta file
+    :return: an Arrow table representation of the NetCDF files
+    """
+    tbl, = convert_ncfiles_to_tables(nc_files)
+    return tbl
+
+
 def convert_ncfiles_to_dataframe(nc_files):
     """reads the NetCDF files as multifile dataset, add a grid ID layer and convert it to dataframe
 
     :param nc_files: a list of NetCDF file to treat as one meta file
     :return: a dataframe representation of the NetCDF files
     """
-    ds = xr.open_mfdataset(nc_files)
-    ds = add_grid(ds)
-    df = ds.to_dataframe()
-    df = modify_dataframe(df)
-    return df
+    return convert_ncfiles_to_table(nc_files).to_pandas()
+
+
+def as_arrow_table(df):
+    """Returns the AgERA5 data as an Arrow table.
+
+    :param df: a pandas dataframe or Arrow table with AgERA5 data
+    :return: an Arrow table
+    """
+    if isinstance(df, pa.Table):
+        return df
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def describe_days(df):
+    """Returns a descriptor for the days in the data, e.g. "2000-01-01" or "2000-01-01 to 2000-01-10".
+
+    :param df: a pandas dataframe or Arrow table with AgERA5 data
+    """
+    days = pc.min_max(as_arrow_table(df).column("day"))
+    first_day, last_day = days["min"].as_py(), days["max"].as_py()
+    return f"{first_day}" if first_day == last_day else f"{first_day} to {last_day}"
+
+
+def convert_month(input, streaming=False):
+    """Converts the NetCDF files of one month into Arrow tables.
+
+    This function is executed by the worker processes of the conversion stage in `build()`.
+
+    :param input: a tuple of three elements consisting of
+       - year: the year to convert
+       - month: the month to convert
+       - varnames: the AgERA5 variable names to include
+    :param streaming: if True, the tables are returned as a generator instead of a list.
+    :return: a dict with year, month, the NetCDF files names and the tables
+    """
+    year, month, varnames = input
+    nc_files = get_nc_filenames(varnames, year, month)
+    tables = convert_ncfiles_to_tables(nc_files, config.build.days_per_chunk)
+    if not streaming:
+        tables = list(tables)
+    return dict(year=year, month=month, nc_files=nc_files, tables=tables)
+
+
+def convert_months(inputs, workers=1):
+    """Converts the NetCDF files for the given months, in parallel when workers > 1.
+
+    With a single worker, the months are converted in the calling process and the chunks
+    of each month are converted when they are consumed. Otherwise, a pool of worker processes
+    converts the months and results are returned in order of completion. The number of
+    months being converted or waiting to be written is limited to twice the number of workers.
+
+    :param inputs: an iterable of (year, month, varnames) tuples
+    :param workers: the number of worker processes
+    :return: a generator yielding the output of `convert_month()` for each month
+    """
+    if workers <= 1:
+        for inp in inputs:
+            yield convert_month(inp, streaming=True)
+    else:
+        # Use spawn to avoid forking a process that runs download threads in the background
+        mp_context = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor:
+            yield from imap_bounded(executor, convert_month, inputs, max_pending=2*workers)
+
+
+def write_month(converted, to_database, to_csv, to_parquet=False):
+    """Writes the converted tables of one month to the database, CSV file and/or Parquet file.
+
+    :param converted: the output of `convert_month()`
+    :param to_database: Flag indicating if results should be written to the database
+    :param to_csv: Flag indicating if a compressed CSV file should be written.
+    :param to_parquet: Flag indicating if a Parquet file should be written.
+    """
+    logger = logging.getLogger(__name__)
+    year, month = converted["year"], converted["month"]
+    csv_fname = config.data_storage.csv_path / f"weather_grid_agera5_{year}-{month:02}.csv.gz"
+    csv_fname_tmp = f"{csv_fname}.{uuid4()}.tmp"
+    CSV_not_yet_written = False if csv_fname.exists() else True
+    parquet_fname = create_parquet_fname(year, month, f"weather_grid_agera5_{year}-{month:02}")
+    parquet_fname_tmp = create_parquet_tmp_fname(parquet_fname)
+    Parquet_not_yet_written = False if parquet_fname.exists() else True
+
+    fm = "w"  # Start a new CSV file with the first chunk, append the others
+    parquet_writer = None  # Opened with the first chunk, the others are added as row groups
+    completed = False
+    try:
+        for tbl in converted["tables"]:
+            if to_database:
+                df_to_database(tbl, descriptor=describe_days(tbl))
+
+            if to_csv and CSV_not_yet_written:
+                df_to_csv(tbl, csv_fname_tmp, filemode=fm)
+                fm = "a"
+
+            if to_parquet and Parquet_not_yet_written:
+                parquet_writer = df_to_parquet(tbl, parquet_fname_tmp, parquet_writer)
+        completed = True
+    finally:
+        # Finalize the Parquet file, an incomplete file is removed
+        if parquet_writer is not None:
+            parquet_writer.close()
+            if not completed:
+                parquet_fname_tmp.unlink(missing_ok=True)
+
+    # Move tmp CSV file to final name
+    if to_csv and CSV_not_yet_written:
+        os.rename(csv_fname_tmp, csv_fname)
+
+    # Move tmp Parquet file to final name
+    if parquet_writer is not None:
+        os.rename(parquet_fname_tmp, parquet_fname)
+        logger.info(f"Written output to Parquet: {parquet_fname}")
 
 
 def df_to_database(df, descriptor):
-    """Insert dataframe rows into the database.
+    """Insert dataframe rows into the database and records the days in the ingest ledger.
 
-    :param df: a dataframe with AgERA5 data
+    :param df: a dataframe or Arrow table with AgERA5 data
     :param descriptor: a descriptor for this set of data, usually year-month ("2000-01") or a date ("2000-01-01")
     """
     logger = logging.getLogger(__name__)
     t1 = time.time()
+    tbl = as_arrow_table(df)
+    records = ledger_records(tbl)
     try:
         if config.database.dsn.startswith("duckdb"):
             fname_duckdb = Path(config.database.dsn.replace("duckdb:///", ""))
             with duckdb.connect(fname_duckdb) as DBconn:
-                DBconn.sql(f"INSERT INTO {config.database.agera5_table_name} BY NAME SELECT * FROM df")
+                # data and ledger are written in one transaction
+                DBconn.begin()
+                DBconn.sql(f"INSERT INTO {config.database.agera5_table_name} BY NAME SELECT * FROM tbl")
+                DBconn.sql(f"INSERT OR REPLACE INTO {config.database.ledger_table_name} BY NAME SELECT * FROM records")
+                DBconn.commit()
         else:
             engine = sa.create_engine(config.database.dsn)
-            meta = sa.MetaData()
-            tbl = sa.Table(config.database.agera5_table_name, meta, autoload_with=engine)
-            recs = df.to_dict(orient="records")
-            nrecs_written = 0
-            with engine.begin() as DBconn:
-                ins = tbl.insert()
-                for chunk in chunker(recs, config.database.chunk_size):
-                    DBconn.execute(ins, chunk)
-                    nrecs_written += len(chunk)
-                    msg = f"Written {nrecs_written} from total {len(recs)} records to database."
-                    logger.info(msg)
+            ledger_mark_started(engine, records.column("day").to_pylist())
+            bulk_insert(engine, config.database.agera5_table_name, tbl, config.database.chunk_size)
+            ledger_mark_finished(engine, records)
+            engine.dispose()
         logger.info(f"Written AgERA5 data for {descriptor} to database in {time.time()-t1} seconds.")
-    except (sa.exc.IntegrityError, duckdb.duckdb.ConstraintException) as e:
+    except (sa.exc.IntegrityError, duckdb.ConstraintException) as e:
         logger.warning(f"Failed inserting AgERA5 data for {descriptor}: duplicate rows!")
     except Exception as e:
         logger.error(f"Failed inserting AgERA5 data for {descriptor}: {e}!")
 
 
-def df_to_csv(df, csv_fname, filemode="w"):
+def compress_csv_block(batch, compresslevel=5):
+    """Formats a block of records as CSV (without header) and compresses it as a gzip member.
+
+    :param batch: an Arrow table or record batch
+    :param compresslevel: the gzip compression level
+    :return: the compressed bytes
+    """
+    buf = io.BytesIO()
+    pa_csv.write_csv(batch, buf, pa_csv.WriteOptions(include_header=False))
+    return gzip.compress(buf.getvalue(), compresslevel=compresslevel)
+
+
+def df_to_csv(df, csv_fname, filemode="w", rows_per_block=100000, threads=None):
     """Write dataframe to a compressed CSV file
 
-    :param df:  a dataframe with AgERA5 data
+    The records are formatted and compressed in blocks of rows by a pool of threads. Each block
+    becomes a separate gzip member, the concatenated members form a standard gzip file. Memory use
+    is bounded by the number of blocks in flight, not by the size of the dataframe.
+
+    :param df:  a dataframe or Arrow table with AgERA5 data
     :param csv_fname: the name of the file to write to
     :param filemode: the way the file should be opened: either "w" (write) or "a" (append)
+    :param rows_per_block: the number of rows compressed as one gzip member
+    :param threads: the number of compression threads, defaults to the number of CPUs (max 8)
     """
     logger = logging.getLogger(__name__)
 
-    hdr = True if filemode=="w" else False
+    tbl = as_arrow_table(df)
+    threads = threads or min(os.cpu_count() or 1, 8)
     try:
-        with gzip.open(csv_fname, filemode, compresslevel=5) as fp:
-            fp.write(df.to_csv(None, header=hdr, index=False, date_format="%Y-%m-%d").encode("utf-8"))
+        with open(csv_fname, filemode + "b") as fp, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            if filemode == "w":
+                fp.write(gzip.compress((",".join(tbl.column_names) + "\n").encode("utf-8"), compresslevel=5))
+            blocks = tbl.to_batches(max_chunksize=rows_per_block)
+            for member in imap_bounded(executor, compress_csv_block, blocks, max_pending=2*threads, ordered=True):
+                fp.write(member)
         logger.info(f"Written output to CSV: {csv_fname}")
     except Exception as e:
         logger.exception(f"Failed writing CSV file with AgERA5 data for {csv_fname}).")
@@ -240,6 +558,59 @@ def df_to_csv(df, csv_fname, filemode="w"):
     return csv_fname
 
 
+def create_parquet_fname(year, month, name):
+    """Returns the name of a Parquet file in the hive partitioned (year=/month=) Parquet dataset.
+
+    :param year: the year of the data
+    :param month: the month of the data
+    :param name: the name of the file without extension
+    """
+    return config.data_storage.parquet_path / f"year={year}" / f"month={month}" / f"{name}.parquet"
+
+
+def create_parquet_tmp_fname(parquet_fname):
+    """Returns a temporary name for writing a Parquet file before it is renamed to parquet_fname.
+
+    The temporary file is in the same directory, so it can be renamed, but its name starts with
+    an underscore and does not end with ".parquet", so readers of the Parquet dataset ignore it.
+
+    :param parquet_fname: the final name of the Parquet file
+    """
+    return parquet_fname.with_name(f"_{parquet_fname.name}.{uuid4()}.tmp")
+
+
+def df_to_parquet(df, parquet_fname, writer=None):
+    """Writes dataframe to a Parquet file.
+
+    Columns are stored with their types, zstd compression and dictionary encoding. Rows are sorted
+    by idgrid and day and statistics plus a page index are written for these columns which
+    allows readers to skip data when filtering on location or date.
+
+    :param df: a dataframe or Arrow table with AgERA5 data
+    :param parquet_fname: the name of the file to write to
+    :param writer: an open ParquetWriter to append to, if None a new file is started
+    :return: the ParquetWriter, which must be closed by the caller to finalize the file. A writer
+        opened by this function is closed when writing fails.
+    """
+    tbl = as_arrow_table(df)
+    tbl = tbl.sort_by([(c, "ascending") for c in ("idgrid", "day") if c in tbl.column_names])
+    new_writer = writer is None
+    if new_writer:
+        Path(parquet_fname).parent.mkdir(parents=True, exist_ok=True)
+        sorted_columns = [c for c in ("idgrid", "day") if c in tbl.column_names]
+        writer = pq.ParquetWriter(parquet_fname, tbl.schema, compression="zstd",
+                                  use_dictionary=sorted_columns, write_statistics=sorted_columns,
+                                  write_page_index=True)
+    try:
+        writer.write_table(tbl)
+    except Exception:
+        if new_writer:
+            writer.close()
+        raise
+
+    return writer
+
+
 def nc_files_available(varname, year, month):
     """This checks the available NetCDF file on the disk cache. If all files are already available, return True
     else False.
@@ -277,7 +648,7 @@ def get_nc_filenames(varnames, year, month, day=None, check=True):
     """
     logger = logging.getLogger(__name__)
     if day is None:
-        days = number_days_in_month(year, month)
+        days = dates_in_month(year, month)
     else:
         days = [day]
     nc_fnames = []
@@ -297,7 +668,7 @@ def get_nc_filenames(varnames, year, month, day=None, check=True):
     return nc_fnames
 
 
-def build(year_month=None, to_database=True, to_csv=False):
+def build(year_month=None, to_database=True, to_csv=False, to_parquet=False):
     """Builds the AgERA5tools database.
 
     This step is useful to initially populate the database with data because the build step downloads the data
@@ -307,58 +678,37 @@ def build(year_month=None, to_database=True, to_csv=False):
     :param year_month: Only process given (year, month) when given
     :param to_database: Flag indicating if results should be written to the database immediately
     :param to_csv: Flag indicating if a compressed CSV file should be written.
+    :param to_parquet: Flag indicating if the data should be added to the Parquet dataset.
     """
     logger = logging.getLogger(__name__)
+    if to_database:
+        engine = sa.create_engine(config.database.dsn)
+        ensure_ledger(engine)
+        engine.dispose()
     build_years_months = determine_build_range()
     selected_years_months = build_years_months if year_month is None else year_month
     selected_variables = [varname for varname, selected in config.variables.items() if selected]
 
-    for year, month in build_years_months:
-        if (year, month) not in selected_years_months:
-            continue
-        logger.info(f"Starting AgERA5 download for {year}-{month:02}")
-        potential_downloads = [(v, year, month) for v in selected_variables]
-        actual_downloads = [inp for inp in potential_downloads if not nc_files_available(*inp)]
-        if actual_downloads:
-            logger.info(f"Starting concurrent CDS download of {len(actual_downloads)} AgERA5 variables.")
-            with concurrent.futures.ThreadPoolExecutor(max_workers=len(actual_downloads)) as executor:
-                downloaded_sets = executor.map(download_one_month, actual_downloads)
-
-            downloaded_ncfiles = []
-            for dset in downloaded_sets:
-                ncfiles = unpack_cds_download(dset)
-                downloaded_ncfiles.extend(ncfiles)
+    months = [(year, month, selected_variables) for year, month in build_years_months
+              if (year, month) in selected_years_months]
+    # Months are downloaded in the background while the months already downloaded are converted.
+    downloaded_months = pipeline(download_months(months), None, maxsize=config.download.max_queued)
+    try:
+        if to_database or to_csv or to_parquet:
+            logger.info(f"Starting conversion of {len(months)} months with {config.build.workers} worker(s).")
+            for converted in convert_months(downloaded_months, config.build.workers):
+                write_month(converted, to_database, to_csv, to_parquet)
+
+                # Delete NetCDF files if required
+                if config.data_storage.keep_netcdf is False:
+                    [f.unlink() for f in converted["nc_files"]]
         else:
-            logger.info(f"Skipping download, NetCDF files already exist.")
-
-    for year, month in build_years_months:
-        if (year, month) not in selected_years_months:
-            continue
-        csv_fname = config.data_storage.csv_path / f"weather_grid_agera5_{year}-{month:02}.csv.gz"
-        csv_fname_tmp = f"{csv_fname}.{uuid4()}.tmp"
-        CSV_not_yet_written = False if csv_fname.exists() else True
-
-        for day in dates_in_month(year, month):
-            nc_files = get_nc_filenames(selected_variables, year, month, day)
-            df = None
-
-            if to_database or to_csv:
-                df = convert_ncfiles_to_dataframe(nc_files)
-
-            if to_database:
-                df_to_database(df, descriptor=f"{day}")
-
-            if to_csv and CSV_not_yet_written:
-                fm = "w" if day.day == 1 else "a"  # Start new file on 1st day of the month, else append
-                df_to_csv(df, csv_fname_tmp, filemode=fm)
-
-            # Delete NetCDF files if required
-            if config.data_storage.keep_netcdf is False:
-                [f.unlink() for f in nc_files]
-
-        # Move tmp CSV file to final name
-        if to_csv and CSV_not_yet_written:
-            os.rename(csv_fname_tmp, csv_fname)
+            for year, month, varnames in downloaded_months:
+                if config.data_storage.keep_netcdf is False:
+                    [f.unlink() for f in get_nc_filenames(varnames, year, month)]
+    finally:
+        # Stop downloading in the background when converting or writing failed
+        downloaded_months.close()
 
 
 if __name__ == "__main__":
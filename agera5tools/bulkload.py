@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) October 2026, Wageningen Environmental Research
+# Allard de Wit (allard.dewit@wur.nl)
+"""Bulk loading of Arrow tables into relational databases.
+
+The loader is selected on the SQLAlchemy dialect of the engine. Fast paths exist for
+PostgreSQL (COPY FROM STDIN) and SQLite (executemany on tuples within one transaction),
+other databases use a generic path through SQLAlchemy. Additional loaders can be
+registered with the `register_loader` decorator.
+"""
+import io
+import logging
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import sqlalchemy as sa
+
+bulk_loaders = {}
+
+
+def register_loader(dialect_name):
+    """Decorator registering a bulk loader for the given SQLAlchemy dialect name.
+
+    A loader has the signature loader(engine, table_name, tbl, chunk_size) and returns
+    the number of records written.
+    """
+    def decorator(func):
+        bulk_loaders[dialect_name] = func
+        return func
+    return decorator
+
+
+def bulk_insert(engine, table_name, tbl, chunk_size=10000):
+    """Inserts the rows of an Arrow table into a database table.
+
+    Duplicate rows raise an sqlalchemy.exc.IntegrityError regardless of the loader used.
+
+    :param engine: an SQLAlchemy engine
+    :param table_name: the name of the table to insert into
+    :param tbl: an Arrow table, its column names must match the columns in the database table
+    :param chunk_size: the number of rows written in one batch
+    :return: the number of records written
+    """
+    loader = bulk_loaders.get(engine.dialect.name, insert_generic)
+    return loader(engine, table_name, tbl, max(int(chunk_size), 1))
+
+
+def _iter_batches(tbl, chunk_size):
+    """Yields the Arrow table as slices of at most chunk_size rows.
+    """
+    for offset in range(0, tbl.num_rows, chunk_size):
+        yield tbl.slice(offset, chunk_size)
+
+
+def _log_progress(nrecs_written, nrecs_total):
+    logger = logging.getLogger(__name__)
+    logger.info(f"Written {nrecs_written} from total {nrecs_total} records to database.")
+
+
+def _run_raw(engine, sql, load):
+    """Runs load(cursor) on a raw DBAPI connection within one transaction.
+
+    DBAPI integrity errors are re-raised as sqlalchemy.exc.IntegrityError.
+    """
+    raw_conn = engine.raw_connection()
+    try:
+        cursor = raw_conn.cursor()
+        nrecs = load(cursor)
+        cursor.close()
+        raw_conn.commit()
+    except engine.dialect.dbapi.IntegrityError as e:
+        raw_conn.rollback()
+        raise sa.exc.IntegrityError(sql, None, e)
+    except Exception:
+        raw_conn.rollback()
+        raise
+    finally:
+        raw_conn.close()
+
+    return nrecs
+
+
+@register_loader("postgresql")
+def insert_postgresql(engine, table_name, tbl, chunk_size):
+    """Loads the table with COPY FROM STDIN, streaming CSV formatted by Arrow.
+
+    Supports both the psycopg2 and psycopg (version 3) drivers. For other drivers
+    the generic loader is used.
+    """
+    driver = engine.dialect.driver
+    if driver not in ("psycopg2", "psycopg"):
+        return insert_generic(engine, table_name, tbl, chunk_size)
+
+    quote = engine.dialect.identifier_preparer.quote
+    columns = ", ".join(quote(c) for c in tbl.column_names)
+    sql = f"COPY {quote(table_name)} ({columns}) FROM STDIN WITH (FORMAT csv)"
+    write_options = pa_csv.WriteOptions(include_header=False)
+
+    def load(cursor):
+        nrecs_written = 0
+        for batch in _iter_batches(tbl, chunk_size):
+            buf = io.BytesIO()
+            pa_csv.write_csv(batch, buf, write_options)
+            buf.seek(0)
+            if driver == "psycopg2":
+                cursor.copy_expert(sql, buf)
+            else:
+                with cursor.copy(sql) as copy:
+                    copy.write(buf.getvalue())
+            nrecs_written += batch.num_rows
+            _log_progress(nrecs_written, tbl.num_rows)
+        return nrecs_written
+
+    return _run_raw(engine, sql, load)
+
+
+@register_loader("sqlite")
+def insert_sqlite(engine, table_name, tbl, chunk_size):
+    """Loads the table with executemany on tuples on the raw sqlite3 connection.
+
+    All rows are written in a single transaction. Synchronous writes are disabled and
+    the page cache is enlarged during the load, the previous settings are restored afterwards.
+    """
+    quote = engine.dialect.identifier_preparer.quote
+    columns = ", ".join(quote(c) for c in tbl.column_names)
+    placeholders = ", ".join("?" * tbl.num_columns)
+    sql = f"INSERT INTO {quote(table_name)} ({columns}) VALUES ({placeholders})"
+
+    # SQLite has no date type, dates are stored as ISO strings like SQLAlchemy does
+    for i, field in enumerate(tbl.schema):
+        if pa.types.is_temporal(field.type):
+            tbl = tbl.set_column(i, field.name, pc.cast(tbl.column(i), pa.string()))
+
+    def load(cursor):
+        synchronous = cursor.execute("PRAGMA synchronous").fetchone()[0]
+        cache_size = cursor.execute("PRAGMA cache_size").fetchone()[0]
+        cursor.execute("PRAGMA synchronous = OFF")
+        cursor.execute("PRAGMA cache_size = -262144")
+        try:
+            nrecs_written = 0
+            for batch in _iter_batches(tbl, chunk_size):
+                rows = zip(*[col.to_pylist() for col in batch.columns])
+                cursor.executemany(sql, rows)
+                nrecs_written += batch.num_rows
+                _log_progress(nrecs_written, tbl.num_rows)
+            # commit here because PRAGMA synchronous cannot be changed within a transaction
+            cursor.connection.commit()
+        finally:
+            if cursor.connection.in_transaction:
+                cursor.connection.rollback()
+            cursor.execute(f"PRAGMA cache_size = {int(cache_size)}")
+            cursor.execute(f"PRAGMA synchronous = {int(synchronous)}")
+        return nrecs_written
+
+    return _run_raw(engine, sql, load)
+
+
+def insert_generic(engine, table_name, tbl, chunk_size):
+    """Loads the table through SQLAlchemy, converting one chunk of rows at a time.
+    """
+    meta = sa.MetaData()
+    db_table = sa.Table(table_name, meta, autoload_with=engine)
+    ins = db_table.insert()
+    nrecs_written = 0
+    with engine.begin() as DBconn:
+        for batch in _iter_batches(tbl, chunk_size):
+            DBconn.execute(ins, batch.to_pylist())
+            nrecs_written += batch.num_rows
+            _log_progress(nrecs_written, tbl.num_rows)
+
+    return nrecs_written
@@ -5,8 +5,12 @@
 import datetime as dt
 from itertools import product
 
+import sqlalchemy as sa
+
 from . import config
 from .util import create_target_fname
+from .ledger import find_ingested_days
+from .manifest import get_archive_manifest
 
 
 def determine_day_range():
@@ -24,22 +28,56 @@ def determine_day_range():
     return days_required
 
 
-def check():
-    """This checks the existence of the NetCDF files in the archive and does some basic checking on the
-    files itself.
+def check_archive(validate=False, rescan=False):
+    """Checks the NetCDF files in the archive using the archive manifest.
 
-    :return: the list of missing files
+    Only the directories in the archive that have changed since the previous check are
+    scanned, see `agera5tools.manifest`.
+
+    :param validate: validate the header and shape of NetCDF files that were not validated before
+    :param rescan: scan all directories of the archive again
+    :return: a tuple with the list of missing files and a dict with invalid files and the reason
     """
     days = determine_day_range()
     selected_variables = [varname for varname, selected in config.variables.items() if selected]
+    years = sorted({day.year for day in days})
+    keys = [f"{year}/{varname.replace('_', '-')}" for year, varname in product(years, selected_variables)]
+    manifest = get_archive_manifest(keys, validate=validate, rescan=rescan)
+
     missing_nc_fnames = []
     for varname, day in product(selected_variables, days):
         f = create_target_fname(varname, day, agera5_dir=config.data_storage.netcdf_path, version=config.misc.agera5_version)
-        if not f.exists():
+        if manifest.get(f) is None:
             missing_nc_fnames.append(f)
 
+    return missing_nc_fnames, manifest.find_invalid()
+
+
+def check():
+    """This checks the existence of the NetCDF files in the archive.
+
+    :return: the list of missing files
+    """
+    missing_nc_fnames, _ = check_archive()
     return missing_nc_fnames
 
 
+def check_database():
+    """Checks the days loaded into the database using the ingest ledger.
+
+    :return: a tuple with the sorted lists of days missing in the database and days that
+        were not loaded completely
+    """
+    engine = sa.create_engine(config.database.dsn)
+    try:
+        complete_days, incomplete_days = find_ingested_days(engine)
+    finally:
+        engine.dispose()
+    days = determine_day_range()
+    missing_days = [day for day in days if day not in complete_days and day not in incomplete_days]
+
+    return missing_days, sorted(incomplete_days)
+
+
 if __name__ == "__main__":
     check()
\ No newline at end of file
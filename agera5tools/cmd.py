@@ -9,13 +9,14 @@ import click
 os.environ["CMD_MODE"] = "1"
 
 from .util import BoundingBox, check_date, check_date_range, write_dataframe, Point, day_fmt
-from .extract_point import extract_point
+from .extract_point import extract_point, extract_points, read_sites
 from .dump_clip import dump, clip
 from .dump_grid import dump_grid
 from .init import init
 from .build import build
 from .mirror import mirror
-from .check import check
+from .check import check_archive, check_database
+from .compact import compact
 from .server import serve
 from . import config
 from . import __version__
@@ -71,6 +72,42 @@ def cmd_extract_point(longitude, latitude, startdate, enddate, output=None):
     write_dataframe(df, output)
 
 
+@click.command("extract_points")
+@click.argument("sites", type=click.Path(exists=True))
+@click.argument("startdate")
+@click.argument("enddate")
+@click.option("-o", "--output", type=click.Path(),
+              help=("output file to write to: .csv, .json and .db3 (SQLite) are supported. "
+                    "Giving no output will write to stdout in CSV format. With --per_site this "
+                    "is the directory to write the CSV files to."))
+@click.option("--per_site", is_flag=True,
+              help="Write a CSV file for each site instead of a single file in long format.")
+def cmd_extract_points(sites, startdate, enddate, output=None, per_site=False):
+    """Extracts AgERA5 data for the sites in a CSV or GeoJSON file and date range.
+
+    \b
+    SITES: a CSV file with site, latitude and longitude columns or a GeoJSON file with points
+    STARTDATE: the start date (yyyy-mm-dd, >=1979-01-01)
+    ENDDATE: the last date (yyyy-mm-dd, <= 1 week ago)
+    """
+    startdate, enddate = check_date_range(startdate, enddate)
+    try:
+        df = extract_points(read_sites(sites), startdate, enddate)
+    except (RuntimeError, KeyError, ValueError) as e:
+        click.echo(f"Failed extracting sites from {sites}: {e}")
+        sys.exit(1)
+    if not per_site:
+        write_dataframe(df, None if output is None else Path(output))
+        return
+
+    output = Path.cwd() if output is None else Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    for site, df_site in df.groupby("site", sort=False):
+        fname = output / f"{str(site).replace(os.sep, '_')}.csv"
+        df_site.drop(columns="site").to_csv(fname, index=False, float_format="%7.2f")
+    click.echo(f"Written CSV output for {df.site.nunique()} sites to: {output}")
+
+
 @click.command("dump")
 @click.argument("day")
 @click.option("-o", "--output", type=click.Path(),
@@ -159,17 +196,20 @@ def cmd_init():
               help="Load AgERA5 data into the database")
 @click.option("-c", "--to_csv", is_flag=True, flag_value=True,
               help="Write AgERA5 data to compressed CSV files.")
-def cmd_build(to_database, to_csv):
+@click.option("-p", "--to_parquet", is_flag=True, flag_value=True,
+              help="Write AgERA5 data to the partitioned Parquet dataset.")
+def cmd_build(to_database, to_csv, to_parquet):
     """Builds the AgERA5 database by bulk download from CDS
     """
     print(f"Export to database: {to_database}")
     print(f"Export to CSV: {to_csv}")
-    if to_csv is False and to_database is False:
+    print(f"Export to Parquet: {to_parquet}")
+    if to_csv is False and to_database is False and to_parquet is False:
         msg = ("Warning: Only NetCDF files will be updated, no tabular output will be written, "
-               "use either --to_database, --to_csv")
+               "use either --to_database, --to_csv or --to_parquet")
         click.echo(msg)
 
-    build(None, to_database, to_csv)
+    build(None, to_database, to_csv, to_parquet)
     msg = "Done building database, use the `mirror` command to keep the DB up to date"
     click.echo(msg)
 
@@ -181,17 +221,20 @@ def cmd_build(to_database, to_csv):
               help="Load AgERA5 data into the database")
 @click.option("-c", "--to_csv", is_flag=True, flag_value=True,
               help="Write AgERA5 data to compressed CSV files.")
-def cmd_buildym(year, month, to_database, to_csv):
+@click.option("-p", "--to_parquet", is_flag=True, flag_value=True,
+              help="Write AgERA5 data to the partitioned Parquet dataset.")
+def cmd_buildym(year, month, to_database, to_csv, to_parquet):
     """Builds the AgERA5 database by bulk download from CDS for given year/month only
     """
     print(f"Export to database: {to_database}")
     print(f"Export to CSV: {to_csv}")
-    if to_csv is False and to_database is False:
+    print(f"Export to Parquet: {to_parquet}")
+    if to_csv is False and to_database is False and to_parquet is False:
         msg = ("Warning: Only NetCDF files will be updated, no tabular output will be written, "
-               "use either --to_database, --to_csv")
+               "use either --to_database, --to_csv or --to_parquet")
         click.echo(msg)
     year_month = [(year, month)]
-    build(year_month, to_database, to_csv)
+    build(year_month, to_database, to_csv, to_parquet)
     msg = "Done building database, use the `mirror` command to keep the DB up to date"
     click.echo(msg)
 
@@ -199,12 +242,14 @@ def cmd_buildym(year, month, to_database, to_csv):
 @click.command("mirror")
 @click.option("-c", "--to_csv", is_flag=True,
               help="Write AgERA5 data to compressed CSV files.")
+@click.option("-p", "--to_parquet", is_flag=True,
+              help="Write AgERA5 data to the partitioned Parquet dataset.")
 @click.option("-d", "--dry-run", is_flag=True,
               help="Do not run mirror but only check for days to update.")
-def cmd_mirror(to_csv=False, dry_run=False):
+def cmd_mirror(to_csv=False, dry_run=False, to_parquet=False):
     """Incrementally updates the AgERA5 database by daily downloads from the CDS.
     """
-    days, days_failed = mirror(to_csv, dry_run)
+    days, days_failed = mirror(to_csv, dry_run, to_parquet)
     days_done = days.difference(days_failed)
     if not days:
         click.echo("Found no days to update the AgERA5 database for.")
@@ -222,28 +267,74 @@ def cmd_mirror(to_csv=False, dry_run=False):
 
 
 @click.command("check")
-def cmd_check():
-    """Checks the completeness of NetCDF files from which the database is built
+@click.option("--validate", is_flag=True,
+              help="Validate the header of NetCDF files that were not validated before.")
+@click.option("--rescan", is_flag=True,
+              help="Scan the entire NetCDF archive again instead of only changed directories.")
+def cmd_check(validate, rescan):
+    """Checks the completeness of NetCDF files and of the days loaded into the database
     """
-    missing = check()
+    missing, invalid = check_archive(validate=validate, rescan=rescan)
     if not missing:
         click.echo(f"Found no missing NetCDF files under {config.data_storage.netcdf_path}")
     else:
         click.echo(f"Found {len(missing)} missing NetCDF files under {config.data_storage.netcdf_path}:")
         for f in missing:
             click.echo(f" - {f}")
+    if invalid:
+        click.echo(f"Found {len(invalid)} invalid NetCDF files under {config.data_storage.netcdf_path}:")
+        for f, reason in sorted(invalid.items()):
+            click.echo(f" - {f}: {reason}")
+
+    try:
+        missing_days, incomplete_days = check_database()
+    except Exception as e:
+        click.echo(f"Could not check the ingest ledger in the database: {e}")
+        return
+    if not missing_days and not incomplete_days:
+        click.echo("Found no missing days in the database")
+    else:
+        click.echo(f"Found {len(missing_days)} missing days in the database: {day_fmt(set(missing_days))}")
+        click.echo(f"Found {len(incomplete_days)} incompletely loaded days in the database: "
+                   f"{day_fmt(set(incomplete_days))}")
+
+
+@click.command("compact")
+def cmd_compact():
+    """Compacts the NetCDF archive into a Zarr store for fast reading of time series
+    """
+    try:
+        days = compact()
+    except RuntimeError as e:
+        click.echo(str(e))
+        sys.exit(1)
+    if not days:
+        click.echo(f"Found no days to add to the Zarr store at {config.data_storage.zarr_path}")
+    else:
+        click.echo(f"Added {len(days)} days ({days[0]} to {days[-1]}) to the Zarr store at "
+                   f"{config.data_storage.zarr_path}")
 
 
 @click.command("serve")
 @click.option("-p", "--port", help="Port to number to start listening, default=8080.", default=8080)
-def cmd_serve(port):
+@click.option("-w", "--workers", type=int, default=None,
+              help="Number of worker processes, default from `server.workers` in the configuration. "
+                   "More than one worker requires gunicorn.")
+@click.option("-t", "--threads", type=int, default=None,
+              help="Number of threads per worker, default from `server.threads` in the configuration.")
+def cmd_serve(port, workers, threads):
     """Starts the http server to serve AgERA5 data through HTTP
     """
     print(f"Started serving AgERA5 data on http://localhost:{port}")
-    serve(port)
+    try:
+        serve(port, workers, threads)
+    except RuntimeError as e:
+        click.echo(str(e))
+        sys.exit(1)
 
 
 cli.add_command(cmd_extract_point)
+cli.add_command(cmd_extract_points)
 cli.add_command(cmd_dump)
 cli.add_command(cmd_clip)
 cli.add_command(cmd_dump_grid)
@@ -251,6 +342,7 @@ cli.add_command(cmd_init)
 cli.add_command(cmd_build)
 cli.add_command(cmd_buildym)
 cli.add_command(cmd_mirror)
+cli.add_command(cmd_compact)
 cli.add_command(cmd_check)
 cli.add_command(cmd_serve)
 
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) October 2026, Wageningen Environmental Research
+# Allard de Wit (allard.dewit@wur.nl)
+"""Compacts the archive of daily NetCDF files into a Zarr store.
+
+The NetCDF archive holds one file per variable and day, so reading a time series for a
+location requires opening a file for every day and variable. The Zarr store holds all
+selected variables for the region on a continuous daily time axis, chunked with many days
+and few grid cells per chunk. A time series for a location then requires reading a single
+chunk per variable for every `compact.time_chunk` days.
+
+The Zarr store is optional, it requires the `zarr` package and the `data_storage.zarr_path`
+setting in the configuration.
+"""
+import logging
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from . import config
+from .util import create_target_fname
+from .build import open_ncfiles
+from .check import determine_day_range
+
+
+@lru_cache(maxsize=1)
+def zarr_installed():
+    """Returns True if the zarr package is installed, otherwise a warning is logged once.
+    """
+    try:
+        import zarr
+    except ImportError:
+        logger = logging.getLogger(__name__)
+        logger.warning("A Zarr store is configured but the zarr package is not installed, "
+                       "install it with `pip install zarr`.")
+        return False
+    return True
+
+
+def zarr_store_configured():
+    """Returns True if a Zarr store is configured and the zarr package is installed.
+    """
+    if config.data_storage.zarr_path is None:
+        return False
+    return zarr_installed()
+
+
+def open_zarr_store():
+    """Opens the Zarr store as an xarray dataset.
+
+    :return: an xarray dataset or None when the Zarr store is not configured or does not exist yet
+    """
+    if not zarr_store_configured() or not config.data_storage.zarr_path.exists():
+        return None
+    return xr.open_zarr(config.data_storage.zarr_path)
+
+
+def open_zarr_dataset(startday, endday, variables):
+    """Returns the selected variables for the given date range from the Zarr store.
+
+    :param startday: the first day
+    :param endday: the last day
+    :param variables: the names of the AgERA5 variables, e.g. "Precipitation_Flux"
+    :return: an xarray dataset, or None if the Zarr store does not hold all variables
+        for the complete date range. In that case data should be read from the NetCDF archive.
+    """
+    ds = open_zarr_store()
+    if ds is None or ds.sizes["time"] == 0:
+        return None
+    startday, endday = pd.Timestamp(startday), pd.Timestamp(endday)
+    if startday < ds.time.values[0] or endday > ds.time.values[-1] or not all(v in ds.data_vars for v in variables):
+        return None
+    return ds[variables].sel(time=slice(startday, endday))
+
+
+def prepare_for_zarr(ds):
+    """Removes the encoding taken from the NetCDF files and loads the data into memory.
+    """
+    ds = ds.load()
+    for v in ds.variables:
+        ds[v].encoding = {}
+    return ds
+
+
+def write_to_zarr(ds):
+    """Writes a dataset with consecutive days to the Zarr store.
+
+    Days that are already in the store are overwritten, days following directly on the last
+    day in the store are appended. A new store is created when it does not exist yet.
+
+    :param ds: an xarray dataset with the selected AgERA5 variables on (time, lat, lon)
+    """
+    logger = logging.getLogger(__name__)
+    zarr_path = config.data_storage.zarr_path
+    ds = prepare_for_zarr(ds.transpose("time", "lat", "lon"))
+    days = pd.DatetimeIndex(ds.time.values)
+
+    ds_store = open_zarr_store()
+    if ds_store is None:
+        chunks = (config.compact.time_chunk, config.compact.space_chunk, config.compact.space_chunk)
+        encoding = {v: {"chunks": chunks} for v in ds.data_vars}
+        encoding["time"] = {"units": "days since 1900-01-01", "dtype": "int32"}
+        ds.attrs.update(agera5_version=str(config.misc.agera5_version), region=config.region.name)
+        ds.to_zarr(zarr_path, mode="w-", encoding=encoding, consolidated=True)
+        logger.info(f"Created Zarr store at {zarr_path} with days {days[0].date()} to {days[-1].date()}")
+        return
+
+    store_days = pd.DatetimeIndex(ds_store.time.values)
+    if ds_store.sizes["lat"] != ds.sizes["lat"] or ds_store.sizes["lon"] != ds.sizes["lon"] or \
+            not np.allclose(ds_store.lat.values, ds.lat.values) or not np.allclose(ds_store.lon.values, ds.lon.values):
+        msg = f"Grid of the data does not match the grid of the Zarr store at {zarr_path}"
+        raise RuntimeError(msg)
+
+    # Overwrite days already in the store
+    existing = days.isin(store_days)
+    if existing.any():
+        ds_existing = ds.isel(time=np.flatnonzero(existing)).drop_vars(["lat", "lon"])
+        i = store_days.get_loc(days[existing][0])
+        ds_existing.to_zarr(zarr_path, region={"time": slice(i, i + ds_existing.sizes["time"])})
+
+    # Append new days
+    if not existing.all():
+        ds_new = ds.isel(time=np.flatnonzero(~existing))
+        if ds_new.time.values[0] != (store_days[-1] + pd.Timedelta(days=1)).to_datetime64():
+            msg = f"Cannot append {pd.Timestamp(ds_new.time.values[0]).date()} to the Zarr store at " \
+                  f"{zarr_path}, the store ends at {store_days[-1].date()}. Run `agera5tools compact` " \
+                  f"to fill the gap from the NetCDF archive."
+            raise RuntimeError(msg)
+        ds_new.to_zarr(zarr_path, append_dim="time", consolidated=True)
+    logger.info(f"Written days {days[0].date()} to {days[-1].date()} to Zarr store at {zarr_path}")
+
+
+def update_zarr_store(nc_files):
+    """Adds the data from the given NetCDF files to the Zarr store, if the store exists.
+
+    This is used by `mirror` to keep the Zarr store up to date. Failures are logged and not
+    raised, the store can be brought up to date later with the `compact` command.
+
+    :param nc_files: a list of NetCDF files with the selected variables for consecutive days
+    :return: True if the data were written to the store, False otherwise
+    """
+    logger = logging.getLogger(__name__)
+    if open_zarr_store() is None:
+        return False
+    try:
+        write_to_zarr(open_ncfiles(nc_files))
+    except Exception as e:
+        logger.warning(f"Failed to update Zarr store: {e}")
+        return False
+    return True
+
+
+def compact(days_per_block=None):
+    """Adds the days in the NetCDF archive that are not yet in the Zarr store to the store.
+
+    The days are added in blocks of consecutive days, starting after the last day in the store
+    (or at the start of the temporal range for a new store) until the first day for which a
+    NetCDF file is missing.
+
+    :param days_per_block: the number of days read into memory and written at once, defaults
+        to the `build.days_per_chunk` setting.
+    :return: a list with the days that were added
+    """
+    logger = logging.getLogger(__name__)
+    if config.data_storage.zarr_path is None:
+        msg = "No Zarr store configured, set `zarr_path` in the `data_storage` section of the configuration."
+        raise RuntimeError(msg)
+    if not zarr_store_configured():
+        msg = "The zarr package is required for compacting the archive, install it with `pip install zarr`."
+        raise RuntimeError(msg)
+
+    days_per_block = days_per_block or config.build.days_per_chunk
+    selected_variables = [varname for varname, selected in config.variables.items() if selected]
+    ds_store = open_zarr_store()
+    days = determine_day_range()
+    if ds_store is not None and ds_store.sizes["time"] > 0:
+        last_day = pd.Timestamp(ds_store.time.values[-1]).date()
+        days = [day for day in days if day > last_day]
+
+    days_added = []
+    block = []
+    for day in days + [None]:
+        if day is not None:
+            nc_fnames = [create_target_fname(v, day, agera5_dir=config.data_storage.netcdf_path,
+                                             version=config.misc.agera5_version)
+                         for v in selected_variables]
+            complete = all(f.exists() for f in nc_fnames)
+            if complete:
+                block.append(nc_fnames)
+            else:
+                logger.info(f"NetCDF files for {day} are missing, stopped compacting at {day}.")
+        if block and (day is None or not complete or len(block) == days_per_block):
+            ds = open_ncfiles([f for nc_fnames in block for f in nc_fnames])
+            write_to_zarr(ds)
+            days_added.extend(pd.Timestamp(t).date() for t in ds.time.values)
+            block = []
+        if day is not None and not complete:
+            break
+
+    return days_added
@@ -1,90 +1,539 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) December 2022, Wageningen Environmental Research
 # Allard de Wit (allard.dewit@wur.nl)
+import time
 import datetime as dt
+import itertools
+from functools import lru_cache
 
 from sqlalchemy import MetaData, Table, select, and_
 import sqlalchemy as sa
 from dotmap import DotMap
+import numpy as np
 import pandas as pd
 
 from . import config
-from .util import Point, check_date, get_grid
+from .util import Point, BoundingBox, check_date, chunker
+from .grid import get_region_grid_definition, GridIndex
+from .ledger import define_ledger_table
 
 
-def fetch_grid_agera5_properties(engine, idgrid):
-    """Retrieves latitude, longitude, elevation from "grid" table.
+aggregation_periods = ("dekad", "month", "year")
 
-    Assigns them to self.latitude, self.longitude, self.elevation.
+aggregation_functions = {"sum": sa.func.sum, "mean": sa.func.avg, "min": sa.func.min, "max": sa.func.max}
+
+
+def aggregation_statistic(varname):
+    """Returns the statistic used to aggregate a variable over a period.
+
+    Precipitation and radiation are summed, maximum and minimum temperatures are aggregated to
+    the maximum and minimum, all other variables are averaged.
+
+    :param varname: the name of the variable
+    :return: one of "sum", "mean", "min" or "max"
     """
-    metadata = sa.MetaData()
-    metadata.reflect(engine)
-    tg = Table(config.database.grid_table_name, metadata, autoload_with=engine)
-    sc = select(tg).where(tg.c.idgrid == idgrid)
-    with engine.connect() as DBconn:
-        cursor = DBconn.execute(sc)
-        row = cursor.fetchone()
-    if row is None:
-        msg = "No land grid at this location or outside region definition!"
-        raise RuntimeError(msg)
+    varname = varname.lower()
+    if varname in ("precipitation_flux", "solar_radiation_flux"):
+        return "sum"
+    if "_max_" in varname:
+        return "max"
+    if "_min_" in varname:
+        return "min"
+    return "mean"
+
+
+def parse_variables(variables):
+    """Parses the variables of a request given as a list or as a comma-separated string.
+
+    :return: a list of unique variable names in lower case, or None when no variables are given
+    """
+    if variables in (None, "", "None"):
+        return None
+    if isinstance(variables, str):
+        variables = variables.split(",")
+    parsed = []
+    for varname in variables:
+        varname = str(varname).strip().lower()
+        if varname and varname not in parsed:
+            parsed.append(varname)
+    return parsed or None
+
+
+class ServerEngine:
+    """Database access for the HTTP server.
+
+    The engine with its connection pool is created once, the tables are reflected once and the
+    SELECT statements are built once with bound parameters, so that SQLAlchemy can reuse their
+    compiled form. The land cells of the grid table are loaded once into a GridIndex. For DuckDB
+    the connections are opened read-only.
+
+    DuckDB allows only one process to open a database file when it is written, a process that
+    keeps read-only connections therefore blocks `mirror`. With `server.keep_connections` set
+    to `no`, connections are opened for each request and closed afterwards. This is the default
+    for DuckDB, other databases keep connections open by default.
+
+    A database without ingest ledger is checked again for a ledger at most once every
+    `ledger_check_interval` seconds, so that a ledger created by `mirror` is used without
+    restarting the server.
+
+    :param dsn: the SQLAlchemy database URL
+    """
+
+    ledger_check_interval = 60
+
+    def __init__(self, dsn):
+        url = sa.engine.make_url(dsn)
+        kwargs = {}
+        if url.get_backend_name() == "duckdb":
+            kwargs["connect_args"] = {"read_only": True}
+        keep_connections = config.server.keep_connections
+        if keep_connections is None:
+            keep_connections = url.get_backend_name() != "duckdb"
+        if not keep_connections:
+            kwargs["poolclass"] = sa.pool.NullPool
+        elif url.get_backend_name() != "sqlite" and url.database not in (None, "", ":memory:"):
+            kwargs.update(pool_size=config.server.pool_size, max_overflow=config.server.pool_size,
+                          pool_pre_ping=True)
+        self.engine = sa.create_engine(url, **kwargs)
+
+        meta = sa.MetaData()
+        self.weather_table = Table(config.database.agera5_table_name, meta, autoload_with=self.engine)
+        self.grid_table = Table(config.database.grid_table_name, meta, autoload_with=self.engine)
+        self.ledger_table = define_ledger_table(meta)
+        self.has_ledger = sa.inspect(self.engine).has_table(config.database.ledger_table_name)
+        self._ledger_checked = time.monotonic()
+
+        gw, ledger = self.weather_table, self.ledger_table
+        self.select_weather = select(gw).where(and_(gw.c.idgrid == sa.bindparam("idgrid"),
+                                                    gw.c.day >= sa.bindparam("startdate"),
+                                                    gw.c.day <= sa.bindparam("enddate")))
+        self.select_weather_bulk = select(gw).where(
+            and_(gw.c.idgrid.in_(sa.bindparam("idgrids", expanding=True)),
+                 gw.c.day >= sa.bindparam("startdate"),
+                 gw.c.day <= sa.bindparam("enddate"))).order_by(gw.c.idgrid, gw.c.day)
+        grid = self.grid_table
+        self.select_weather_area = select(gw, grid.c.latitude, grid.c.longitude).join(
+            grid, grid.c.idgrid == gw.c.idgrid).where(
+            and_(grid.c.latitude >= sa.bindparam("lat_min"), grid.c.latitude <= sa.bindparam("lat_max"),
+                 grid.c.longitude >= sa.bindparam("lon_min"), grid.c.longitude <= sa.bindparam("lon_max"),
+                 gw.c.day >= sa.bindparam("startdate"), gw.c.day <= sa.bindparam("enddate"))
+        ).order_by(gw.c.day, gw.c.idgrid)
+        self.select_ledger_state = select(
+            sa.func.max(sa.case((ledger.c.nrows.isnot(None), ledger.c.day))).label("latest_day"),
+            sa.func.max(ledger.c.ingest_time).label("ingest_time"),
+            sa.func.count().label("nrecords"))
+        self.grid_index = GridIndex.from_table(self.engine, config.database.grid_table_name)
+        self.weather_variables = [c.name for c in gw.columns if c.name not in ("idgrid", "day")]
+        self._weather_statements = {(None, None): self.select_weather}
+
+    def select_variables(self, variables):
+        """Checks the variables of a request and returns them in the order of the weather table.
+
+        :param variables: a list of variable names (lower case), or None
+        :return: the list of variables, or None when no variables or all variables are given
+        """
+        if variables is None:
+            return None
+        unknown = [v for v in variables if v not in self.weather_variables]
+        if unknown:
+            msg = f"Unknown variable(s) {', '.join(unknown)}, should be one of {', '.join(self.weather_variables)}"
+            raise RuntimeError(msg)
+        variables = [v for v in self.weather_variables if v in variables]
+        return None if variables == self.weather_variables else variables
 
-    latitude = float(row.latitude)
-    longitude = float(row.longitude)
-    elevation = float(row.elevation)
+    def weather_statement(self, variables=None, aggregate=None):
+        """Returns the SELECT statement for the meteo data of a grid cell and date range with
+        only the given variables and optionally aggregated per period.
+
+        For aggregated data the rows are grouped per dekad, month or year in the database and
+        each variable is aggregated with the statistic given by `aggregation_statistic()`. The
+        column "day" then holds the first day of the period within the date range and the
+        column "ndays" the number of days with data in the period. Statements are built once
+        for each combination of variables and period, the variables are ordered as in the
+        weather table, see `select_variables()`.
+
+        :param variables: a list of variable names (lower case), None selects all variables
+        :param aggregate: None, "dekad", "month" or "year"
+        """
+        variables = self.select_variables(variables)
+        key = (None if variables is None else tuple(variables), aggregate)
+        stmt = self._weather_statements.get(key)
+        if stmt is not None:
+            return stmt
+
+        if aggregate is not None and aggregate not in aggregation_periods:
+            msg = f"Unknown aggregation period '{aggregate}', should be one of {', '.join(aggregation_periods)}"
+            raise RuntimeError(msg)
+
+        gw = self.weather_table
+        variables = self.weather_variables if variables is None else variables
+        where = and_(gw.c.idgrid == sa.bindparam("idgrid"),
+                     gw.c.day >= sa.bindparam("startdate"),
+                     gw.c.day <= sa.bindparam("enddate"))
+        if aggregate is None:
+            stmt = select(gw.c.idgrid, gw.c.day, *[gw.c[v] for v in variables]).where(where)
+        else:
+            period = [sa.extract("year", gw.c.day)]
+            if aggregate in ("dekad", "month"):
+                period.append(sa.extract("month", gw.c.day))
+            if aggregate == "dekad":
+                day_of_month = sa.extract("day", gw.c.day)
+                period.append(sa.case((day_of_month <= 10, 1), (day_of_month <= 20, 2), else_=3))
+            aggregates = [aggregation_functions[aggregation_statistic(v)](gw.c[v]).label(v) for v in variables]
+            stmt = select(gw.c.idgrid, sa.func.min(gw.c.day).label("day"), sa.func.count().label("ndays"),
+                          *aggregates).where(where).group_by(gw.c.idgrid, *period).order_by(sa.func.min(gw.c.day))
+        self._weather_statements[key] = stmt
+        return stmt
+
+    def query(self, stmt, **params):
+        """Executes a SELECT statement and returns the result as a dataframe.
+        """
+        with self.engine.connect() as DBconn:
+            result = DBconn.execute(stmt, params)
+            return pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+
+    def find_grid(self, lon, lat, search_radius):
+        """Returns the idgrid of the grid cell containing the location, or of the nearest
+        grid cell within search_radius when the location is not on land. Returns None when
+        no grid cell is found.
+        """
+        return self.grid_index.find_idgrid(lon, lat, max_distance=search_radius)
+
+    def fetch_ledger_state(self):
+        """Returns the last day loaded completely and the version of the ingest ledger.
+
+        The version changes with every change to the ledger: new days, backfilled earlier days
+        and days that were deleted and reloaded. It is a tuple with the last day, the last
+        time of loading and the number of days in the ledger, which are retrieved with a
+        single query.
+
+        :return: a tuple (latest_day, version), (None, None) when the database has no ledger
+        """
+        if not self.has_ledger:
+            if time.monotonic() - self._ledger_checked < self.ledger_check_interval:
+                return None, None
+            self._ledger_checked = time.monotonic()
+            self.has_ledger = sa.inspect(self.engine).has_table(config.database.ledger_table_name)
+            if not self.has_ledger:
+                return None, None
+        with self.engine.connect() as DBconn:
+            latest, ingest_time, nrecords = DBconn.execute(self.select_ledger_state).one()
+        if isinstance(latest, str):
+            latest = dt.date.fromisoformat(latest)
+        return latest, (latest, ingest_time, nrecords)
+
+    def stream_weather(self, idgrid, startdate, enddate, batch_size=1000, variables=None, aggregate=None):
+        """Retrieves the meteo data for the grid cell and date range in batches of rows.
+
+        The rows are fetched from the database cursor while the batches are consumed, the
+        connection is returned to the pool when the generator is exhausted or closed.
+
+        :param variables: the variables to retrieve, see `weather_statement()`
+        :param aggregate: the period to aggregate to, see `weather_statement()`
+        :return: a generator yielding first the list of column names and then lists of rows
+        """
+        stmt = self.weather_statement(variables, aggregate)
+        with self.engine.connect() as DBconn:
+            result = DBconn.execution_options(stream_results=True).execute(
+                stmt, dict(idgrid=idgrid, startdate=startdate, enddate=enddate))
+            yield list(result.keys())
+            for rows in iter(lambda: result.fetchmany(batch_size), []):
+                yield [tuple(row) for row in rows]
+
+    def stream_weather_bulk(self, idgrids, startdate, enddate, batch_size=1000, idgrids_per_query=5000):
+        """Retrieves the meteo data for many grid cells and a date range in batches of rows,
+        ordered by grid cell and day.
+
+        The grid cells are selected with `idgrid IN (...)`, very long lists of grid cells are
+        split over several queries to stay within the limits of the database on the number of
+        parameters.
+
+        :return: a generator yielding first the list of column names and then lists of rows
+        """
+        yield [c.name for c in self.weather_table.columns]
+        with self.engine.connect() as DBconn:
+            for idgrids_chunk in chunker(sorted(set(idgrids)), idgrids_per_query):
+                result = DBconn.execution_options(stream_results=True).execute(
+                    self.select_weather_bulk, dict(idgrids=idgrids_chunk, startdate=startdate, enddate=enddate))
+                for rows in iter(lambda: result.fetchmany(batch_size), []):
+                    yield [tuple(row) for row in rows]
+
+    def stream_weather_area(self, bbox, startdate, enddate, batch_size=10000):
+        """Retrieves the meteo data for the grid cells with their centre in the bounding box
+        and the date range in batches of rows, ordered by day and grid cell.
+
+        :return: a generator yielding first the list of column names and then lists of rows
+        """
+        with self.engine.connect() as DBconn:
+            result = DBconn.execution_options(stream_results=True).execute(
+                self.select_weather_area, dict(lat_min=bbox.lat_min, lat_max=bbox.lat_max, lon_min=bbox.lon_min,
+                                               lon_max=bbox.lon_max, startdate=startdate, enddate=enddate))
+            yield list(result.keys())
+            for rows in iter(lambda: result.fetchmany(batch_size), []):
+                yield [tuple(row) for row in rows]
+
+    def fetch_weather(self, idgrid, startdate, enddate, variables=None, aggregate=None):
+        """Retrieves the meteo data for the grid cell and date range.
+
+        :param variables: the variables to retrieve, see `weather_statement()`
+        :param aggregate: the period to aggregate to, see `weather_statement()`
+        """
+        df = self.query(self.weather_statement(variables, aggregate), idgrid=idgrid, startdate=startdate,
+                        enddate=enddate)
+        df.index = pd.to_datetime(df.day)
+        return df
+
+
+@lru_cache(maxsize=1)
+def get_server_engine():
+    """Returns the ServerEngine for the configured database, it is created on first use.
+    """
+    return ServerEngine(config.database.dsn)
 
-    return DotMap(latitude=latitude, longitude=longitude, elevation=elevation)
 
+def fetch_grid_agera5_properties(idgrid):
+    """Retrieves latitude, longitude, elevation for the given grid.
 
-def fetch_agera5_weather_from_db(engine, idgrid, startdate, enddate):
-    """Retrieves the meteo data from table 'config.database.agera5_table_name'
+    The properties are taken from the in-memory grid definition of the region which
+    holds the same values as the "grid" table, avoiding a database query per request.
     """
-    metadata = sa.MetaData()
-    gw = Table(config.database.agera5_table_name, metadata, autoload_with=engine)
-    sel = select(gw).where(and_(gw.c.idgrid == idgrid,
-                                gw.c.day >= startdate,
-                                gw.c.day <= enddate))
-    df = pd.read_sql(sel, engine)
-    df.index = pd.to_datetime(df.day)
+    return get_region_grid_definition().properties(idgrid)
 
-    return df
 
+def request_date_range(startdate=None, enddate=None):
+    """Checks the date range of a request.
 
-def get_agera5(latitude, longitude, startdate=None, enddate=None):
+    The date range defaults to the temporal range in the configuration and is limited to
+    the last day loaded into the database.
+
+    :return: a tuple with startdate, enddate, the last day loaded into the database and the
+        version of the ingest ledger, see `ServerEngine.fetch_ledger_state()`
+    """
     # Check the start and end dates and assign when ok
     try:
         startdate = check_date(startdate)
-    except ValueError:
+    except (ValueError, TypeError):
         startdate = dt.date(config.temporal_range.start_year, 1, 1)
     try:
         enddate = check_date(enddate)
-    except ValueError:
+    except (ValueError, TypeError):
         enddate = dt.date(config.temporal_range.end_year, 12, 31)
 
+    # Limit the date range to the days loaded into the database, databases without
+    # an ingest ledger are queried for the full range.
+    latest_day, ledger_version = get_server_engine().fetch_ledger_state()
+    if latest_day is not None:
+        if startdate > latest_day:
+            raise RuntimeError(f"No AgERA5 data available after {latest_day}")
+        enddate = min(enddate, latest_day)
+
+    return startdate, enddate, latest_day, ledger_version
+
+
+def locate_agera5(latitude, longitude, startdate=None, enddate=None, variables=None, aggregate=None):
+    """Checks the location, date range, variables and aggregation period of a request and finds
+    the AgERA5 grid cell.
+
+    :param variables: a list or comma-separated string of variables, defaults to all variables
+    :param aggregate: None (daily data), "dekad", "month" or "year"
+    :return: a DotMap with idgrid, startdate, enddate, latest_day, ledger_version, location_info,
+        variables and aggregate
+    """
     pnt = Point(longitude, latitude)
     if not config.region.boundingbox.point_in_bbox(pnt):
         msg = f'{pnt} not in boundingbox of region!'
         raise RuntimeError(msg)
 
-    engine = sa.create_engine(config.database.dsn)
+    server_engine = get_server_engine()
+    variables = server_engine.select_variables(parse_variables(variables))
+    aggregate = None if aggregate in (None, "", "None") else aggregate
+    server_engine.weather_statement(variables, aggregate)
+    startdate, enddate, latest_day, ledger_version = request_date_range(startdate, enddate)
+
     print(f"Requesting data for lat {latitude:7.2f}, lon {longitude:7.2f}")
-    idgrid_agera5 = get_grid(engine, pnt.longitude, pnt.latitude,
-                             config.database.grid_table_name, config.misc.grid_search_radius)
-    grid_agera5_properties = fetch_grid_agera5_properties(engine, idgrid_agera5)
-    df_AgERA5 = fetch_agera5_weather_from_db(engine, idgrid_agera5, startdate, enddate)
+    idgrid_agera5 = server_engine.find_grid(pnt.longitude, pnt.latitude, config.misc.grid_search_radius)
+    if idgrid_agera5 is None:
+        raise RuntimeError("No land grid at this location or outside region definition!")
+    grid_agera5_properties = fetch_grid_agera5_properties(idgrid_agera5)
+    location_info = {
+        "input_latitude": latitude,
+        "input_longitude": longitude,
+        "grid_agera5_latitude": grid_agera5_properties.latitude,
+        "grid_agera5_longitude": grid_agera5_properties.longitude,
+        "grid_agera5_elevation": grid_agera5_properties.elevation,
+        "region_name": config.region.name,
+    }
+    return DotMap(idgrid=idgrid_agera5, startdate=startdate, enddate=enddate, latest_day=latest_day,
+                  ledger_version=ledger_version, location_info=location_info, variables=variables,
+                  aggregate=aggregate, _dynamic=False)
 
+
+def fetch_agera5_records(location):
+    """Retrieves the meteo data for a location found by `locate_agera5()` as a list of records.
+    """
+    df_AgERA5 = get_server_engine().fetch_weather(location.idgrid, location.startdate, location.enddate,
+                                                  location.variables, location.aggregate)
     if len(df_AgERA5) == 0:
         raise RuntimeError("No AgERA5 data found for this location and/or date range")
+    return df_AgERA5.to_dict(orient="records")
+
+
+def stream_agera5_rows(location, batch_size=1000):
+    """Retrieves the meteo data for a location found by `locate_agera5()` in batches of rows.
+
+    :return: a tuple with the list of column names and an iterator over lists of rows
+    """
+    batches = get_server_engine().stream_weather(location.idgrid, location.startdate, location.enddate,
+                                                 batch_size, location.variables, location.aggregate)
+    columns = next(batches)
+    first_batch = next(batches, None)
+    if first_batch is None:
+        raise RuntimeError("No AgERA5 data found for this location and/or date range")
+    return columns, itertools.chain([first_batch], batches)
+
+
+def locate_agera5_bulk(points=None, idgrids=None, startdate=None, enddate=None):
+    """Finds the AgERA5 grid cells for many locations at once.
+
+    The locations are either points with a latitude and longitude, or grid IDs. Locations
+    outside the region or without a grid cell on land are reported with a message.
+
+    :param points: a list of dicts with latitude and longitude
+    :param idgrids: a list of grid IDs, only used if no points are given
+    :param startdate: the first day (yyyy-mm-dd)
+    :param enddate: the last day (yyyy-mm-dd)
+    :return: a DotMap with startdate, enddate, latest_day, ledger_version and locations: a list
+        with for each location a dict with the location (its index in the request), idgrid and
+        location_info, or location and message when no grid cell was found.
+    """
+    if not points and not idgrids:
+        raise RuntimeError("No points or idgrids given")
+    nlocations = len(points) if points else len(idgrids)
+    if nlocations > config.server.max_bulk_locations:
+        msg = f"Too many locations ({nlocations}), at most {config.server.max_bulk_locations} are allowed"
+        raise RuntimeError(msg)
+
+    server_engine = get_server_engine()
+    index = server_engine.grid_index
+    startdate, enddate, latest_day, ledger_version = request_date_range(startdate, enddate)
+    grid = get_region_grid_definition()
+
+    if points:
+        try:
+            latitudes = np.array([float(p["latitude"]) for p in points])
+            longitudes = np.array([float(p["longitude"]) for p in points])
+        except (KeyError, TypeError, ValueError):
+            raise RuntimeError("Each point should have a numeric latitude and longitude")
+        bbox = config.region.boundingbox
+        in_bbox = (latitudes >= bbox.lat_min) & (latitudes <= bbox.lat_max) & \
+                  (longitudes >= bbox.lon_min) & (longitudes <= bbox.lon_max)
+        positions = np.full(nlocations, -1, dtype=np.int64)
+        positions[in_bbox] = index.lookup(latitudes[in_bbox], longitudes[in_bbox], config.misc.grid_search_radius)
+    else:
+        in_bbox = np.ones(nlocations, dtype=bool)
+        positions = index.positions_of(idgrids)
+
+    locations = []
+    for i, position in enumerate(positions):
+        if not in_bbox[i]:
+            locations.append(dict(location=i, message="Location not in boundingbox of region!"))
+            continue
+        if position < 0:
+            locations.append(dict(location=i, message="No land grid at this location or outside region definition!"))
+            continue
+        idgrid = int(index.idgrid[position])
+        properties = grid.properties(idgrid)
+        if points:
+            location_info = {"input_latitude": float(latitudes[i]), "input_longitude": float(longitudes[i])}
+        else:
+            location_info = {"input_idgrid": idgrid}
+        location_info.update({"grid_agera5_latitude": properties.latitude,
+                              "grid_agera5_longitude": properties.longitude,
+                              "grid_agera5_elevation": properties.elevation,
+                              "region_name": config.region.name})
+        locations.append(dict(location=i, idgrid=idgrid, location_info=location_info))
+
+    return DotMap(startdate=startdate, enddate=enddate, latest_day=latest_day, ledger_version=ledger_version,
+                  locations=locations, _dynamic=False)
+
+
+def iter_agera5_groups(idgrids, startdate, enddate, batch_size=1000):
+    """Retrieves the meteo data for many grid cells with a single query and groups the rows
+    by grid cell.
+
+    :return: a tuple with the list of column names and an iterator over tuples (idgrid, rows)
+    """
+    batches = get_server_engine().stream_weather_bulk(idgrids, startdate, enddate, batch_size)
+    columns = next(batches)
+    i_idgrid = columns.index("idgrid")
+
+    def groups():
+        current, group_rows = None, []
+        for rows in batches:
+            for row in rows:
+                if row[i_idgrid] != current:
+                    if group_rows:
+                        yield current, group_rows
+                    current, group_rows = row[i_idgrid], []
+                group_rows.append(row)
+        if group_rows:
+            yield current, group_rows
+
+    return columns, groups()
+
+
+def locate_agera5_area(lon_min, lon_max, lat_min, lat_max, day=None, startdate=None, enddate=None):
+    """Checks the bounding box and date range of a request for an area.
+
+    The number of rows is estimated from the number of grid cells in the bounding box and the
+    number of days, requests with more than `server.max_area_rows` rows are refused.
+
+    :param day: a single day (yyyy-mm-dd), replaces startdate and enddate when given
+    :return: a DotMap with bbox, startdate, enddate, latest_day, ledger_version and the number of
+        grid cells
+    """
+    if lon_min >= lon_max or lat_min >= lat_max:
+        raise RuntimeError("The minimum longitude/latitude should be smaller than the maximum longitude/latitude")
+    if day is not None:
+        startdate = enddate = day
+        check_date(day)
+    startdate, enddate, latest_day, ledger_version = request_date_range(startdate, enddate)
+    if enddate < startdate:
+        raise RuntimeError("The end date should not be before the start date")
+
+    index = get_server_engine().grid_index
+    ncells = int(((index.latitude >= lat_min) & (index.latitude <= lat_max) &
+                  (index.longitude >= lon_min) & (index.longitude <= lon_max)).sum())
+    if ncells == 0:
+        raise RuntimeError("No land grid cells within the bounding box")
+    nrows = ncells * ((enddate - startdate).days + 1)
+    if nrows > config.server.max_area_rows:
+        msg = f"Request for {ncells} grid cells and {(enddate - startdate).days + 1} days exceeds the " \
+              f"maximum of {config.server.max_area_rows} rows, reduce the bounding box or the date range"
+        raise RuntimeError(msg)
+    bbox = BoundingBox(lon_min=lon_min, lon_max=lon_max, lat_min=lat_min, lat_max=lat_max)
+    return DotMap(bbox=bbox, startdate=startdate, enddate=enddate, latest_day=latest_day,
+                  ledger_version=ledger_version, ncells=ncells, _dynamic=False)
+
+
+def stream_agera5_area_rows(area):
+    """Retrieves the meteo data for an area found by `locate_agera5_area()` in batches of rows.
+
+    :return: a tuple with the list of column names and an iterator over lists of rows
+    """
+    batches = get_server_engine().stream_weather_area(area.bbox, area.startdate, area.enddate)
+    columns = next(batches)
+    first_batch = next(batches, None)
+    if first_batch is None:
+        raise RuntimeError("No AgERA5 data found for this area and/or date range")
+    return columns, itertools.chain([first_batch], batches)
+
 
+def get_agera5(latitude, longitude, startdate=None, enddate=None, variables=None, aggregate=None):
+    location = locate_agera5(latitude, longitude, startdate, enddate, variables, aggregate)
     return_value = {
-        "location_info": {
-            "input_latitude": latitude,
-            "input_longitude": longitude,
-            "grid_agera5_latitude": grid_agera5_properties.latitude,
-            "grid_agera5_longitude": grid_agera5_properties.longitude,
-            "grid_agera5_elevation": grid_agera5_properties.elevation,
-            "region_name": config.region.name,
-        },
-        "weather_variables": df_AgERA5.to_dict(orient="records"),
+        "location_info": location.location_info,
+        "weather_variables": fetch_agera5_records(location),
         "info": "data retrieval successful"
     }
     return return_value
@@ -7,12 +7,28 @@ import xarray as xr
 import click
 
 from .util import create_agera5_fnames, add_grid
-from .build import modify_dataframe
+from .build import dataset_to_table
+from .compact import open_zarr_dataset
 from . import config
 
 CMD_MODE = True if os.environ["CMD_MODE"] == "1" else False
 
 
+def open_agera5_dataset(day, variables):
+    """Opens the AgERA5 variables for the given day from the Zarr store when available, or
+    otherwise from the NetCDF files.
+
+    :param day: the date to open
+    :param variables: the names of the AgERA5 variables
+    :return: an xarray dataset
+    """
+    ds = open_zarr_dataset(day, day, variables)
+    if ds is None:
+        fnames = create_agera5_fnames(config.data_storage.netcdf_path, variables, day)
+        ds = xr.open_mfdataset(fnames)
+    return ds
+
+
 def dump(day, bbox, add_gridid=False):
     """Converts the data for all AgERA5 variables for given day to a pandas dataframe.
 
@@ -31,14 +47,9 @@ def dump(day, bbox, add_gridid=False):
             raise RuntimeError(msg)
 
     selected_variables = [varname for varname, selected in config.variables.items() if selected]
-    fnames = create_agera5_fnames(config.data_storage.netcdf_path, selected_variables, day)
-    ds = xr.open_mfdataset(fnames)
+    ds = open_agera5_dataset(day, selected_variables)
     ds = ds.sel(lon=slice(bbox.lon_min, bbox.lon_max), lat=slice(bbox.lat_max, bbox.lat_min))
-
-    if add_gridid:
-        ds = add_grid(ds)
-    df = ds.to_dataframe()
-    df = modify_dataframe(df)
+    df = dataset_to_table(ds, add_gridid).to_pandas()
 
     return df
 
@@ -61,8 +72,7 @@ def clip(day, bbox, add_gridid=False):
             raise RuntimeError(msg)
 
     selected_variables = [varname for varname, selected in config.variables.items() if selected]
-    fnames = create_agera5_fnames(config.data_storage.netcdf_path, selected_variables, day)
-    ds = xr.open_mfdataset(fnames)
+    ds = open_agera5_dataset(day, selected_variables)
     if add_gridid:
         ds = add_grid(ds)
     ds_clip = ds.sel(lon=slice(bbox.lon_min, bbox.lon_max), lat=slice(bbox.lat_max, bbox.lat_min))
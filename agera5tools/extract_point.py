@@ -2,14 +2,164 @@
 # Copyright (c) May 2021, Wageningen Environmental Research
 # Allard de Wit (allard.dewit@wur.nl)
 import sys, os
-import xarray as xr
+import json
+import logging
+import concurrent.futures
+from pathlib import Path
+
+import numpy as np
 import pandas as pd
+import xarray as xr
+import netCDF4
 
 CMD_MODE = True if os.environ["CMD_MODE"] == "1" else False
-from .util import create_target_fname, convert_to_celsius
+from .util import create_target_fname, convert_to_celsius, chunker
+from .compact import open_zarr_dataset
+from .grid import get_grid_index
 from . import config
 
 
+def find_nearest_cells(nc_fname, latitudes, longitudes):
+    """Finds the indices of the grid cells nearest to the points in a NetCDF file of the archive.
+
+    All files in the archive are on the same grid, so the indices apply to all files.
+
+    :param nc_fname: the path to a NetCDF file of the archive
+    :param latitudes: an array with the latitudes of the points
+    :param longitudes: an array with the longitudes of the points
+    :return: a tuple (ilat, ilon) with arrays of indices along the lat and lon dimensions
+    """
+    with netCDF4.Dataset(nc_fname) as ds:
+        lat, lon = pd.Index(ds.variables["lat"][:]), pd.Index(ds.variables["lon"][:])
+    # Same lookup as xarray's .sel(method="nearest")
+    ilat = lat.get_indexer(np.asarray(latitudes, dtype=float), method="nearest")
+    ilon = lon.get_indexer(np.asarray(longitudes, dtype=float), method="nearest")
+    return ilat, ilon
+
+
+def read_cell_values(nc_fnames, varname, ilat, ilon):
+    """Reads the values of the given grid cells from each NetCDF file.
+
+    Only the window of the variable spanning the grid cells is read from each file, the grid
+    cells are then gathered from the window by fancy indexing.
+
+    :param nc_fnames: a list of NetCDF files with one day of data each
+    :param varname: the name of the AgERA5 variable
+    :param ilat: an array of indices along the lat dimension
+    :param ilon: an array of indices along the lon dimension
+    :return: a NumPy array of shape (files, cells) with the values, missing values are NaN
+    """
+    lat0, lat1 = ilat.min(), ilat.max() + 1
+    lon0, lon1 = ilon.min(), ilon.max() + 1
+    values = np.empty((len(nc_fnames), len(ilat)), dtype=np.float32)
+    for i, nc_fname in enumerate(nc_fnames):
+        with netCDF4.Dataset(nc_fname) as ds:
+            v = ds.variables[varname] if varname in ds.variables else \
+                next(v for v in ds.variables.values() if v.ndim == 3)
+            window = np.ma.filled(np.ma.asarray(v[0, lat0:lat1, lon0:lon1], dtype=np.float32), np.nan)
+            values[i] = window[ilat - lat0, ilon - lon0]
+    return values
+
+
+def read_points_from_netcdf(latitudes, longitudes, days, variables, workers=None, files_per_task=100):
+    """Reads the time series for the grid cells nearest to the points from the NetCDF archive.
+
+    The grid cells are located once, after which each file is read once and the values for all
+    grid cells are stored into preallocated arrays. The files are read in parallel by a pool of
+    processes, the HDF5 library used for reading NetCDF files is not thread-safe.
+
+    :param latitudes: an array with the latitudes of the points
+    :param longitudes: an array with the longitudes of the points
+    :param days: a DatetimeIndex with the days to read
+    :param variables: the names of the AgERA5 variables
+    :param workers: the number of processes for reading, defaults to the number of CPUs (max 8)
+    :param files_per_task: the number of files read by a process in one task
+    :return: a dict with for each variable an array of shape (days, points)
+    """
+    nc_fnames = {v: [create_target_fname(v, day, agera5_dir=config.data_storage.netcdf_path,
+                                         version=config.misc.agera5_version) for day in days]
+                 for v in variables}
+    ilat, ilon = find_nearest_cells(nc_fnames[variables[0]][0], latitudes, longitudes)
+    columns = {v: np.empty((len(days), len(ilat)), dtype=np.float32) for v in variables}
+    tasks = [(v, r) for v in variables for r in chunker(range(len(days)), files_per_task)]
+
+    workers = min(workers or os.cpu_count() or 1, 8, len(tasks))
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(read_cell_values, [nc_fnames[v][r.start:r.stop] for v, r in tasks],
+                                   [v for v, _ in tasks], [ilat] * len(tasks), [ilon] * len(tasks))
+            for (v, r), values in zip(tasks, results):
+                columns[v][r.start:r.stop] = values
+    else:
+        for v, r in tasks:
+            columns[v][r.start:r.stop] = read_cell_values(nc_fnames[v][r.start:r.stop], v, ilat, ilon)
+
+    return columns
+
+
+def snap_to_land(latitudes, longitudes):
+    """Moves points of which the nearest grid cell is not on land to the nearest land cell.
+
+    Points are only moved to land cells within `misc.grid_search_radius`, other points are
+    left as they are and will have no data.
+
+    :param latitudes: an array with the latitudes of the points
+    :param longitudes: an array with the longitudes of the points
+    :return: a tuple with arrays of latitudes and longitudes
+    """
+    logger = logging.getLogger(__name__)
+    latitudes = np.array(latitudes, dtype=float)
+    longitudes = np.array(longitudes, dtype=float)
+    index = get_grid_index()
+    # The archive is read at the grid coordinate nearest to a point, grid coordinates refer
+    # to the lower left corner while the index holds the centres of the grid cells.
+    half = index.resolution / 2
+    no_land = np.flatnonzero(index.locate(latitudes + half, longitudes + half) < 0)
+    if len(no_land) == 0:
+        return latitudes, longitudes
+
+    positions = index.nearest_land(latitudes[no_land], longitudes[no_land], config.misc.grid_search_radius)
+    found = positions >= 0
+    latitudes[no_land[found]] = index.latitude[positions[found]] - half
+    longitudes[no_land[found]] = index.longitude[positions[found]] - half
+    logger.info(f"Moved {found.sum()} out of {len(no_land)} points not on land to the nearest land cell.")
+    return latitudes, longitudes
+
+
+def read_points_data(latitudes, longitudes, startday, endday, variables):
+    """Reads the time series for the grid cells nearest to the points from the Zarr store, when
+    it covers the date range, or otherwise from the NetCDF archive.
+
+    Points that are not on land (e.g. over water) are moved to the nearest land cell first,
+    see `snap_to_land()`.
+
+    :return: a tuple with a DatetimeIndex of the days and a dict with for each variable an
+        array of shape (days, points)
+    """
+    latitudes, longitudes = snap_to_land(latitudes, longitudes)
+    ds = open_zarr_dataset(startday, endday, variables)
+    if ds is not None:
+        pnt_data = ds.sel(lat=xr.DataArray(np.asarray(latitudes, dtype=float), dims="point"),
+                          lon=xr.DataArray(np.asarray(longitudes, dtype=float), dims="point"),
+                          method="nearest").load()
+        return pd.DatetimeIndex(pnt_data.time.values), \
+            {v: pnt_data[v].transpose("time", "point").values for v in variables}
+
+    days = pd.date_range(startday, endday)
+    # Small requests are not worth starting processes for
+    workers = 1 if len(days) * len(variables) < 1000 else None
+    return days, read_points_from_netcdf(latitudes, longitudes, days, variables, workers=workers)
+
+
+def read_point_data(point, startday, endday, variables):
+    """Reads the time series for the grid cell nearest to the point.
+
+    :return: a dataframe with a time index and a column for each variable
+    """
+    days, columns = read_points_data([point.latitude], [point.longitude], startday, endday, variables)
+    return pd.DataFrame({v: values[:, 0] for v, values in columns.items()}, index=pd.Index(days, name="time"))
+
+
 def extract_point(point, startday, endday):
     """Extracts data for given point and variable names over the give date range
 
@@ -19,37 +169,116 @@ def extract_point(point, startday, endday):
     :return: a dataframe with AgERA5 meteo variables
     """
     selected_variables = [varname for varname, selected in config.variables.items() if selected]
-    df_final = pd.DataFrame()
-    for day in pd.date_range(startday, endday):
-        fnames = [create_target_fname(v, day,
-                                      agera5_dir=config.data_storage.netcdf_path,
-                                      version=config.misc.agera5_version)
-                  for v in selected_variables]
-        ds = xr.open_mfdataset(fnames)
-        pnt_data = ds.sel(lon=point.longitude, lat=point.latitude, method="nearest")
-        df = pnt_data.to_dataframe()
-        ix = ~df.isna().any(axis=1)
-        if not any(ix):
-            print(f"No data for given lon/lat ({point.longitude:7.2f}/{point.latitude:7.2f}),"
-                  f" probably over water...")
-            if CMD_MODE:
-                sys.exit()
-            else:
-                return None
-        df_final = pd.concat([df_final, df[ix]])
+    df_final = read_point_data(point, startday, endday, selected_variables)
+    ix = ~df_final.isna().any(axis=1)
+    if not any(ix):
+        print(f"No data for given lon/lat ({point.longitude:7.2f}/{point.latitude:7.2f}), no land"
+              f" within {config.misc.grid_search_radius} degrees...")
+        if CMD_MODE:
+            sys.exit()
+        else:
+            return None
+    df_final = df_final[ix]
 
     rename_cols = {c:c.lower() for c in df_final.columns}
     rename_cols.update({"time": "day"})
     df_final = (df_final.reset_index()
-                        .drop(columns=["lat", "lon"])
                         .rename(columns=rename_cols)
                 )
     # convert to simple date
     df_final['day'] = df_final.day.dt.date
-    if "solar_radiation_flux" in df_final.columns:
-        df_final["solar_radiation_flux"] = df_final.solar_radiation_flux.astype(int)
+
+    return convert_units(df_final)
+
+
+def convert_units(df):
+    """Converts solar radiation to integer and temperatures to degrees C if configured.
+    """
+    if "solar_radiation_flux" in df.columns:
+        df["solar_radiation_flux"] = df.solar_radiation_flux.astype(int)
 
     if config.misc.kelvin_to_celsius:
-        df_final = convert_to_celsius(df_final)
+        df = convert_to_celsius(df)
+
+    return df
+
+
+def read_sites(fname):
+    """Reads the sites for `extract_points()` from a CSV or GeoJSON file.
+
+    A CSV file should have columns with the latitude ("latitude" or "lat") and longitude
+    ("longitude", "lon") and optionally a site identifier ("site", "id" or "name"). A GeoJSON
+    file should contain Point features, the site identifier is taken from the "site", "id" or
+    "name" properties or the feature id. Sites without identifier are numbered from 1.
+
+    :param fname: the path to a .csv, .json or .geojson file
+    :return: a dataframe with columns site, latitude and longitude
+    """
+    fname = Path(fname)
+    if fname.suffix.lower() in (".json", ".geojson"):
+        with open(fname) as fp:
+            features = json.load(fp)["features"]
+        records = []
+        for i, feature in enumerate(features, start=1):
+            if feature["geometry"]["type"] != "Point":
+                raise RuntimeError(f"Only Point features are supported, found {feature['geometry']['type']}")
+            longitude, latitude = feature["geometry"]["coordinates"][:2]
+            props = feature.get("properties") or {}
+            site = next((props[k] for k in ("site", "id", "name") if k in props), feature.get("id", i))
+            records.append(dict(site=site, latitude=latitude, longitude=longitude))
+        return pd.DataFrame(records, columns=["site", "latitude", "longitude"])
+
+    df = pd.read_csv(fname)
+    columns = {c.lower(): c for c in df.columns}
+
+    def find_column(names):
+        return next((columns[n] for n in names if n in columns), None)
+
+    lat_col, lon_col = find_column(["latitude", "lat"]), find_column(["longitude", "lon"])
+    site_col = find_column(["site", "id", "name"])
+    if lat_col is None or lon_col is None:
+        raise RuntimeError(f"No latitude/longitude columns found in {fname}")
+    sites = df[site_col] if site_col is not None else pd.Series(range(1, len(df) + 1))
+    return pd.DataFrame({"site": sites.values, "latitude": df[lat_col].values, "longitude": df[lon_col].values})
+
+
+def extract_points(sites, startday, endday):
+    """Extracts data for many sites over the given date range.
+
+    Each NetCDF file is read only once for all sites, so the time for extraction depends on the
+    number of days and variables and hardly on the number of sites. Sites over water are moved
+    to the nearest land cell, sites outside the region and sites without data are left out.
+
+    :param sites: a dataframe with columns site, latitude and longitude, see `read_sites()`
+    :param startday: the start date
+    :param endday: the end date
+    :return: a dataframe in long format with columns site, day and the AgERA5 variables, sorted
+        by site and day
+    """
+    logger = logging.getLogger(__name__)
+    bbox = config.region.boundingbox
+    in_bbox = (sites.longitude >= bbox.lon_min) & (sites.longitude <= bbox.lon_max) & \
+              (sites.latitude >= bbox.lat_min) & (sites.latitude <= bbox.lat_max)
+    if not in_bbox.all():
+        logger.warning(f"Sites outside the boundingbox of this setup are skipped: {list(sites.site[~in_bbox])}")
+        sites = sites[in_bbox]
+    if len(sites) == 0:
+        raise RuntimeError("None of the sites is within the boundingbox of this setup")
+
+    selected_variables = [varname for varname, selected in config.variables.items() if selected]
+    days, columns = read_points_data(sites.latitude.values, sites.longitude.values, startday, endday,
+                                     selected_variables)
+    nsites, ndays = len(sites), len(days)
+    df = pd.DataFrame({"site": np.repeat(sites.site.values, ndays),
+                       "day": np.tile(days.date, nsites)})
+    for varname in selected_variables:
+        df[varname.lower()] = columns[varname].T.ravel()
+
+    ix = ~df.isna().any(axis=1)
+    no_data = set(sites.site.values) - set(df.site[ix])
+    if no_data:
+        logger.warning(f"No data for sites {sorted(no_data, key=str)}, no land within "
+                       f"{config.misc.grid_search_radius} degrees...")
+    df = df[ix].reset_index(drop=True)
 
-    return df_final
+    return convert_units(df)
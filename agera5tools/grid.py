@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) October 2026, Wageningen Environmental Research
+# Allard de Wit (allard.dewit@wur.nl)
+"""Tools for using the AgERA5 grid definition that is embedded in the agera5tools package.
+"""
+import logging
+from pathlib import Path
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from dotmap import DotMap
+
+from . import config
+
+agera5_grid_fname = Path(__file__).parent / "grid_elevation_landfraction.nc"
+
+
+def coordinate_keys(values):
+    """Converts coordinates in decimal degrees into integer keys (1/100 degree) for exact matching.
+
+    :param values: an array of longitudes or latitudes
+    :return: an array of integer keys
+    """
+    return np.round(np.asarray(values, dtype=np.float64) * 100).astype(np.int64)
+
+
+class GridDefinition:
+    """The AgERA5 grid definition held in memory.
+
+    The grid ID, elevation and land fraction are exposed as NumPy arrays with dimensions
+    (lat, lon). Coordinates refer to the lower left corner of each grid cell.
+
+    :param ds: an xarray dataset with the variables idgrid_era5, elevation and land_fraction
+    """
+
+    def __init__(self, ds):
+        ds = ds.transpose("lat", "lon").load()
+        self.ds = ds
+        self.lat = ds.lat.values
+        self.lon = ds.lon.values
+        self.idgrid = ds.idgrid_era5.values
+        self.elevation = ds.elevation.values
+        self.land_fraction = ds.land_fraction.values
+        self._idgrid_order = None
+
+    @classmethod
+    def from_file(cls, bbox=None, margin=0.):
+        """Reads the grid definition embedded in agera5tools, optionally only for a bounding box.
+
+        :param bbox: a BoundingBox object or None to read the global grid
+        :param margin: extra margin (dd) around the boundingbox
+        :return: a GridDefinition
+        """
+        with xr.open_dataset(agera5_grid_fname) as ds:
+            if bbox is not None:
+                ix_lat = ((ds.lat >= bbox.lat_min - margin) & (ds.lat <= bbox.lat_max + margin)).values
+                ix_lon = ((ds.lon >= bbox.lon_min - margin) & (ds.lon <= bbox.lon_max + margin)).values
+                ds = ds.isel(lat=ix_lat, lon=ix_lon)
+            return cls(ds)
+
+    @property
+    def is_land(self):
+        """Boolean array indicating grid cells with land and a valid grid ID.
+        """
+        return (self.land_fraction > 0) & (self.idgrid != -999)
+
+    def covers(self, lat, lon):
+        """Returns True if the given latitudes and longitudes are all within the grid.
+        """
+        return (np.isin(coordinate_keys(lat), coordinate_keys(self.lat)).all() and
+                np.isin(coordinate_keys(lon), coordinate_keys(self.lon)).all())
+
+    def to_dataframe(self, bbox=None):
+        """Returns the land cells of the grid as a dataframe.
+
+        :param bbox: a BoundingBox, if given only grid cells with their centre within the bbox are returned
+        :return: a dataframe with the columns ll_latitude, ll_longitude, idgrid_era5, elevation,
+            land_fraction, latitude and longitude.
+        """
+        ilat, ilon = np.nonzero(self.is_land)
+        df = pd.DataFrame({"ll_latitude": self.lat[ilat],
+                           "ll_longitude": self.lon[ilon],
+                           "idgrid_era5": self.idgrid[ilat, ilon],
+                           "elevation": self.elevation[ilat, ilon],
+                           "land_fraction": self.land_fraction[ilat, ilon]})
+        # compute grid centre instead of lower left
+        df["latitude"] = df.ll_latitude + 0.05
+        df["longitude"] = df.ll_longitude + 0.05
+        if bbox is not None:
+            ix = ((df.latitude >= bbox.lat_min) & (df.latitude <= bbox.lat_max) &
+                  (df.longitude >= bbox.lon_min) & (df.longitude <= bbox.lon_max))
+            df = df[ix].reset_index(drop=True)
+        return df
+
+    def properties(self, idgrid):
+        """Returns the latitude, longitude (grid centre) and elevation for the given grid ID.
+
+        :param idgrid: the grid ID
+        :return: a DotMap with latitude, longitude and elevation
+        """
+        if self._idgrid_order is None:
+            self._idgrid_order = np.argsort(self.idgrid, axis=None)
+        flat_idgrid = self.idgrid.ravel()
+        pos = np.searchsorted(flat_idgrid, idgrid, sorter=self._idgrid_order)
+        if pos >= len(flat_idgrid) or flat_idgrid[self._idgrid_order[pos]] != idgrid:
+            msg = "No land grid at this location or outside region definition!"
+            raise RuntimeError(msg)
+        ilat, ilon = np.unravel_index(self._idgrid_order[pos], self.idgrid.shape)
+        return DotMap(latitude=round(float(self.lat[ilat]) + 0.05, 2),
+                      longitude=round(float(self.lon[ilon]) + 0.05, 2),
+                      elevation=float(self.elevation[ilat, ilon]))
+
+
+@lru_cache(maxsize=None)
+def get_grid_definition():
+    """Returns the global AgERA5 grid definition, it is read only once per process.
+
+    :return: a GridDefinition
+    """
+    return GridDefinition.from_file()
+
+
+@lru_cache(maxsize=None)
+def get_region_grid_definition():
+    """Returns the AgERA5 grid definition for the region in the configuration, it is
+    read only once per process.
+
+    A small margin is added around the boundingbox to include the cells at the edges
+    of the AgERA5 data downloaded for the region.
+
+    :return: a GridDefinition
+    """
+    return GridDefinition.from_file(config.region.boundingbox, margin=0.2)
+
+
+class LandCellIndex:
+    """An index of the land cells of the AgERA5 grid within a bounding box.
+
+    The index stores the grid coordinates around the bounding box together with the positions
+    and grid IDs of the cells that are on land (land_fraction > 0 and a valid grid ID). It is used
+    to gather only the land cells from the AgERA5 variables instead of flattening the full
+    lat/lon rectangle and filtering afterwards.
+
+    :param lat: the latitudes of the rows of the grid
+    :param lon: the longitudes of the columns of the grid
+    :param ilat: the row position of each land cell
+    :param ilon: the column position of each land cell
+    :param idgrid: the grid ID of each land cell
+    """
+
+    def __init__(self, lat, lon, ilat, ilon, idgrid):
+        self.lat = np.asarray(lat)
+        self.lon = np.asarray(lon)
+        self.ilat = np.asarray(ilat)
+        self.ilon = np.asarray(ilon)
+        self.idgrid = np.asarray(idgrid)
+
+    def __len__(self):
+        return len(self.idgrid)
+
+    @classmethod
+    def from_grid(cls, grid):
+        """Builds the index from a grid definition.
+
+        :param grid: a GridDefinition
+        :return: a LandCellIndex
+        """
+        ilat, ilon = np.nonzero(grid.is_land)
+        return cls(grid.lat, grid.lon, ilat, ilon, grid.idgrid[ilat, ilon].astype(np.int64))
+
+    @classmethod
+    def load(cls, fname):
+        """Loads the index from a .npz file.
+        """
+        with np.load(fname) as data:
+            return cls(data["lat"], data["lon"], data["ilat"], data["ilon"], data["idgrid"])
+
+    def save(self, fname):
+        """Saves the index to a .npz file, writing to a temporary file first to avoid partial files.
+        """
+        fname = Path(fname)
+        fname_tmp = fname.with_name(fname.name + ".tmp.npz")
+        np.savez(fname_tmp, lat=self.lat, lon=self.lon, ilat=self.ilat, ilon=self.ilon, idgrid=self.idgrid)
+        fname_tmp.replace(fname)
+
+    def gather_positions(self, lat, lon):
+        """Finds the land cells in a raster with the given latitudes and longitudes.
+
+        :param lat: the latitudes of the rows of the raster
+        :param lon: the longitudes of the columns of the raster
+        :return: a tuple with the positions of the land cells in the flattened (lat, lon) raster
+            and their grid IDs, both ordered by position.
+        """
+        rows = self._map_coordinates(self.lat, lat)[self.ilat]
+        cols = self._map_coordinates(self.lon, lon)[self.ilon]
+        in_raster = (rows >= 0) & (cols >= 0)
+        positions = rows[in_raster] * len(lon) + cols[in_raster]
+        idgrid = self.idgrid[in_raster]
+        order = np.argsort(positions)
+        return positions[order], idgrid[order]
+
+    @staticmethod
+    def _map_coordinates(index_coords, raster_coords):
+        """Returns for each index coordinate its position in raster_coords, or -1 if not present.
+        """
+        index_keys = coordinate_keys(index_coords)
+        raster_keys = coordinate_keys(raster_coords)
+        order = np.argsort(raster_keys)
+        pos = np.searchsorted(raster_keys, index_keys, sorter=order)
+        pos = np.clip(pos, 0, len(raster_keys) - 1)
+        found = raster_keys[order[pos]] == index_keys
+        return np.where(found, order[pos], -1)
+
+
+def landcell_index_fname(bbox):
+    """Returns the name of the file caching the land cell index for the boundingbox.
+
+    The file is stored next to the NetCDF archive.
+    """
+    bbox_str = f"{bbox.lon_min}_{bbox.lon_max}_{bbox.lat_min}_{bbox.lat_max}"
+    return config.data_storage.netcdf_path / f"landcell_index_{bbox_str}.npz"
+
+
+@lru_cache(maxsize=None)
+def get_landcell_index():
+    """Returns the land cell index for the region defined in the configuration.
+
+    The index is computed once and cached on disk next to the NetCDF archive. The cached
+    file is rebuilt when the grid definition is newer than the cache.
+
+    :return: a LandCellIndex
+    """
+    logger = logging.getLogger(__name__)
+    bbox = config.region.boundingbox
+    fname = landcell_index_fname(bbox)
+    if fname.exists() and fname.stat().st_mtime >= agera5_grid_fname.stat().st_mtime:
+        try:
+            return LandCellIndex.load(fname)
+        except Exception as e:
+            logger.warning(f"Failed loading land cell index from {fname}, rebuilding it: {e}")
+
+    index = LandCellIndex.from_grid(get_region_grid_definition())
+    try:
+        index.save(fname)
+        logger.info(f"Written land cell index with {len(index)} cells to {fname}")
+    except OSError as e:
+        logger.warning(f"Failed writing land cell index to {fname}: {e}")
+
+    return index
+
+
+def unit_vectors(lat, lon):
+    """Converts latitudes and longitudes into points on the unit sphere.
+
+    Euclidean distances between these points increase with the great circle distance, so
+    they can be used for nearest neighbour searches.
+
+    :return: an array of shape (points, 3)
+    """
+    lat, lon = np.radians(np.asarray(lat, dtype=np.float64)), np.radians(np.asarray(lon, dtype=np.float64))
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+class GridIndex:
+    """An in-memory index for finding the land cell of the AgERA5 grid at a location.
+
+    The land cells are stored on a dense raster spanning the cells, which allows finding
+    the cell nearest to a location by arithmetic on its coordinates. Locations on a cell
+    that is not on land (e.g. over water) can be moved to the nearest land cell within a
+    maximum distance. The nearest land cell is searched with a KD-tree from scipy if it is
+    installed, otherwise by computing the distance to all land cells.
+
+    :param idgrid: the grid ID of each land cell
+    :param latitude: the latitude of the centre of each land cell
+    :param longitude: the longitude of the centre of each land cell
+    :param resolution: the size of the grid cells in decimal degrees
+    """
+
+    def __init__(self, idgrid, latitude, longitude, resolution=0.1):
+        self.idgrid = np.asarray(idgrid, dtype=np.int64)
+        # Coordinates from the database may be stored as single precision
+        self.latitude = coordinate_keys(latitude) / 100
+        self.longitude = coordinate_keys(longitude) / 100
+        self.resolution = resolution
+        self.lat_min = self.latitude.min()
+        self.lon_min = self.longitude.min()
+        rows = np.round((self.latitude - self.lat_min) / resolution).astype(np.int64)
+        cols = np.round((self.longitude - self.lon_min) / resolution).astype(np.int64)
+        self.raster = np.full((rows.max() + 1, cols.max() + 1), -1, dtype=np.int64)
+        self.raster[rows, cols] = np.arange(len(self.idgrid))
+        self._tree = None
+        self._idgrid_order = None
+
+    def __len__(self):
+        return len(self.idgrid)
+
+    @classmethod
+    def from_grid(cls, grid, bbox=None):
+        """Builds the index from the land cells of a grid definition.
+
+        :param grid: a GridDefinition
+        :param bbox: a BoundingBox, if given only grid cells with their lower left corner within
+            the bbox are included. These are the grid cells of the AgERA5 data downloaded for the bbox.
+        :return: a GridIndex
+        """
+        df = grid.to_dataframe()
+        if bbox is not None:
+            eps = 1e-6
+            ix = ((df.ll_latitude >= bbox.lat_min - eps) & (df.ll_latitude <= bbox.lat_max + eps) &
+                  (df.ll_longitude >= bbox.lon_min - eps) & (df.ll_longitude <= bbox.lon_max + eps))
+            df = df[ix]
+        return cls(df.idgrid_era5.values, df.latitude.values, df.longitude.values)
+
+    @classmethod
+    def from_table(cls, engine, grid_table_name):
+        """Builds the index from the grid table in the database.
+
+        :param engine: an SQLAlchemy engine
+        :param grid_table_name: the name of the grid table
+        :return: a GridIndex
+        """
+        with engine.connect() as DBconn:
+            df = pd.read_sql_query(f"SELECT idgrid, latitude, longitude FROM {grid_table_name}", DBconn)
+        if len(df) == 0:
+            msg = f"The grid table '{grid_table_name}' is empty!"
+            raise RuntimeError(msg)
+        return cls(df.idgrid.values, df.latitude.values, df.longitude.values)
+
+    def locate(self, latitudes, longitudes):
+        """Finds the land cells containing the given locations.
+
+        :param latitudes: an array with latitudes
+        :param longitudes: an array with longitudes
+        :return: an array with the position of the land cell for each location in the index,
+            -1 for locations that are not on a land cell.
+        """
+        # Rounding first avoids floating point errors for locations on the boundary between
+        # cells, these are assigned to the cell to the north or east.
+        rows = np.floor(np.round((np.asarray(latitudes, dtype=np.float64) - self.lat_min) / self.resolution, 6) + 0.5)
+        cols = np.floor(np.round((np.asarray(longitudes, dtype=np.float64) - self.lon_min) / self.resolution, 6) + 0.5)
+        inside = (rows >= 0) & (rows < self.raster.shape[0]) & (cols >= 0) & (cols < self.raster.shape[1])
+        positions = np.full(rows.shape, -1, dtype=np.int64)
+        positions[inside] = self.raster[rows[inside].astype(np.int64), cols[inside].astype(np.int64)]
+        return positions
+
+    def nearest_land(self, latitudes, longitudes, max_distance):
+        """Finds the land cells nearest to the given locations.
+
+        :param latitudes: an array with latitudes
+        :param longitudes: an array with longitudes
+        :param max_distance: the maximum distance (dd along a great circle) to the centre of
+            the land cell
+        :return: an array with the position of the nearest land cell for each location in the
+            index, -1 for locations without a land cell within max_distance.
+        """
+        points = unit_vectors(latitudes, longitudes).reshape(-1, 3)
+        max_chord = 2 * np.sin(np.radians(max_distance) / 2)
+        try:
+            from scipy.spatial import cKDTree
+        except ImportError:
+            cKDTree = None
+        if cKDTree is not None:
+            if self._tree is None:
+                self._tree = cKDTree(unit_vectors(self.latitude, self.longitude))
+            distance, positions = self._tree.query(points, distance_upper_bound=max_chord)
+        else:
+            cells = unit_vectors(self.latitude, self.longitude)
+            distance = np.empty(len(points))
+            positions = np.empty(len(points), dtype=np.int64)
+            for i, point in enumerate(points):
+                d = np.sqrt(((cells - point) ** 2).sum(axis=1))
+                positions[i] = d.argmin()
+                distance[i] = d[positions[i]]
+        positions = np.where(distance <= max_chord, positions, -1)
+        return positions.reshape(np.shape(latitudes))
+
+    def lookup(self, latitudes, longitudes, max_distance=None):
+        """Returns the positions of the land cells for the given locations.
+
+        Locations that are not on a land cell are moved to the nearest land cell, when
+        max_distance is given.
+
+        :param latitudes: an array with latitudes
+        :param longitudes: an array with longitudes
+        :param max_distance: the maximum distance (dd) for moving locations to a land cell
+        :return: an array with positions in the index, -1 for locations without land cell
+        """
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        positions = self.locate(latitudes, longitudes)
+        no_land = positions < 0
+        if max_distance is not None and no_land.any():
+            positions[no_land] = self.nearest_land(latitudes[no_land], longitudes[no_land], max_distance)
+        return positions
+
+    def positions_of(self, idgrids):
+        """Returns the positions in the index of the land cells with the given grid IDs.
+
+        :param idgrids: an array with grid IDs
+        :return: an array with positions, -1 for grid IDs that are not in the index
+        """
+        if self._idgrid_order is None:
+            self._idgrid_order = np.argsort(self.idgrid)
+        idgrids = np.asarray(idgrids, dtype=np.int64)
+        pos = np.searchsorted(self.idgrid, idgrids, sorter=self._idgrid_order)
+        pos = np.clip(pos, 0, len(self.idgrid) - 1)
+        positions = self._idgrid_order[pos]
+        return np.where(self.idgrid[positions] == idgrids, positions, -1)
+
+    def find_idgrid(self, longitude, latitude, max_distance=None):
+        """Returns the grid ID of the land cell for a single location, or None.
+        """
+        position = int(self.lookup([latitude], [longitude], max_distance)[0])
+        return None if position < 0 else int(self.idgrid[position])
+
+
+@lru_cache(maxsize=None)
+def get_grid_index():
+    """Returns the GridIndex of the land cells in the AgERA5 data for the region in the
+    configuration, it is built only once per process.
+
+    The cells in the margin of the region grid definition are not included, as they are
+    not part of the downloaded data.
+
+    :return: a GridIndex
+    """
+    return GridIndex.from_grid(get_region_grid_definition(), config.region.boundingbox)
@@ -20,10 +20,13 @@ warnings.filterwarnings("ignore")
 
 import click
 import sqlalchemy as sa
+import pyarrow as pa
 
 from . import config
-from .dump_grid import dump_grid
-from .util import chunker, get_user_home
+from .grid import get_region_grid_definition
+from .bulkload import bulk_insert
+from .ledger import define_ledger_table
+from .util import get_user_home
 
 
 def make_paths():
@@ -115,30 +118,16 @@ def fill_grid_table():
     """
     logger = logging.getLogger(__name__)
 
-    df = dump_grid()
     # Subset grid to only contain relevant region
-    ix = ((df.latitude >= config.region.boundingbox.lat_min) &
-          (df.latitude <= config.region.boundingbox.lat_max) &
-          (df.longitude >= config.region.boundingbox.lon_min) &
-          (df.longitude <= config.region.boundingbox.lon_max))
-    df = df[ix]
+    df = get_region_grid_definition().to_dataframe(config.region.boundingbox)
     df = (df.drop(columns=["ll_latitude", "ll_longitude", "land_fraction"])
             .rename(columns={"idgrid_era5": "idgrid"}))
 
     engine = sa.create_engine(config.database.dsn)
-    meta = sa.MetaData()
-    tbl = sa.Table(config.database.grid_table_name, meta, autoload_with=engine)
-    recs = df.to_dict(orient="records")
-    nrecs_written = 0
     t1 = time.time()
     try:
-        with engine.begin() as DBconn:
-            ins = tbl.insert()
-            for chunk in chunker(recs, config.database.chunk_size):
-                DBconn.execute(ins, chunk)
-                nrecs_written += len(chunk)
-                msg = f"Written {nrecs_written} from total {len(recs)} records to database."
-                logger.info(msg)
+        bulk_insert(engine, config.database.grid_table_name, pa.Table.from_pandas(df, preserve_index=False),
+                    config.database.chunk_size)
         msg = f"Written grid definition to database in {time.time() - t1} seconds."
         logger.info(msg)
     except sa.exc.IntegrityError as e:
@@ -167,6 +156,9 @@ def build_database():
                        sa.Column("latitude", sa.Float),
                        sa.Column("elevation", sa.Float,),
                        )
+
+        # Build table recording the days loaded into the database
+        define_ledger_table(meta)
         click.echo(f"Initializing database at {config.database.dsn}")
         try:
             meta.create_all(engine)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) October 2026, Wageningen Environmental Research
+# Allard de Wit (allard.dewit@wur.nl)
+"""The ingest ledger records which days have been loaded into the AgERA5 database.
+
+For each day the ledger stores the variables and number of records that were loaded, the
+time of loading and the AgERA5 version. A day without a record count (nrows is NULL) was
+being loaded but did not finish. This allows to find missing and incomplete days without
+scanning the table with weather data.
+"""
+import logging
+import datetime as dt
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import sqlalchemy as sa
+import pandas as pd
+
+from . import config
+
+
+def define_ledger_table(meta):
+    """Defines the ledger table on the given SQLAlchemy MetaData object.
+    """
+    return sa.Table(config.database.ledger_table_name, meta,
+                    sa.Column("day", sa.Date, primary_key=True),
+                    sa.Column("variables", sa.String(1000)),
+                    sa.Column("nrows", sa.Integer),
+                    sa.Column("ingest_time", sa.DateTime),
+                    sa.Column("source_version", sa.String(20)),
+                    extend_existing=True)
+
+
+def selected_variables_key():
+    """Returns the set of variables selected in the configuration as stored in the ledger.
+    """
+    return ",".join(sorted(varname.lower() for varname, selected in config.variables.items() if selected))
+
+
+def ledger_records(tbl):
+    """Summarizes a table with AgERA5 data into ledger records, one for each day.
+
+    :param tbl: an Arrow table with AgERA5 data
+    :return: an Arrow table with the columns of the ledger table
+    """
+    counts = tbl.group_by("day").aggregate([("day", "count")])
+    nrecs = counts.num_rows
+    variables = ",".join(sorted(c for c in tbl.column_names if c not in ("day", "idgrid")))
+    return pa.table({"day": counts.column("day"),
+                     "variables": pa.array([variables] * nrecs, pa.string()),
+                     "nrows": pc.cast(counts.column("day_count"), pa.int64()),
+                     "ingest_time": pa.array([dt.datetime.now()] * nrecs, pa.timestamp("us")),
+                     "source_version": pa.array([str(config.misc.agera5_version)] * nrecs, pa.string())})
+
+
+def ledger_mark_started(engine, days):
+    """Adds ledger records without a record count for days that are not yet in the ledger.
+
+    This marks the days as being loaded, until `ledger_mark_finished()` is called.
+    """
+    tbl = define_ledger_table(sa.MetaData())
+    with engine.begin() as DBconn:
+        existing = {r.day for r in DBconn.execute(sa.select(tbl.c.day).where(tbl.c.day.in_(days)))}
+        new = [dict(day=day, variables=None, nrows=None, ingest_time=dt.datetime.now(),
+                    source_version=str(config.misc.agera5_version))
+               for day in days if day not in existing]
+        if new:
+            DBconn.execute(tbl.insert(), new)
+
+
+def ledger_mark_finished(engine, records):
+    """Replaces the ledger records for the days in records.
+
+    :param engine: an SQLAlchemy engine
+    :param records: an Arrow table as returned by `ledger_records()`
+    """
+    tbl = define_ledger_table(sa.MetaData())
+    recs = records.to_pylist()
+    with engine.begin() as DBconn:
+        DBconn.execute(tbl.delete().where(tbl.c.day.in_([r["day"] for r in recs])))
+        DBconn.execute(tbl.insert(), recs)
+
+
+def fetch_ledger(engine):
+    """Returns the ledger as a dataframe.
+    """
+    tbl = define_ledger_table(sa.MetaData())
+    with engine.connect() as DBconn:
+        df = pd.read_sql(sa.select(tbl), DBconn)
+    df["day"] = pd.to_datetime(df.day).dt.date
+    return df
+
+
+def find_ingested_days(engine):
+    """Finds the days in the ledger that were loaded completely and the days that were not
+    loaded completely.
+
+    Only days without a record count are incomplete. A day that was loaded with other
+    variables than selected in the configuration is still complete when the selected
+    variables are a subset of the loaded variables. Otherwise a warning is logged, the
+    day is not loaded again because its data is never removed for a difference in the
+    configuration.
+
+    :param engine: an SQLAlchemy engine
+    :return: a tuple with two sets of date objects: complete days and incomplete days
+    """
+    logger = logging.getLogger(__name__)
+    df = fetch_ledger(engine)
+    complete = df.nrows.notnull()
+    selected = set(selected_variables_key().split(","))
+    lacking = complete & ~df.variables.fillna("").map(lambda v: selected.issubset(v.split(",")))
+    if lacking.any():
+        msg = f"{lacking.sum()} days in the database lack some of the selected variables " \
+              f"({', '.join(sorted(selected))}), re-initialize the database to load these variables."
+        logger.warning(msg)
+    return set(df.day[complete]), set(df.day[~complete])
+
+
+def fetch_latest_ingested_day(engine):
+    """Returns the last day that was loaded completely, or None when the ledger is empty.
+    """
+    tbl = define_ledger_table(sa.MetaData())
+    with engine.connect() as DBconn:
+        latest = DBconn.execute(sa.select(sa.func.max(tbl.c.day)).where(tbl.c.nrows.isnot(None))).scalar()
+    if isinstance(latest, str):
+        latest = dt.date.fromisoformat(latest)
+    return latest
+
+
+def delete_days(engine, days):
+    """Deletes the AgERA5 data and ledger records for the given days.
+    """
+    days = sorted(days)
+    if not days:
+        return
+    meta = sa.MetaData()
+    ledger = define_ledger_table(meta)
+    weather = sa.Table(config.database.agera5_table_name, meta, autoload_with=engine)
+    with engine.begin() as DBconn:
+        DBconn.execute(weather.delete().where(sa.and_(weather.c.day >= days[0], weather.c.day <= days[-1],
+                                                      weather.c.day.in_(days))))
+        DBconn.execute(ledger.delete().where(ledger.c.day.in_(days)))
+
+
+def ensure_ledger(engine):
+    """Creates the ledger table if needed and fills it from the AgERA5 data when it is empty.
+
+    Filling the ledger from existing data (backfilling) is needed for databases that were
+    built before the ledger was introduced. It requires one scan over the AgERA5 table.
+    """
+    meta = sa.MetaData()
+    ledger = define_ledger_table(meta)
+    meta.create_all(engine, tables=[ledger], checkfirst=True)
+    with engine.connect() as DBconn:
+        n = DBconn.execute(sa.select(sa.func.count()).select_from(ledger)).scalar()
+    if n > 0:
+        return
+
+    weather = sa.Table(config.database.agera5_table_name, meta, autoload_with=engine)
+    variables = ",".join(sorted(c.name for c in weather.columns if c.name not in ("day", "idgrid")))
+    sel = sa.select(weather.c.day, sa.literal(variables), sa.func.count(),
+                    sa.literal(dt.datetime.now(), sa.DateTime), sa.literal(str(config.misc.agera5_version)))
+    sel = sel.group_by(weather.c.day)
+    with engine.begin() as DBconn:
+        DBconn.execute(ledger.insert().from_select(["day", "variables", "nrows", "ingest_time", "source_version"], sel))
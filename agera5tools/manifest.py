@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) October 2026, Wageningen Environmental Research
+# Allard de Wit (allard.dewit@wur.nl)
+"""The archive manifest records the NetCDF files available in the AgERA5 archive.
+
+The archive is organised in directories per year and variable. For each directory the
+manifest stores its modification time and the size and modification time of its NetCDF
+files. Optionally, the header of each file is validated by opening it and reading the shape
+of the data variable. Adding, removing or renaming files changes the modification time of a
+directory, therefore only directories that have changed need to be scanned again.
+"""
+import os
+import json
+import logging
+import collections
+import threading
+import concurrent.futures
+from pathlib import Path
+from uuid import uuid4
+
+import netCDF4
+
+from . import config
+
+MANIFEST_VERSION = 1
+
+# The HDF5 library used for reading NetCDF files is not thread-safe, so files are validated
+# one at a time while directories are scanned in parallel.
+netcdf_lock = threading.Lock()
+
+
+def manifest_fname():
+    """Returns the path to the manifest file of the NetCDF archive.
+    """
+    return config.data_storage.netcdf_path / "archive_manifest.json"
+
+
+def validate_ncfile(fname):
+    """Validates a NetCDF file by opening it and reading the shape of its data variable.
+
+    Truncated or otherwise damaged files usually fail to open because the HDF5 library checks
+    the file size against the end of file address in the header.
+
+    :param fname: the path to the NetCDF file
+    :return: a tuple (shape, error) with the shape of the data variable as a list and None
+        for valid files, or None and an error message for invalid files.
+    """
+    try:
+        with netcdf_lock, netCDF4.Dataset(fname) as ds:
+            data_vars = [v for v in ds.variables.values() if v.ndim == 3]
+            if len(data_vars) != 1:
+                return None, f"expected one variable with dimensions (time, lat, lon), found {len(data_vars)}"
+            shape = list(data_vars[0].shape)
+    except Exception as e:
+        return None, str(e)
+    if shape[0] != 1 or 0 in shape:
+        return shape, f"unexpected shape {shape} of data variable"
+    return shape, None
+
+
+def scan_directory(dir_path, previous=None, validate=False):
+    """Scans a directory of the archive for NetCDF files.
+
+    Entries of files that did not change since the previous scan are kept, including the
+    result of their validation. Therefore, files are validated only once.
+
+    :param dir_path: the path to the directory
+    :param previous: the manifest entry of the directory from the previous scan, or None
+    :param validate: validate files that have not been validated yet
+    :return: the manifest entry for the directory
+    """
+    previous_files = {} if previous is None else previous["files"]
+    entry = dict(mtime_ns=os.stat(dir_path).st_mtime_ns, files={})
+    with os.scandir(dir_path) as it:
+        for dir_entry in it:
+            if not dir_entry.name.endswith(".nc") or not dir_entry.is_file():
+                continue
+            st = dir_entry.stat()
+            rec = previous_files.get(dir_entry.name)
+            if rec is None or rec["size"] != st.st_size or rec["mtime_ns"] != st.st_mtime_ns:
+                rec = dict(size=st.st_size, mtime_ns=st.st_mtime_ns, validated=False, shape=None, error=None)
+            if validate and not rec["validated"]:
+                shape, error = validate_ncfile(dir_entry.path)
+                rec = dict(rec, validated=True, shape=shape, error=error)
+            entry["files"][dir_entry.name] = rec
+
+    return entry
+
+
+class ArchiveManifest:
+    """The manifest of the NetCDF archive, persisted to a JSON file.
+
+    The manifest is keyed on the directories relative to the archive root, e.g.
+    "2022/Precipitation-Flux", and the names of the files in these directories.
+
+    :param archive_path: the root of the NetCDF archive
+    :param fname: the path to the JSON file, if None the manifest is not persisted
+    """
+
+    def __init__(self, archive_path, fname=None):
+        self.archive_path = Path(archive_path)
+        self.fname = None if fname is None else Path(fname)
+        self.directories = {}
+        if self.fname is not None and self.fname.exists():
+            try:
+                with open(self.fname) as fp:
+                    r = json.load(fp)
+                if r.get("version") == MANIFEST_VERSION:
+                    self.directories = r["directories"]
+            except (OSError, ValueError, KeyError) as e:
+                logger = logging.getLogger(__name__)
+                logger.warning(f"Failed reading archive manifest from {self.fname}, rebuilding it: {e}")
+
+    def save(self):
+        """Writes the manifest to a temporary file first which is then renamed.
+        """
+        if self.fname is None:
+            return
+        fname_tmp = self.fname.with_name(f"{self.fname.name}.{uuid4()}.tmp")
+        with open(fname_tmp, "w") as fp:
+            json.dump(dict(version=MANIFEST_VERSION, directories=self.directories), fp)
+        fname_tmp.replace(self.fname)
+
+    def _needs_scan(self, key, validate):
+        previous = self.directories.get(key)
+        if previous is None:
+            return True
+        try:
+            mtime_ns = os.stat(self.archive_path / key).st_mtime_ns
+        except FileNotFoundError:
+            return True
+        if mtime_ns != previous["mtime_ns"]:
+            return True
+        return validate and not all(rec["validated"] for rec in previous["files"].values())
+
+    def update(self, keys, validate=False, threads=None):
+        """Scans the given directories in parallel, when they have changed since the last scan.
+
+        :param keys: the directories to scan, relative to the archive root
+        :param validate: validate files that have not been validated yet
+        :param threads: the number of threads used for scanning, defaults to 4x the number of CPUs (max 32)
+        :return: the number of directories that were scanned
+        """
+        logger = logging.getLogger(__name__)
+        threads = threads or min((os.cpu_count() or 1) * 4, 32)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            # Checking the directory modification times is done in parallel as well, on
+            # network filesystems each stat call has a significant latency.
+            needs_scan = list(executor.map(lambda k: self._needs_scan(k, validate), keys))
+            keys_to_scan = [key for key, scan in zip(keys, needs_scan) if scan]
+            futures = {executor.submit(scan_directory, self.archive_path / key, self.directories.get(key), validate): key
+                       for key in keys_to_scan if (self.archive_path / key).is_dir()}
+            for key in keys_to_scan:
+                self.directories.pop(key, None)
+            for future in concurrent.futures.as_completed(futures):
+                self.directories[futures[future]] = future.result()
+
+        logger.info(f"Scanned {len(keys_to_scan)} out of {len(keys)} directories in the NetCDF archive.")
+        return len(keys_to_scan)
+
+    def get(self, fname):
+        """Returns the manifest record for the given file, or None if the file does not exist.
+        """
+        fname = Path(fname)
+        key = fname.parent.relative_to(self.archive_path).as_posix()
+        directory = self.directories.get(key)
+        if directory is None:
+            return None
+        return directory["files"].get(fname.name)
+
+    def find_invalid(self):
+        """Finds files that are empty, failed validation, or of which the shape of the data
+        variable differs from the most common shape for the variable.
+
+        :return: a dict with the paths of invalid files as keys and the reason as values
+        """
+        invalid = {}
+        shapes = collections.defaultdict(collections.Counter)
+        for key, directory in self.directories.items():
+            varname = key.split("/")[-1]
+            for name, rec in directory["files"].items():
+                if rec["size"] == 0:
+                    invalid[self.archive_path / key / name] = "empty file"
+                elif rec["error"] is not None:
+                    invalid[self.archive_path / key / name] = rec["error"]
+                elif rec["shape"] is not None:
+                    shapes[varname][tuple(rec["shape"])] += 1
+
+        for key, directory in self.directories.items():
+            varname = key.split("/")[-1]
+            if not shapes[varname]:
+                continue
+            common_shape, _ = shapes[varname].most_common(1)[0]
+            for name, rec in directory["files"].items():
+                if rec["error"] is None and rec["shape"] is not None and tuple(rec["shape"]) != common_shape:
+                    invalid[self.archive_path / key / name] = \
+                        f"shape {tuple(rec['shape'])} differs from other files {common_shape}"
+
+        return invalid
+
+
+def get_archive_manifest(keys, validate=False, rescan=False):
+    """Returns the manifest of the NetCDF archive after updating the given directories.
+
+    :param keys: the directories to update, relative to the archive root, e.g. "2022/Precipitation-Flux"
+    :param validate: validate the NetCDF files that have not been validated yet
+    :param rescan: discard the persisted manifest and scan all directories again
+    :return: an ArchiveManifest object
+    """
+    fname = manifest_fname()
+    if rescan:
+        fname.unlink(missing_ok=True)
+    manifest = ArchiveManifest(config.data_storage.netcdf_path, fname)
+    if manifest.update(keys, validate=validate) > 0:
+        manifest.save()
+    return manifest
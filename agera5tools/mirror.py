@@ -1,35 +1,51 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) December 2022, Wageningen Environmental Research
 # Allard de Wit (allard.dewit@wur.nl)
+import os
 import logging
 from uuid import uuid4
 import datetime as dt
-import concurrent.futures
-import copy
 
-import cdsapi
 import pandas as pd
 import sqlalchemy as sa
 
-from .util import variable_names, get_grid
-from .build import unpack_cds_download, convert_ncfiles_to_dataframe, df_to_csv, df_to_database
+from .util import create_target_fname, pipeline
+from .build import download_and_unpack_month, convert_ncfiles_to_table, df_to_csv, df_to_database, \
+    df_to_parquet, create_parquet_fname, create_parquet_tmp_fname
+from .scheduler import create_scheduler
+from .compact import update_zarr_store
+from .ledger import ensure_ledger, find_ingested_days, delete_days
 from . import config
 
 
 def find_days_in_database():
-    """Finds the available days in the AgERA5 database by querying the time-series on the
-    point defined by `config.misc.reference_point`
+    """Finds the days that were loaded completely into the AgERA5 database from the ingest ledger.
+
+    The ledger is created when it does not exist and filled from the AgERA5 data when it is empty.
 
     :return: A set of date objects present in the database
     """
     engine = sa.create_engine(config.database.dsn)
-    idgrid = get_grid(engine, config.misc.reference_point.lon, config.misc.reference_point.lat,
-                      config.database.grid_table_name, config.misc.grid_search_radius)
-    with engine.connect() as DBconn:
-        sql = f"select day from {config.database.agera5_table_name} where idgrid={idgrid}"
-        df = pd.read_sql_query(sql, DBconn)
-    dates = {d.day for d in df.itertuples()}
-    return dates
+    ensure_ledger(engine)
+    complete_days, _ = find_ingested_days(engine)
+    # Close the connections, otherwise DuckDB refuses to open the database for inserting new data
+    engine.dispose()
+    return complete_days
+
+
+def remove_incomplete_days(days):
+    """Removes the data of days that were not loaded completely, so they can be loaded again.
+
+    :param days: the days that will be loaded
+    """
+    logger = logging.getLogger(__name__)
+    engine = sa.create_engine(config.database.dsn)
+    _, incomplete_days = find_ingested_days(engine)
+    incomplete_days = incomplete_days.intersection(days)
+    if incomplete_days:
+        logger.info(f"Removing data of incompletely loaded days before loading them again: {sorted(incomplete_days)}")
+        delete_days(engine, incomplete_days)
+    engine.dispose()
 
 
 def find_days_potential():
@@ -56,52 +72,61 @@ def find_days_to_update():
     return days_potential.difference(days_in_db)
 
 
-def download_one_day(input):
-    """Download one month of CDS data for given variable name, year and month
+def find_day_runs(days):
+    """Groups days into runs of consecutive days within the same month.
 
-    :param input: a tuple of three elements consisting of
-       - agera5_variable_name: the full name of the AgERA5 variable, as in YAML configuration
-       - date: the day for the download
-    :return: a dict with input variables and the path to the downloaded filename
+    :param days: an iterable of date objects
+    :return: a list of lists of consecutive days, sorted by date
+    """
+    runs = []
+    for day in sorted(days):
+        if runs and day - runs[-1][-1] == dt.timedelta(days=1) and day.month == runs[-1][-1].month:
+            runs[-1].append(day)
+        else:
+            runs.append([day])
+    return runs
+
+
+def download_days(days, varnames):
+    """Downloads the NetCDF files for all variables of the given days.
+
+    Consecutive days within a month are downloaded with one request per variable. All
+    downloads go through one scheduler which limits the number of requests to the CDS in
+    flight and retries failed requests.
+
+    :param days: an iterable of days to download
+    :param varnames: the AgERA5 variable names to download
+    :return: a generator yielding a dict with the day and the list of NetCDF files that were
+        downloaded for each day, in the order of the days.
     """
-    agera5_variable_name, day = input
-    cds_variable_details = copy.deepcopy(variable_names[agera5_variable_name])
-    version = str(config.misc.agera5_version).replace(".", "_")
-
-    cds_query = {
-            'format': 'zip',
-            'variable': cds_variable_details.pop("variable"),
-            'year': f'{day.year}',
-            'month': f'{day.month:02}',
-            'day': [f"{day.day:02}"],
-            'area': config.region.boundingbox.get_cds_bbox(),
-            'version': f'{version}',
-    }
-    cds_query.update(cds_variable_details)
-
-    download_fname = config.data_storage.tmp_path / f"cds_download_{uuid4()}.zip"
-    c = cdsapi.Client(quiet=True)
     logger = logging.getLogger(__name__)
-    try:
-        c.retrieve('sis-agrometeorological-indicators', cds_query, download_fname)
-        msg = f"Downloaded data for {agera5_variable_name} for {day} to {download_fname}."
-        logger.debug(msg)
-    except Exception as e:
-        logger.exception(f"Failed downloading {agera5_variable_name} - {day}")
-        download_fname = None
 
-    return dict(day=day, varname=agera5_variable_name, download_fname=download_fname)
+    def download_tasks():
+        for run in find_day_runs(days):
+            logger.info(f"Scheduling CDS download of {len(varnames)} AgERA5 variables for {run[0]} - {run[-1]}")
+            yield run, [(varname, run[0].year, run[0].month, [day.day for day in run]) for varname in varnames]
 
+    scheduler = create_scheduler(download_and_unpack_month, "mirror")
+    for run, results, _ in scheduler.run_groups(download_tasks()):
+        downloaded_ncfiles = {nc_file for nc_files in results for nc_file in nc_files}
+        for day in run:
+            nc_files = [create_target_fname(varname, day, agera5_dir=config.data_storage.netcdf_path,
+                                            version=config.misc.agera5_version) for varname in varnames]
+            yield dict(day=day, nc_files=[f for f in nc_files if f in downloaded_ncfiles])
 
-def mirror(to_csv=True, dry_run=False):
+
+def mirror(to_csv=True, dry_run=False, to_parquet=False):
     """mirrors the AgERA5tools database.
 
     This procedure will mirror the AgERA5 data at the Copernicus Climate Datastore. It will
-    incrementally update the local database by downloading files for each day. Note that this
+    incrementally update the local database by downloading files for the missing days. Consecutive
+    missing days within a month are downloaded with a single request for each variable. Note that this
     procedure should be run daily to update the local database with the remote AgERA5 data at
-    the CDS.
+    the CDS. Days are also appended to the Zarr store, when it has been created with `compact`.
 
     :param to_csv: Flag indicating if a compressed CSV file should be written.
+    :param dry_run: Only determine the days to update, do not download and process them.
+    :param to_parquet: Flag indicating if the data should be added to the Parquet dataset.
     """
     logger = logging.getLogger(__name__)
     selected_variables = [varname for varname, selected in config.variables.items() if selected]
@@ -115,30 +140,33 @@ def mirror(to_csv=True, dry_run=False):
     if dry_run:  # Do not actually start processing
         return days, days_failed
 
-    for day in sorted(days):
-        logger.info(f"Starting AgERA5 download for {day}")
-        to_download = []
-        for varname in selected_variables:
-            to_download.append((varname, day))
-
-        logger.info(f"Starting concurrent CDS download of {len(to_download)} AgERA5 variables.")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=len(to_download)) as executor:
-            downloaded_sets = executor.map(download_one_day, to_download)
-
-        downloaded_ncfiles = []
-        for dset in downloaded_sets:
-            ncfiles = unpack_cds_download(dset)
-            downloaded_ncfiles.extend(ncfiles)
+    remove_incomplete_days(days)
 
+    # Days are downloaded in the background while the days already downloaded are converted.
+    downloaded_days = download_days(sorted(days), selected_variables)
+    for downloaded in pipeline(downloaded_days, None, maxsize=config.download.max_queued):
+        day, downloaded_ncfiles = downloaded["day"], downloaded["nc_files"]
         if len(downloaded_ncfiles) != len(selected_variables):
             days_failed.add(day)
             continue
 
-        df = convert_ncfiles_to_dataframe(downloaded_ncfiles)
-        df_to_database(df, descriptor=day)
+        tbl = convert_ncfiles_to_table(downloaded_ncfiles)
+        df_to_database(tbl, descriptor=day)
         if to_csv:
             csv_fname = config.data_storage.csv_path / f"weather_grid_agera5_{day}.csv.gz"
-            df_to_csv(df, csv_fname)
+            df_to_csv(tbl, csv_fname)
+        if to_parquet:
+            parquet_fname = create_parquet_fname(day.year, day.month, f"weather_grid_agera5_{day}")
+            parquet_fname_tmp = create_parquet_tmp_fname(parquet_fname)
+            try:
+                df_to_parquet(tbl, parquet_fname_tmp).close()
+            except Exception:
+                parquet_fname_tmp.unlink(missing_ok=True)
+                raise
+            os.rename(parquet_fname_tmp, parquet_fname)
+            logger.info(f"Written output to Parquet: {parquet_fname}")
+
+        update_zarr_store(downloaded_ncfiles)
 
         # Delete NetCDF files if required
         if config.data_storage.keep_netcdf is False:
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) October 2026, Wageningen Environmental Research
+# Allard de Wit (allard.dewit@wur.nl)
+"""An in-memory cache of serialized responses for the HTTP server.
+
+Clients often request the same grid cells and date ranges repeatedly. The cache stores the
+serialized weather data for a request, keyed on the grid ID, the date range, the output
+format, the selected variables and the aggregation period, and evicts the least recently used
+entries when the total size of the cached responses exceeds the memory budget
+(`server.cache_size_mb`).
+
+The cache is emptied when the version of the ingest ledger changes, so that responses do not
+hold data from before new, backfilled or reloaded days were ingested by `mirror` or `build`.
+"""
+import threading
+import collections
+from functools import lru_cache
+
+from . import config
+
+
+class ResponseCache:
+    """A thread-safe LRU cache of serialized responses with a memory budget.
+
+    :param max_bytes: the maximum total size of the cached responses, 0 disables the cache
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def validate(self, version):
+        """Empties the cache when the version of the ingest ledger has changed.
+
+        :param version: the version of the ingest ledger, see `ServerEngine.fetch_ledger_state()`
+        """
+        with self._lock:
+            if version != self.version:
+                if self.entries:
+                    self.invalidations += 1
+                self.entries.clear()
+                self.nbytes = 0
+                self.version = version
+
+    def get(self, key):
+        """Returns the cached response for key, or None.
+        """
+        with self._lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, version):
+        """Adds a response to the cache, evicting the least recently used responses when needed.
+
+        Responses larger than the memory budget are not cached. Neither are responses read
+        for another version of the ingest ledger than the current version of the cache, because
+        the cache was validated for a newer version while the response was read.
+
+        :param key: a tuple (idgrid, startdate, enddate, format, variables, aggregate)
+        :param value: the serialized response as bytes
+        :param version: the version of the ingest ledger passed to `validate()` for this response
+        """
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if version != self.version:
+                return
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.nbytes -= len(previous)
+            self.entries[key] = value
+            self.nbytes += len(value)
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= len(evicted)
+                self.evictions += 1
+
+    def put_stream(self, key, chunks, version):
+        """Yields the chunks of a streamed response and adds the complete response to the cache
+        once all chunks were yielded.
+
+        Chunks are only collected as long as the response fits into the memory budget.
+
+        :param key: a tuple (idgrid, startdate, enddate, format, variables, aggregate)
+        :param chunks: an iterator over the chunks of the response as bytes
+        :param version: the version of the ingest ledger passed to `validate()` for this response
+        """
+        parts, size = [], 0
+        for chunk in chunks:
+            yield chunk
+            if parts is not None:
+                size += len(chunk)
+                if size <= self.max_bytes:
+                    parts.append(chunk)
+                else:
+                    parts = None
+        if parts is not None:
+            self.put(key, b"".join(parts), version)
+
+    def stats(self):
+        """Returns the cache statistics as a dict.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(entries=len(self.entries), bytes=self.nbytes, max_bytes=self.max_bytes,
+                        hits=self.hits, misses=self.misses,
+                        hit_ratio=round(self.hits / lookups, 4) if lookups else None,
+                        evictions=self.evictions, invalidations=self.invalidations,
+                        latest_day=None if self.version is None or self.version[0] is None
+                        else self.version[0].isoformat())
+
+
+@lru_cache(maxsize=1)
+def get_response_cache():
+    """Returns the response cache of this process, it is created on first use.
+    """
+    return ResponseCache(int(config.server.cache_size_mb * 1024 ** 2))
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) October 2026, Wageningen Environmental Research
+# Allard de Wit (allard.dewit@wur.nl)
+"""Output formats of the HTTP API for time series of AgERA5 data.
+
+The formats "ndjson", "csv" and "arrow" are serialized incrementally from batches of rows
+fetched from the database cursor, so that the response can be streamed to the client without
+holding the complete time series in memory. The formats "json" (a list of records) and
+"json_columns" (a list of values for each column) are returned as a single JSON document.
+The formats "parquet" and "netcdf" are used for areas and are returned as a single file.
+"""
+import io
+import csv
+import json
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .util import json_date_serial
+
+mimetypes = {"json": "application/json",
+             "json_columns": "application/json",
+             "ndjson": "application/x-ndjson",
+             "csv": "text/csv",
+             "arrow": "application/vnd.apache.arrow.stream",
+             "parquet": "application/vnd.apache.parquet",
+             "netcdf": "application/x-netcdf"}
+
+streamed_formats = ("ndjson", "csv", "arrow")
+
+
+def negotiate_format(fmt, accept_mimetypes, formats=("json", "json_columns", "ndjson", "csv", "arrow")):
+    """Determines the output format from the `format` parameter or the Accept header.
+
+    :param fmt: the value of the `format` parameter of the request, or None
+    :param accept_mimetypes: the parsed Accept header of the request (`request.accept_mimetypes`)
+    :param formats: the formats supported by the API call, the first one is the default
+    :return: the name of the output format
+    """
+    if fmt is not None:
+        if fmt not in formats:
+            msg = f"Unknown format '{fmt}', should be one of {', '.join(formats)}"
+            raise RuntimeError(msg)
+        return fmt
+    # json_columns has the same media type as json and can only be requested by name. The
+    # default format is listed first, so it is chosen when the client accepts any type.
+    candidates = [f for f in formats if f != "json_columns"]
+    best = accept_mimetypes.best_match([mimetypes[f] for f in candidates], default=mimetypes[candidates[0]])
+    return next(f for f in candidates if mimetypes[f] == best)
+
+
+def iter_ndjson(columns, batches):
+    """Serializes batches of rows as JSON objects, one per line.
+    """
+    for rows in batches:
+        yield "".join(json.dumps(dict(zip(columns, row)), default=json_date_serial) + "\n"
+                      for row in rows).encode()
+
+
+def iter_csv(columns, batches):
+    """Serializes batches of rows as CSV with a header line.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(columns)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def iter_record_batches(columns, batches, metadata=None):
+    """Converts batches of rows into Arrow record batches with the same schema.
+
+    The schema is inferred from the first batch of rows.
+
+    :param metadata: a dict with metadata stored in the schema, values are serialized to JSON
+    """
+    schema = None
+    for rows in batches:
+        arrays = [pa.array(values) for values in zip(*rows)]
+        if schema is None:
+            schema = pa.schema([pa.field(name, array.type) for name, array in zip(columns, arrays)])
+            if metadata is not None:
+                schema = schema.with_metadata({k: json.dumps(v) for k, v in metadata.items()})
+        yield pa.record_batch([a.cast(f.type) for a, f in zip(arrays, schema)], schema=schema)
+
+
+def iter_arrow(columns, batches, metadata=None):
+    """Serializes batches of rows as an Arrow IPC stream with a record batch per batch of rows.
+
+    :param metadata: a dict with metadata stored in the schema, values are serialized to JSON
+    """
+    sink = io.BytesIO()
+    writer = None
+    for batch in iter_record_batches(columns, batches, metadata):
+        if writer is None:
+            writer = pa.ipc.new_stream(sink, batch.schema)
+        writer.write_batch(batch)
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+    if writer is not None:
+        writer.close()
+        yield sink.getvalue()
+
+
+def serialize_parquet(columns, batches, metadata=None):
+    """Serializes batches of rows as a Parquet file with a row group per batch of rows.
+
+    :param metadata: a dict with metadata stored in the schema, values are serialized to JSON
+    """
+    sink = io.BytesIO()
+    writer = None
+    for batch in iter_record_batches(columns, batches, metadata):
+        if writer is None:
+            writer = pq.ParquetWriter(sink, batch.schema)
+        writer.write_batch(batch)
+    if writer is not None:
+        writer.close()
+    return sink.getvalue()
+
+
+def serialize_netcdf(columns, batches, attrs=None):
+    """Serializes batches of rows with the columns day, latitude and longitude as a NetCDF file
+    with the variables on (time, lat, lon).
+
+    The latitudes and longitudes are those of the grid cells in the rows, rounded to 2 decimals
+    as they may be stored as 32-bit floats in the database. Grid cells without data have missing
+    values.
+
+    :param attrs: a dict with global attributes of the NetCDF file
+    """
+    df = pd.DataFrame([row for rows in batches for row in rows], columns=columns)
+    df = df.drop(columns=[c for c in ("idgrid",) if c in df.columns])
+    df["day"] = pd.to_datetime(df.day)
+    df = df.rename(columns={"day": "time", "latitude": "lat", "longitude": "lon"})
+    df["lat"] = df.lat.round(2)
+    df["lon"] = df.lon.round(2)
+    ds = df.set_index(["time", "lat", "lon"]).to_xarray().sortby("lat", ascending=False)
+    ds.attrs.update(attrs or {})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = Path(tmpdir) / "agera5.nc"
+        ds.to_netcdf(fname)
+        return fname.read_bytes()
+
+
+def serialize_json_columns(columns, batches):
+    """Serializes batches of rows as a JSON object with a list of values for each column.
+    """
+    values = [[] for _ in columns]
+    for rows in batches:
+        for i, column in enumerate(zip(*rows)):
+            values[i].extend(column)
+    return json.dumps(dict(zip(columns, values)), default=json_date_serial).encode()
+
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) October 2026, Wageningen Environmental Research
+# Allard de Wit (allard.dewit@wur.nl)
+"""Scheduling of download tasks on the Copernicus Climate Data Store.
+
+All downloads of a `build` or `mirror` run go through one DownloadScheduler which limits
+the number of requests in flight, retries failed requests with exponential backoff and
+keeps track of the tasks in a JSON file in the `tmp_path`. Tasks that were interrupted in
+a previous run are read from this file and scheduled again when they are part of the
+current run, other interrupted tasks are dropped.
+"""
+import logging
+import json
+import time
+import random
+import heapq
+import collections
+import datetime as dt
+import concurrent.futures
+from pathlib import Path
+from uuid import uuid4
+
+from . import config
+
+
+def task_key(task):
+    """Returns a string key for a task, tasks are tuples of strings, numbers and dates.
+    """
+    return json.dumps(task, default=str)
+
+
+class TaskQueue:
+    """A record of download tasks and their status, persisted to a JSON file.
+
+    Tasks are removed from the record when completed. After a run the file therefore contains
+    only the tasks that failed, or that were unfinished when the run was interrupted.
+    Tasks are stored as JSON lists and returned as tuples by `interrupted()`.
+
+    :param fname: the path to the JSON file, if None the queue is not persisted
+    """
+
+    def __init__(self, fname=None):
+        self.fname = None if fname is None else Path(fname)
+        self.tasks = {}
+        if self.fname is not None and self.fname.exists():
+            try:
+                with open(self.fname) as fp:
+                    self.tasks = json.load(fp)
+            except (OSError, ValueError) as e:
+                logger = logging.getLogger(__name__)
+                logger.warning(f"Failed reading task queue from {self.fname}: {e}")
+
+    def unfinished(self):
+        """Returns the records of tasks that were not completed successfully.
+        """
+        return list(self.tasks.values())
+
+    def interrupted(self):
+        """Returns the tasks that were running or waiting for a retry when a run was interrupted.
+        """
+        return [tuple(rec["task"]) for rec in self.tasks.values() if rec["status"] != "failed"]
+
+    def update(self, task, status, attempts=0, error=None):
+        """Updates the status of a task, completed tasks (status "done") are removed.
+        """
+        key = task_key(task)
+        if status == "done":
+            self.tasks.pop(key, None)
+        else:
+            self.tasks[key] = dict(task=json.loads(key), status=status, attempts=attempts,
+                                   error=None if error is None else str(error),
+                                   updated=dt.datetime.now().isoformat(timespec="seconds"))
+        self.save()
+
+    def save(self):
+        """Writes the queue to a temporary file first which is then renamed.
+        """
+        if self.fname is None:
+            return
+        if not self.tasks:
+            self.fname.unlink(missing_ok=True)
+            return
+        fname_tmp = self.fname.with_name(f"{self.fname.name}.{uuid4()}.tmp")
+        with open(fname_tmp, "w") as fp:
+            json.dump(self.tasks, fp, indent=1)
+        fname_tmp.replace(self.fname)
+
+
+class DownloadScheduler:
+    """Runs download tasks concurrently with a limit on the number of tasks in flight.
+
+    Tasks are pulled from the input iterable only when there is room, so the input can be a
+    generator and tasks are started in the order given. Failed tasks are retried after a
+    delay that doubles with every attempt (exponential backoff) and is randomized (jitter)
+    to avoid that retries hit the server at the same time.
+
+    :param func: the function executing a task, it should raise an exception on failure
+    :param max_in_flight: the maximum number of tasks that are running or waiting for a retry
+    :param max_retries: the number of retries before a task is reported as failed
+    :param backoff: the delay (seconds) before the first retry
+    :param max_backoff: the maximum delay (seconds) between retries
+    :param queue_fname: the JSON file in which the task queue is persisted, or None
+    """
+
+    def __init__(self, func, max_in_flight=4, max_retries=3, backoff=30., max_backoff=600., queue_fname=None):
+        self.func = func
+        self.max_in_flight = max(int(max_in_flight), 1)
+        self.max_retries = max(int(max_retries), 0)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.queue = TaskQueue(queue_fname)
+        self.nretries = 0
+
+    def retry_delay(self, attempt):
+        """Returns the delay before retry number `attempt` (starting at 1).
+
+        Half of the exponential delay is fixed, the other half is random.
+        """
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def run(self, tasks):
+        """Runs the tasks and yields the outcome of each task when it is finished.
+
+        Tasks that were interrupted in a previous run are run again when they are among the
+        given tasks. Interrupted tasks that are not among the given tasks are dropped with a
+        warning, their results would not be processed. Tasks that failed in a previous run are
+        not run again.
+
+        :param tasks: an iterable of tasks, each task is passed to func
+        :return: a generator yielding tuples of (task, result, exception) in order of completion,
+            the exception is None for succesful tasks and the result is None for failed tasks.
+        """
+        logger = logging.getLogger(__name__)
+        unfinished = self.queue.unfinished()
+        interrupted = self.queue.interrupted()
+        if unfinished:
+            logger.warning(f"Found {len(unfinished)} tasks in task queue {self.queue.fname} which did not "
+                           f"complete in a previous run, {len(interrupted)} of these were interrupted.")
+            self.queue.tasks = {}
+            self.queue.save()
+
+        def given_tasks(tasks):
+            seen = set()
+            for task in tasks:
+                seen.add(task_key(task))
+                yield task
+            resumed = [task for task in interrupted if task_key(task) in seen]
+            dropped = [task for task in interrupted if task_key(task) not in seen]
+            if resumed:
+                logger.info(f"Scheduled {len(resumed)} interrupted tasks again.")
+            if dropped:
+                logger.warning(f"Dropped {len(dropped)} interrupted tasks which are not part of this run: "
+                               + ", ".join(task_key(task) for task in dropped))
+
+        tasks = given_tasks(tasks)
+        exhausted = False
+        running = {}  # future -> (task, attempt)
+        waiting = []  # heap of (time to retry, sequence number, task, attempt)
+        seqno = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            while True:
+                # Start tasks waiting for a retry when their time has come
+                now = time.monotonic()
+                while waiting and waiting[0][0] <= now:
+                    _, _, task, attempt = heapq.heappop(waiting)
+                    self.queue.update(task, "running", attempt)
+                    running[executor.submit(self.func, task)] = (task, attempt)
+
+                # Start new tasks while there is room
+                while not exhausted and len(running) + len(waiting) < self.max_in_flight:
+                    try:
+                        task = next(tasks)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    self.queue.update(task, "running", 0)
+                    running[executor.submit(self.func, task)] = (task, 0)
+
+                if not running and not waiting:
+                    break
+
+                timeout = max(waiting[0][0] - now, 0) if waiting else None
+                done, _ = concurrent.futures.wait(running, timeout=timeout,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    task, attempt = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        if attempt < self.max_retries:
+                            delay = self.retry_delay(attempt + 1)
+                            logger.warning(f"Task {task_key(task)} failed ({e}), retrying in {delay:.1f} seconds.")
+                            self.queue.update(task, "waiting", attempt + 1, e)
+                            heapq.heappush(waiting, (time.monotonic() + delay, seqno, task, attempt + 1))
+                            seqno += 1
+                            self.nretries += 1
+                        else:
+                            logger.error(f"Task {task_key(task)} failed after {attempt + 1} attempts: {e}")
+                            self.queue.update(task, "failed", attempt + 1, e)
+                            yield task, None, e
+                    else:
+                        self.queue.update(task, "done")
+                        yield task, result, None
+
+    def run_groups(self, groups):
+        """Runs groups of tasks and yields each group when all its tasks are finished.
+
+        Groups are yielded in the order given, e.g. a month is yielded when all its variables
+        are downloaded. Tasks of later groups are already started while earlier groups are
+        not yet finished, as long as the limit on tasks in flight allows.
+
+        :param groups: an iterable of (key, tasks) tuples where tasks is a list of tasks
+        :return: a generator yielding tuples of (key, results, exceptions) with the results of
+            the successful tasks and the exceptions of the failed tasks in the group.
+        """
+        registered = collections.deque()
+        owners = {}
+
+        def all_tasks():
+            for key, tasks in groups:
+                group = dict(key=key, results=[], errors=[], outstanding=len(tasks))
+                registered.append(group)
+                for task in tasks:
+                    owners[task_key(task)] = group
+                    yield task
+
+        def finished_groups():
+            while registered and registered[0]["outstanding"] == 0:
+                group = registered.popleft()
+                yield group["key"], group["results"], group["errors"]
+
+        for task, result, error in self.run(all_tasks()):
+            group = owners.pop(task_key(task))
+            if error is None:
+                group["results"].append(result)
+            else:
+                group["errors"].append(error)
+            group["outstanding"] -= 1
+            yield from finished_groups()
+
+        yield from finished_groups()
+
+
+def create_scheduler(func, name):
+    """Creates a DownloadScheduler with the settings from the configuration.
+
+    :param func: the function executing a download task
+    :param name: the name of the task queue, the queue is persisted in the `tmp_path` as
+        cds_tasks_<name>.json
+    :return: a DownloadScheduler
+    """
+    return DownloadScheduler(func, max_in_flight=config.download.max_in_flight,
+                             max_retries=config.download.max_retries,
+                             backoff=config.download.retry_backoff,
+                             max_backoff=config.download.max_retry_backoff,
+                             queue_fname=config.data_storage.tmp_path / f"cds_tasks_{name}.json")
@@ -8,8 +8,13 @@ import wsgiserver
 from flask import Flask, request, Response
 import json
 
-from . import config
-from .db_data_provider import get_agera5
+from . import config, reload_config
+from .db_data_provider import locate_agera5, fetch_agera5_records, stream_agera5_rows, get_server_engine, \
+    locate_agera5_bulk, iter_agera5_groups, locate_agera5_area, stream_agera5_area_rows
+from .response_cache import get_response_cache
+from .response_formats import negotiate_format, mimetypes, streamed_formats, iter_ndjson, iter_csv, iter_arrow, \
+    serialize_json_columns, serialize_parquet, serialize_netcdf
+from .grid import get_grid_index, get_region_grid_definition
 from .util import BoundedFloat, json_date_serial
 
 app = Flask(__name__)
@@ -18,6 +23,12 @@ AgERA5_bounded_lat = BoundedFloat(minvalue=-66.5, maxvalue=66.5, msg="Latitude s
 bounded_lon = BoundedFloat(minvalue=-180, maxvalue=180, msg="Longitude should be between -180 and 180")
 
 
+def optional_str(value):
+    """Parses an optional string parameter, which is None when it is missing.
+    """
+    return None if value is None else str(value)
+
+
 def parse_inputs(params):
     """This retrieves and parses the parameters from the HTTP request.
     """
@@ -32,17 +43,81 @@ def parse_inputs(params):
     return inputs
 
 
-def get_JSON_response(func, params, name):
+@app.route("/")
+def index():
+    package_dir = Path(__file__).parent
+    print(package_dir.absolute())
+    with open(package_dir / "help.html") as fp:
+        html = "".join(fp.readlines())
+    return Response(html, mimetype="text/html")
+
+
+def get_agera5_response(params, name):
+    """Returns the response for get_agera5 in the format requested by the client.
+
+    The format is taken from the `format` parameter or otherwise from the Accept header, see
+    `negotiate_format()`. The formats ndjson, csv and arrow are streamed from the database
+    cursor, the location info is then returned in the X-AgERA5-Location header. The JSON
+    formats are assembled from the serialized parts, for the default format ("json") this
+    gives the same body as serializing the complete response with `json.dumps()`.
+
+    The optional parameters `variables` and `aggregate` select variables and aggregate the data
+    per dekad, month or year, they are only included in the inputs of the response when given.
+
+    Serialized weather data is taken from the response cache when available.
+    """
     logger = logging.getLogger(name)
     inputs = "No inputs parsed yet"
     try:
         inputs = parse_inputs(params)
-        r = {"success": True,
-             "message": "success",
-             "inputs": inputs,
-             "data": func(**inputs)}
+        for parname in ("variables", "aggregate"):
+            if request.args.get(parname) is not None:
+                inputs[parname] = request.args.get(parname)
+        fmt = negotiate_format(request.args.get("format"), request.accept_mimetypes)
+        location = locate_agera5(**inputs)
+        cache = get_response_cache()
+        # Without ingest ledger the cache cannot be invalidated, so it is not used.
+        use_cache = location.ledger_version is not None
+        if use_cache:
+            cache.validate(location.ledger_version)
+        key = (location.idgrid, location.startdate, location.enddate, fmt,
+               None if location.variables is None else tuple(location.variables), location.aggregate)
+        cached = cache.get(key) if use_cache else None
+
+        if fmt in streamed_formats:
+            headers = {"X-AgERA5-Location": json.dumps(location.location_info)}
+            if cached is not None:
+                body = cached
+            else:
+                columns, batches = stream_agera5_rows(location)
+                if fmt == "ndjson":
+                    body = iter_ndjson(columns, batches)
+                elif fmt == "csv":
+                    body = iter_csv(columns, batches)
+                else:
+                    body = iter_arrow(columns, batches, metadata={"location_info": location.location_info})
+                if use_cache:
+                    body = cache.put_stream(key, body, location.ledger_version)
+            logger.info("Retrieving %s with inputs %s as %s", name, inputs, fmt)
+            return Response(body, mimetype=mimetypes[fmt], headers=headers)
+
+        weather_variables = cached
+        if weather_variables is None:
+            if fmt == "json_columns":
+                weather_variables = serialize_json_columns(*stream_agera5_rows(location))
+            else:
+                weather_variables = json.dumps(fetch_agera5_records(location), default=json_date_serial).encode()
+            if use_cache:
+                cache.put(key, weather_variables, location.ledger_version)
+        body = b"".join([b'{"success": true, "message": "success", "inputs": ',
+                         json.dumps(inputs).encode(),
+                         b', "data": {"location_info": ',
+                         json.dumps(location.location_info).encode(),
+                         b', "weather_variables": ',
+                         weather_variables,
+                         b', "info": "data retrieval successful"}}'])
         logger.info("Successfully retrieved %s with inputs %s", name, inputs)
-        return Response(json.dumps(r, default=json_date_serial), mimetype="application/json")
+        return Response(body, mimetype="application/json")
     except Exception as e:
         logger.exception("Failure getting %s with inputs %s", name, inputs)
         r = {"success": False,
@@ -51,24 +126,196 @@ def get_JSON_response(func, params, name):
         return Response(json.dumps(r), mimetype="application/json")
 
 
-@app.route("/")
-def index():
-    package_dir = Path(__file__).parent
-    print(package_dir.absolute())
-    with open(package_dir / "help.html") as fp:
-        html = "".join(fp.readlines())
-    return Response(html, mimetype="text/html")
-
-
 @app.route("/api/v1/get_agera5")
 def flask_get_agera5():
     params = {"latitude": AgERA5_bounded_lat, "longitude": bounded_lon, "startdate": str, "enddate": str}
-    return get_JSON_response(get_agera5, params, "get_agera5")
+    return get_agera5_response(params, "get_agera5")
+
+
+def iter_bulk_ndjson(bulk, columns, groups):
+    """Serializes the response of get_agera5_bulk as one JSON object per location and line.
 
+    Locations without grid cell come first, followed by the locations with data ordered by
+    grid cell and finally the locations for which no data were found.
+    """
+    by_idgrid = {}
+    for loc in bulk.locations:
+        if "idgrid" in loc:
+            by_idgrid.setdefault(loc["idgrid"], []).append(loc)
+        else:
+            yield (json.dumps({"location": loc["location"], "success": False, "message": loc["message"]}) + "\n").encode()
+
+    for idgrid, rows in groups:
+        weather_variables = json.dumps([dict(zip(columns, row)) for row in rows], default=json_date_serial)
+        for loc in by_idgrid.pop(idgrid, []):
+            yield "".join(['{"location": ', str(loc["location"]), ', "success": true, "location_info": ',
+                           json.dumps(loc["location_info"]), ', "weather_variables": ', weather_variables,
+                           '}\n']).encode()
+
+    for locs in by_idgrid.values():
+        for loc in locs:
+            yield (json.dumps({"location": loc["location"], "success": False,
+                               "message": "No AgERA5 data found for this location and/or date range"}) + "\n").encode()
+
+
+def iter_bulk_rows(bulk, groups, batch_size=1000):
+    """Returns the rows of the response of get_agera5_bulk with the index of the location
+    in the request as first column, in batches of rows.
+    """
+    by_idgrid = {}
+    for loc in bulk.locations:
+        if "idgrid" in loc:
+            by_idgrid.setdefault(loc["idgrid"], []).append(loc["location"])
+    batch = []
+    for idgrid, rows in groups:
+        for location in by_idgrid.get(idgrid, []):
+            batch.extend((location,) + row for row in rows)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@app.route("/api/v1/get_agera5_bulk", methods=["POST"])
+def flask_get_agera5_bulk():
+    """Returns the data for many locations, given as JSON in the body of a POST request.
 
-def serve(port=8080):
-    server = wsgiserver.WSGIServer(app, port=port)
-    server.start()
+    The body holds "points" (a list of objects with latitude and longitude) or "idgrids"
+    (a list of grid IDs), and optionally "startdate", "enddate" and "format". The locations
+    are resolved at once and the data for all grid cells is retrieved with a single query,
+    the response is streamed grouped by location.
+    """
+    name = "get_agera5_bulk"
+    logger = logging.getLogger(name)
+    inputs = "No inputs parsed yet"
+    try:
+        inputs = request.get_json(force=True, silent=True)
+        if not isinstance(inputs, dict):
+            raise RuntimeError("The body of the request should be a JSON object")
+        fmt = negotiate_format(inputs.get("format"), request.accept_mimetypes, formats=("ndjson", "csv", "arrow"))
+        bulk = locate_agera5_bulk(inputs.get("points"), inputs.get("idgrids"), inputs.get("startdate"),
+                                  inputs.get("enddate"))
+        idgrids = [loc["idgrid"] for loc in bulk.locations if "idgrid" in loc]
+        columns, groups = iter_agera5_groups(idgrids, bulk.startdate, bulk.enddate)
+        if fmt == "ndjson":
+            body = iter_bulk_ndjson(bulk, columns, groups)
+        elif fmt == "csv":
+            body = iter_csv(["location"] + columns, iter_bulk_rows(bulk, groups))
+        else:
+            body = iter_arrow(["location"] + columns, iter_bulk_rows(bulk, groups),
+                              metadata={"locations": [loc.get("location_info") for loc in bulk.locations]})
+        logger.info("Retrieving %s for %i locations as %s", name, len(bulk.locations), fmt)
+        return Response(body, mimetype=mimetypes[fmt])
+    except Exception as e:
+        logger.exception("Failure getting %s with inputs %s", name, inputs)
+        r = {"success": False,
+             "inputs": inputs,
+             "message": str(e)}
+        return Response(json.dumps(r), mimetype="application/json")
+
+
+@app.route("/api/v1/get_agera5_area")
+def flask_get_agera5_area():
+    """Returns the data for the grid cells in a bounding box for a day or a date range.
+
+    The response is an Arrow IPC stream (default), a Parquet file or a NetCDF file, requested
+    with the `format` parameter or the Accept header.
+    """
+    name = "get_agera5_area"
+    logger = logging.getLogger(name)
+    params = {"lon_min": bounded_lon, "lon_max": bounded_lon, "lat_min": AgERA5_bounded_lat,
+              "lat_max": AgERA5_bounded_lat, "day": optional_str, "startdate": str, "enddate": str}
+    inputs = "No inputs parsed yet"
+    try:
+        inputs = parse_inputs(params)
+        fmt = negotiate_format(request.args.get("format"), request.accept_mimetypes,
+                               formats=("arrow", "parquet", "netcdf"))
+        area = locate_agera5_area(**inputs)
+        columns, batches = stream_agera5_area_rows(area)
+        metadata = {"region_name": config.region.name, "startdate": str(area.startdate),
+                    "enddate": str(area.enddate)}
+        if fmt == "arrow":
+            body = iter_arrow(columns, batches, metadata=metadata)
+        elif fmt == "parquet":
+            body = serialize_parquet(columns, batches, metadata=metadata)
+        else:
+            body = serialize_netcdf(columns, batches, attrs=metadata)
+        logger.info("Retrieving %s for %i grid cells with inputs %s as %s", name, area.ncells, inputs, fmt)
+        return Response(body, mimetype=mimetypes[fmt])
+    except Exception as e:
+        logger.exception("Failure getting %s with inputs %s", name, inputs)
+        r = {"success": False,
+             "inputs": inputs,
+             "message": str(e)}
+        return Response(json.dumps(r), mimetype="application/json")
+
+
+@app.route("/api/v1/cache_stats")
+def flask_cache_stats():
+    return Response(json.dumps(get_response_cache().stats()), mimetype="application/json")
+
+
+def serve_gunicorn(port, workers, threads):
+    """Serves the app with gunicorn, using several worker processes with several threads each.
+
+    Each worker process opens its own (read-only for DuckDB) database connections and has its
+    own response cache, the app is therefore not loaded before the workers are started. Workers
+    that do not finish a request within `server.timeout` seconds are restarted. Sending SIGHUP to
+    the main process reloads the configuration of AgERA5tools in the main process and replaces
+    the workers gracefully, the new workers inherit the new configuration. The number of workers
+    and threads and the port are not changed.
+    """
+    from gunicorn.app.base import BaseApplication
+
+    class AgERA5Application(BaseApplication):
+
+        def reload(self):
+            reload_config()
+            for func in (get_server_engine, get_response_cache, get_grid_index, get_region_grid_definition):
+                func.cache_clear()
+            super().reload()
+
+        def load_config(self):
+            options = {"bind": f"0.0.0.0:{port}",
+                       "workers": workers,
+                       "threads": threads,
+                       "worker_class": "gthread",
+                       "timeout": config.server.timeout,
+                       "graceful_timeout": config.server.timeout,
+                       "preload_app": False,
+                       "post_worker_init": lambda worker: get_server_engine()}
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    AgERA5Application().run()
+
+
+def serve(port=8080, workers=None, threads=None):
+    """Starts serving AgERA5 data through HTTP.
+
+    With one worker the app is served by a multithreaded WSGI server in this process. With more
+    workers the app is served by gunicorn, which must be installed.
+
+    :param port: the port to listen on
+    :param workers: the number of worker processes, defaults to `server.workers`
+    :param threads: the number of threads per worker process, defaults to `server.threads`
+    """
+    workers = workers or config.server.workers
+    threads = threads or config.server.threads
+    if workers > 1:
+        try:
+            import gunicorn
+        except ImportError:
+            msg = "Serving with several worker processes requires gunicorn, install it with `pip install gunicorn`."
+            raise RuntimeError(msg)
+        serve_gunicorn(port, workers, threads)
+    else:
+        server = wsgiserver.WSGIServer(app, port=port, numthreads=threads, timeout=config.server.timeout)
+        server.start()
 
 
 if __name__ == "__main__":
@@ -9,10 +9,12 @@ import tempfile
 import datetime as dt
 import sqlite3
 import calendar
+import collections
+import concurrent.futures
+import queue
+import threading
 from math import log10
 
-import pandas as pd
-from numpy import arccos, cos, radians, sin
 
 import yaml
 import xarray as xr
@@ -150,6 +152,13 @@ class Point:
         return f"longitude {self.longitude:6.2f} and/or latitude {self.latitude:5.2f}"
 
 
+def is_temperature(varname):
+    """Returns True if the AgERA5 variable name refers to a temperature in degrees K.
+    """
+    varname = varname.lower()
+    return varname.startswith("temp") or varname.startswith("dew")
+
+
 def convert_to_celsius(df):
     """Converts temperature columns from degrees K to C
 
@@ -158,7 +167,7 @@ def convert_to_celsius(df):
     """
     for colname in df.columns:
         colname = colname.lower()
-        if colname.startswith("temp") or colname.startswith("dew"):
+        if is_temperature(colname):
             df[colname] -= 273.15
     return df
 
@@ -225,11 +234,16 @@ def write_dataframe(df, fname_output=None):
 
 def add_grid(ds):
     """Adds the AgERA5 grid definition to the dataset.
+
+    The grid definition of the configured region is used when it covers the dataset,
+    otherwise the global grid definition. Both are kept in memory after first use.
     """
-    agera5_grid = Path(__file__).parent / "grid_elevation_landfraction.nc"
-    ds_grid = xr.open_dataset(agera5_grid)
+    from .grid import get_grid_definition, get_region_grid_definition
 
-    ds["idgrid"] = ds_grid.idgrid_era5
+    grid = get_region_grid_definition()
+    if not grid.covers(ds.lat.values, ds.lon.values):
+        grid = get_grid_definition()
+    ds["idgrid"] = grid.ds.idgrid_era5
 
     return ds
 
@@ -247,24 +261,6 @@ def number_days_in_month(year, month):
     return 30
 
 
-def get_grid(engine, lon, lat, grid_table_name, search_radius):
-    sql = f""" 
-    SELECT idgrid, longitude, latitude
-    FROM {grid_table_name}
-    WHERE latitude < {lat + search_radius} AND latitude > {lat - search_radius} AND 
-        longitude < {lon + search_radius} AND longitude > {lon - search_radius} 
-    """
-    df = pd.read_sql_query(sql, engine)
-    if len(df) > 0:
-        tiny = 0.001
-        df["dist"] = (6371 * arccos(cos(radians(lat + tiny)) * cos(radians(df.latitude.values)) *
-                             cos(radians(df.longitude.values) - radians(lon + tiny)) +
-                             sin(radians(lat + tiny)) * sin(radians(df.latitude.values))))
-        return int(df.idgrid[df.dist.argmin()])
-    else:
-        return None
-
-
 def last_day_in_month(year, month):
     """Returns the last day in the month
     :return: a date object containing the last day in the month
@@ -337,6 +333,102 @@ def chunker(seq, size):
     return (seq[pos:pos + size] for pos in range(0, len(seq), size))
 
 
+def imap_bounded(executor, func, inputs, max_pending, ordered=False):
+    """Maps func over inputs using the executor while limiting the number of pending tasks.
+
+    Results are yielded in order of completion, or in order of the inputs when `ordered`
+    is True. Limiting the number of pending tasks bounds the memory taken by results that
+    are waiting to be consumed.
+
+    :param executor: a concurrent.futures executor
+    :param func: the function to apply to each input
+    :param inputs: an iterable of inputs
+    :param max_pending: the maximum number of tasks submitted but not yet consumed, should be > 0
+    :param ordered: yield results in the order of the inputs
+    :return: a generator yielding the results of func
+    """
+    if ordered:
+        pending = collections.deque()
+        for inp in inputs:
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+            pending.append(executor.submit(func, inp))
+        while pending:
+            yield pending.popleft().result()
+        return
+
+    pending = set()
+    for inp in inputs:
+        if len(pending) >= max_pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+        pending.add(executor.submit(func, inp))
+
+    for future in concurrent.futures.as_completed(pending):
+        yield future.result()
+
+
+def pipeline(inputs, produce, maxsize):
+    """Runs produce() for each input in a background thread and yields the results.
+
+    Results are passed through a bounded queue: when `maxsize` results are waiting to be
+    consumed, the background thread blocks until the consumer catches up. This overlaps
+    I/O bound work (e.g. downloading) with the CPU bound work of the consumer, while bounding
+    the number of results that are produced but not yet consumed.
+
+    Exceptions raised by produce() are re-raised in the consumer. When the consumer raises an
+    exception or stops early, the inputs are closed by the background thread, which stops
+    a generator of inputs (e.g. one downloading data), and the background thread is joined.
+
+    :param inputs: an iterable of inputs, it is iterated in the background thread
+    :param produce: the function to apply to each input in the background thread, if None
+        the inputs themselves are passed to the consumer
+    :param maxsize: the maximum number of results waiting to be consumed, should be > 0
+    :return: a generator yielding the results of produce() in the order of the inputs
+    """
+    results = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    finished = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for inp in inputs:
+                if not put((inp if produce is None else produce(inp), None)):
+                    return
+        except Exception as e:
+            put((None, e))
+            return
+        finally:
+            # A generator can only be closed by the thread iterating over it
+            if hasattr(inputs, "close"):
+                inputs.close()
+        put((finished, None))
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            result, exc = results.get()
+            if exc is not None:
+                raise exc
+            if result is finished:
+                break
+            yield result
+    finally:
+        stop.set()
+        thread.join()
+
+
 def get_user_home():
     """A reasonable platform independent way to get the user home folder.
     If PCSE runs under a system user then return the temp directory as returned
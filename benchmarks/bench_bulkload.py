@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) October 2026, Wageningen Environmental Research
+# Allard de Wit (allard.dewit@wur.nl)
+"""Compares the throughput of loading AgERA5 records into SQLite.
+
+The previous approach (one dict per record, SQLAlchemy executemany in chunks) is compared
+with the SQLite fast path of agera5tools.bulkload. The records are synthetic but have the
+same layout as the AgERA5 weather table. Importing agera5tools requires a valid configuration,
+so set AGERA5TOOLS_CONFIG before running:
+
+    python benchmarks/bench_bulkload.py --nrows 1000000
+"""
+import argparse
+import datetime as dt
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import sqlalchemy as sa
+
+from agera5tools.bulkload import bulk_insert
+
+variables = ["temperature_air_2m_mean_24h", "temperature_air_2m_max_day_time",
+             "temperature_air_2m_min_night_time", "vapour_pressure_mean", "precipitation_flux",
+             "solar_radiation_flux", "wind_speed_10m_mean"]
+
+
+def make_table(nrows, ngrids=20000):
+    rng = np.random.default_rng(0)
+    ndays = -(-nrows // ngrids)
+    idgrid = np.tile(np.arange(1000000, 1000000 + ngrids, dtype=np.int64), ndays)[:nrows]
+    days = np.repeat(np.datetime64("2020-01-01") + np.arange(ndays), ngrids)[:nrows]
+    columns = {"idgrid": idgrid, "day": days}
+    for v in variables:
+        columns[v] = rng.random(nrows, dtype=np.float32) * 30
+    return pa.table(columns)
+
+
+def create_table(engine, table_name):
+    meta = sa.MetaData()
+    tbl = sa.Table(table_name, meta,
+                   sa.Column("idgrid", sa.Integer, primary_key=True, autoincrement=False),
+                   sa.Column("day", sa.Date, primary_key=True),
+                   *[sa.Column(v, sa.Float) for v in variables])
+    meta.create_all(engine)
+    return tbl
+
+
+def load_records(engine, tbl, table, chunk_size):
+    """The loader used before agera5tools.bulkload: a dict per record and executemany.
+    """
+    recs = table.to_pandas().to_dict(orient="records")
+    with engine.begin() as DBconn:
+        ins = tbl.insert()
+        for i in range(0, len(recs), chunk_size):
+            DBconn.execute(ins, recs[i:i + chunk_size])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nrows", type=int, default=500000, help="Number of records to load")
+    parser.add_argument("--chunk_size", type=int, default=10000, help="Records per batch")
+    args = parser.parse_args()
+
+    table = make_table(args.nrows)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name in ("records", "bulkload"):
+            fname = Path(tmpdir) / f"{name}.db"
+            engine = sa.create_engine(f"sqlite:///{fname}")
+            tbl = create_table(engine, "weather_grid_agera5")
+            t1 = time.time()
+            if name == "records":
+                load_records(engine, tbl, table, args.chunk_size)
+            else:
+                bulk_insert(engine, "weather_grid_agera5", table, args.chunk_size)
+            elapsed = time.time() - t1
+            with engine.connect() as DBconn:
+                n = DBconn.execute(sa.text("select count(*) from weather_grid_agera5")).scalar()
+            engine.dispose()
+            print(f"{name:>10s}: {n} records in {elapsed:.2f} seconds ({n / elapsed:,.0f} records/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) October 2026, Wageningen Environmental Research
+# Allard de Wit (allard.dewit@wur.nl)
+"""Benchmarks extracting time series for points from the NetCDF archive.
+
+A temporary archive with random data is written with the NetCDF files of fake_cds.py for the
+variables selected in the configuration. The time series for a point is then extracted by
+opening the files of each day as a multifile dataset (the approach used before) and by reading
+the grid cell from each file into preallocated arrays with `read_points_from_netcdf()`.
+Finally, time series for many sites are extracted in one pass over the files and one site at
+a time. The configured archive is not touched. Set AGERA5TOOLS_CONFIG before running:
+
+    python benchmarks/bench_extract_point.py --days 1000 --workers 1 4 8 --sites 1000
+"""
+import argparse
+import datetime as dt
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import fake_cds
+from agera5tools import config
+from agera5tools.util import create_target_fname, Point
+from agera5tools.extract_point import read_points_from_netcdf
+
+
+def write_archive(archive_path, days, variables):
+    area = [config.region.boundingbox.lat_max, config.region.boundingbox.lon_min,
+            config.region.boundingbox.lat_min, config.region.boundingbox.lon_max]
+    for varname in variables:
+        for day in days:
+            fname = create_target_fname(varname, day, agera5_dir=archive_path, version=config.misc.agera5_version)
+            fname.parent.mkdir(parents=True, exist_ok=True)
+            fake_cds.make_dataset(varname, day, area).to_netcdf(fname)
+
+
+def read_per_day(point, days, variables):
+    df_final = pd.DataFrame()
+    for day in days:
+        fnames = [create_target_fname(v, day, agera5_dir=config.data_storage.netcdf_path,
+                                      version=config.misc.agera5_version)
+                  for v in variables]
+        ds = xr.open_mfdataset(fnames)
+        df = ds.sel(lon=point.longitude, lat=point.latitude, method="nearest").to_dataframe()
+        df_final = pd.concat([df_final, df])
+    return df_final
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, default=1000, help="Number of days in the archive")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8],
+                        help="Numbers of worker processes to compare")
+    parser.add_argument("--sites", type=int, default=1000, help="Number of sites for the batch extraction")
+    parser.add_argument("--skip_per_day", action="store_true", help="Do not run the per day approach")
+    args = parser.parse_args()
+
+    variables = [varname for varname, selected in config.variables.items() if selected]
+    start_day = dt.date(config.temporal_range.start_year, 1, 1)
+    days = pd.date_range(start_day, periods=args.days)
+    bbox = config.region.boundingbox
+    point = Point(latitude=(bbox.lat_min + bbox.lat_max) / 2, longitude=(bbox.lon_min + bbox.lon_max) / 2)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        print(f"Writing {len(days) * len(variables)} NetCDF files to {tmpdir}")
+        write_archive(Path(tmpdir), [d.date() for d in days], variables)
+        config.data_storage.netcdf_path = Path(tmpdir)
+
+        if not args.skip_per_day:
+            t1 = time.time()
+            df_ref = read_per_day(point, days, variables)
+            print(f"multifile dataset per day: {time.time() - t1:7.2f} seconds")
+        for workers in args.workers:
+            t1 = time.time()
+            columns = read_points_from_netcdf([point.latitude], [point.longitude], days, variables, workers=workers)
+            print(f"read_points_from_netcdf, {workers} workers: {time.time() - t1:7.2f} seconds")
+            if not args.skip_per_day:
+                assert all(np.array_equal(columns[v][:, 0], df_ref[v].values, equal_nan=True) for v in variables)
+
+        if args.sites > 1:
+            rng = np.random.default_rng(1)
+            latitudes = rng.uniform(bbox.lat_min, bbox.lat_max, args.sites)
+            longitudes = rng.uniform(bbox.lon_min, bbox.lon_max, args.sites)
+            t1 = time.time()
+            columns = read_points_from_netcdf(latitudes, longitudes, days, variables, workers=args.workers[0])
+            elapsed = time.time() - t1
+            print(f"read_points_from_netcdf, {args.sites} sites in one pass: {elapsed:7.2f} seconds")
+            t1 = time.time()
+            nsites = min(args.sites, 10)
+            for i in range(nsites):
+                single = read_points_from_netcdf(latitudes[i:i+1], longitudes[i:i+1], days, variables,
+                                                 workers=args.workers[0])
+                assert all(np.array_equal(single[v][:, 0], columns[v][:, i], equal_nan=True) for v in variables)
+            elapsed = (time.time() - t1) / nsites * args.sites
+            print(f"read_points_from_netcdf, {args.sites} sites one by one (estimated): {elapsed:7.2f} seconds")
+
+if __name__ == "__main__":
+    main()
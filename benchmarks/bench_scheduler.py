@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) October 2026, Wageningen Environmental Research
+# Allard de Wit (allard.dewit@wur.nl)
+"""Benchmarks the CDS download scheduler against the fake CDS in fake_cds.py.
+
+Monthly downloads are requested for the variables selected in the configuration, for a number
+of months. The fake CDS has a configurable latency and failure rate, so the throughput and
+the effect of retries can be measured offline for different limits on the requests in flight.
+Only ZIP files are downloaded into the `tmp_path` and deleted afterwards, the NetCDF archive
+is not touched. Set AGERA5TOOLS_CONFIG before running:
+
+    python benchmarks/bench_scheduler.py --months 12 --latency 1 --failure_rate 0.1 --max_in_flight 1 4 8
+"""
+import argparse
+import time
+
+import fake_cds
+from agera5tools import config
+from agera5tools.build import download_one_month
+from agera5tools.scheduler import DownloadScheduler
+
+
+def download_and_delete(task):
+    download_details = download_one_month(task)
+    download_details["download_fname"].unlink()
+    return download_details
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--months", type=int, default=12, help="Number of months to download")
+    parser.add_argument("--latency", type=float, default=1.0, help="Mean latency of a request (seconds)")
+    parser.add_argument("--failure_rate", type=float, default=0.1, help="Probability that a request fails")
+    parser.add_argument("--max_in_flight", type=int, nargs="+", default=[1, 4, 8],
+                        help="Limits on requests in flight to compare")
+    parser.add_argument("--max_retries", type=int, default=3, help="Retries before a request fails")
+    parser.add_argument("--backoff", type=float, default=0.5, help="Delay before the first retry (seconds)")
+    args = parser.parse_args()
+
+    fake_cds.install(latency=args.latency, failure_rate=args.failure_rate)
+    varnames = [varname for varname, selected in config.variables.items() if selected]
+    year = config.temporal_range.start_year
+    tasks = [(v, year + i // 12, i % 12 + 1) for i in range(args.months) for v in varnames]
+
+    print(f"{len(tasks)} requests, latency {args.latency}s, failure rate {args.failure_rate}")
+    for max_in_flight in args.max_in_flight:
+        fake_cds.FakeClient.reset_stats()
+        scheduler = DownloadScheduler(download_and_delete, max_in_flight=max_in_flight,
+                                      max_retries=args.max_retries, backoff=args.backoff,
+                                      max_backoff=args.backoff * 8)
+        t1 = time.time()
+        results = list(scheduler.run(tasks))
+        elapsed = time.time() - t1
+        nfailed = sum(1 for _, _, error in results if error is not None)
+        stats = fake_cds.FakeClient.stats
+        print(f"max_in_flight={max_in_flight:3d}: {elapsed:7.2f} seconds, {len(tasks) / elapsed:6.2f} tasks/s, "
+              f"{stats['requests']} requests, {scheduler.nretries} retries, {nfailed} failed tasks, "
+              f"max {stats['max_in_flight']} concurrent requests")
+
+
+if __name__ == "__main__":
+    main()
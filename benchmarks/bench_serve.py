@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) October 2026, Wageningen Environmental Research
+# Allard de Wit (allard.dewit@wur.nl)
+"""Load test for the HTTP server started with `agera5tools serve`.
+
+For each number of worker processes the server is started on a local port, after which a number
+of clients send requests for random land cells and date ranges in the configured region as fast
+as possible. The throughput (requests per second) and latency percentiles are reported. Random
+date ranges make most requests miss the response cache, so the test measures the database access.
+More than one worker requires gunicorn. Set AGERA5TOOLS_CONFIG before running and run it on a
+machine with several cores, with a database built by `agera5tools build`:
+
+    python benchmarks/bench_serve.py --workers 1 2 4 8 --clients 32 --requests 2000
+"""
+import argparse
+import concurrent.futures
+import datetime as dt
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import requests
+
+from agera5tools import config
+from agera5tools.grid import get_grid_index
+
+
+def wait_for_server(url, process, timeout=60):
+    t1 = time.time()
+    while time.time() - t1 < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server stopped with exit code {process.returncode}")
+        try:
+            requests.get(url, timeout=5)
+            return
+        except (requests.ConnectionError, requests.Timeout):
+            time.sleep(0.2)
+    raise RuntimeError(f"Server did not start within {timeout} seconds")
+
+
+def make_urls(base_url, nrequests, days):
+    index = get_grid_index()
+    bbox = config.region.boundingbox
+    in_bbox = np.flatnonzero((index.latitude >= bbox.lat_min) & (index.latitude <= bbox.lat_max) &
+                             (index.longitude >= bbox.lon_min) & (index.longitude <= bbox.lon_max))
+    rng = np.random.default_rng(1)
+    cells = rng.choice(in_bbox, nrequests)
+    first_day = dt.date(config.temporal_range.start_year, 1, 1)
+    starts = rng.integers(0, max(days - 30, 1), nrequests)
+    urls = []
+    for cell, start in zip(cells, starts):
+        startdate = first_day + dt.timedelta(days=int(start))
+        enddate = startdate + dt.timedelta(days=int(rng.integers(30, 365)))
+        urls.append(f"{base_url}/api/v1/get_agera5?latitude={index.latitude[cell]}&longitude={index.longitude[cell]}"
+                    f"&startdate={startdate}&enddate={enddate}")
+    return urls
+
+
+def run_clients(urls, clients):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=clients, pool_maxsize=clients)
+    session.mount("http://", adapter)
+
+    def fetch(url):
+        t1 = time.perf_counter()
+        r = session.get(url, timeout=120)
+        r.raise_for_status()
+        return time.perf_counter() - t1, r.json()["success"]
+
+    t1 = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=clients) as executor:
+        results = list(executor.map(fetch, urls))
+    elapsed = time.perf_counter() - t1
+    latencies = np.array([r[0] for r in results])
+    failed = sum(not r[1] for r in results)
+    return elapsed, latencies, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4],
+                        help="Numbers of worker processes to compare")
+    parser.add_argument("--threads", type=int, default=None, help="Threads per worker process")
+    parser.add_argument("--clients", type=int, default=32, help="Number of concurrent clients")
+    parser.add_argument("--requests", type=int, default=2000, help="Number of requests per run")
+    parser.add_argument("--days", type=int, default=365, help="Number of days in the database to request from")
+    parser.add_argument("--port", type=int, default=8765, help="Port for the server")
+    args = parser.parse_args()
+
+    base_url = f"http://localhost:{args.port}"
+    urls = make_urls(base_url, args.requests + args.clients * 2, args.days)
+    warmup_urls, urls = urls[:args.clients * 2], urls[args.clients * 2:]
+    print(f"{'workers':>8} {'req/s':>8} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} {'failed':>7}")
+    for workers in args.workers:
+        cmd = [sys.executable, "-m", "agera5tools.cmd", "serve", "--port", str(args.port), "--workers", str(workers)]
+        if args.threads:
+            cmd += ["--threads", str(args.threads)]
+        process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=os.environ)
+        try:
+            wait_for_server(base_url, process)
+            # Warm up all workers
+            run_clients(warmup_urls, args.clients)
+            elapsed, latencies, failed = run_clients(urls, args.clients)
+        finally:
+            process.terminate()
+            process.wait()
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+        print(f"{workers:8d} {len(urls) / elapsed:8.1f} {p50:9.1f} {p95:9.1f} {p99:9.1f} {failed:7d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) October 2026, Wageningen Environmental Research
+# Allard de Wit (allard.dewit@wur.nl)
+"""A local stand-in for the CDS API that allows to run and benchmark downloads offline.
+
+`install()` replaces `cdsapi.Client` by `FakeClient`. Its `retrieve()` method waits for a
+configurable latency, fails randomly with a configurable probability and otherwise writes a
+ZIP file with one NetCDF file per requested day. The NetCDF files contain random values for
+the requested variable on the 0.1 degree AgERA5 grid within the requested area, with the
+same file names as the files from the CDS. Writing the NetCDF files requires scipy.
+
+Example::
+
+    import fake_cds
+    fake_cds.install(latency=2., failure_rate=0.1)
+    # agera5tools now downloads from the fake CDS
+"""
+import datetime as dt
+import random
+import threading
+import time
+from zipfile import ZipFile
+
+import cdsapi
+import numpy as np
+import xarray as xr
+
+from agera5tools.util import variable_names
+
+
+class FakeCDSError(Exception):
+    pass
+
+
+class FakeClient:
+    """Replaces cdsapi.Client, the settings and statistics are shared by all instances.
+    """
+    latency = 1.0
+    failure_rate = 0.
+    lock = threading.Lock()
+    stats = dict(requests=0, failures=0, in_flight=0, max_in_flight=0)
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    @classmethod
+    def reset_stats(cls):
+        with cls.lock:
+            cls.stats.update(requests=0, failures=0, in_flight=0, max_in_flight=0)
+
+    def retrieve(self, name, request, target):
+        cls = type(self)
+        with cls.lock:
+            cls.stats["requests"] += 1
+            cls.stats["in_flight"] += 1
+            cls.stats["max_in_flight"] = max(cls.stats["max_in_flight"], cls.stats["in_flight"])
+        try:
+            time.sleep(random.uniform(0.5, 1.5) * cls.latency)
+            if random.random() < cls.failure_rate:
+                with cls.lock:
+                    cls.stats["failures"] += 1
+                raise FakeCDSError(f"Fake CDS failed request for {request['variable']}")
+            write_zip(request, target)
+        finally:
+            with cls.lock:
+                cls.stats["in_flight"] -= 1
+
+
+def find_variable(request):
+    """Finds the AgERA5 variable name matching the CDS request.
+    """
+    for varname, details in variable_names.items():
+        if all(request.get(k) == v for k, v in details.items()):
+            return varname
+    raise FakeCDSError(f"Unknown variable in request: {request}")
+
+
+def make_dataset(varname, day, area):
+    """Creates a dataset with random values for one day on the AgERA5 grid within area [N, W, S, E].
+    """
+    lat_max, lon_min, lat_min, lon_max = area
+    lats = np.round(np.arange(np.floor(lat_max * 10), np.floor(lat_min * 10) - 1, -1) / 10, 1)
+    lons = np.round(np.arange(np.floor(lon_min * 10), np.floor(lon_max * 10) + 1) / 10, 1)
+    values = np.random.random((1, len(lats), len(lons))).astype(np.float32)
+    if varname.startswith("Temperature") or varname.startswith("Dew_Point"):
+        values = values * 30 + 270
+    elif varname.startswith("Solar"):
+        values = values * 2e7
+    time_coord = np.array([np.datetime64(day)], dtype="datetime64[ns]")
+    return xr.Dataset({varname: (("time", "lat", "lon"), values)},
+                      coords={"time": time_coord, "lat": lats, "lon": lons})
+
+
+def write_zip(request, target):
+    """Writes a ZIP file with one NetCDF file for each day in the request.
+
+    The NetCDF files are written in the NetCDF3 format with scipy, writing them through
+    HDF5 in the download threads conflicts with reading NetCDF files in the main thread.
+    """
+    varname = find_variable(request)
+    version = request.get("version", "1_1").replace("_", ".")
+    year, month = int(request["year"]), int(request["month"])
+    with ZipFile(target, "w") as myzip:
+        for d in request["day"]:
+            day = dt.date(year, month, int(d))
+            fname = f"{varname.replace('_', '-')}_C3S-glob-agric_AgERA5_{day:%Y%m%d}_final-v{version}.nc"
+            myzip.writestr(fname, bytes(make_dataset(varname, day, request["area"]).to_netcdf(engine="scipy")))
+
+
+def install(latency=1.0, failure_rate=0.):
+    """Replaces cdsapi.Client by FakeClient.
+
+    :param latency: the mean time (seconds) a request takes
+    :param failure_rate: the probability that a request fails
+    """
+    FakeClient.latency = latency
+    FakeClient.failure_rate = failure_rate
+    FakeClient.reset_stats()
+    cdsapi.Client = FakeClient